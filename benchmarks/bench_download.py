@@ -0,0 +1,99 @@
+"""Compares download_file_from_'s streaming engine against the old copyfileobj path.
+
+Run from the repository root:
+    python -m benchmarks.bench_download [--size-mib N] [--repeat N]
+
+Every variant downloads the same payload from a local stand-in server. Throughput is
+the best of the repeats; peak memory is what tracemalloc saw Python allocate during
+one extra traced run."""
+
+from argparse import ArgumentParser
+from os import urandom
+from pathlib import Path
+from shutil import copyfileobj
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+from typing import Callable, List, Tuple
+from urllib import request as urllib_request
+
+from src.xlib_commonpy.request import DownloadObserver, download_file_from_
+from tests.stand_in_server import StandInServer
+
+
+def _legacy_download_(url: str, dest_dir: Path) -> Path:
+    """What download_file_from_ did before the streaming engine (in binary mode)."""
+    with urllib_request.urlopen(url) as response:
+        fpath_dest = dest_dir.joinpath("legacy.download")
+        with open(fpath_dest, "xb") as fout:
+            copyfileobj(response, fout)
+    return fpath_dest
+
+
+def _variants_() -> List[Tuple[str, Callable[[str, Path], Path]]]:
+    variants: List[Tuple[str, Callable[[str, Path], Path]]] = [
+        ("copyfileobj (old)", _legacy_download_)
+    ]
+    for chunk_kib in (64, 256, 1024, 4096):
+        variants.append(
+            (
+                f"readinto {chunk_kib} KiB",
+                lambda url, dest, size=chunk_kib * 1024: download_file_from_(
+                    url, dest, chunk_size=size
+                ),
+            )
+        )
+    variants.append(
+        (
+            "observed 256 KiB",
+            lambda url, dest: download_file_from_(
+                url, dest, observer=DownloadObserver()
+            ),
+        )
+    )
+    variants.append(
+        (
+            "zero_copy 1024 KiB",
+            lambda url, dest: download_file_from_(
+                url, dest, chunk_size=1024 * 1024, zero_copy=True
+            ),
+        )
+    )
+    return variants
+
+
+def _time_one_(download: Callable[[str, Path], Path], url: str) -> float:
+    with TemporaryDirectory() as tmpdir:
+        started = perf_counter()
+        download(url, Path(tmpdir))
+        return perf_counter() - started
+
+
+def _peak_memory_of_(download: Callable[[str, Path], Path], url: str) -> int:
+    with TemporaryDirectory() as tmpdir:
+        start()
+        try:
+            download(url, Path(tmpdir))
+            return get_traced_memory()[1]
+        finally:
+            stop()
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mib", type=int, default=128)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size_mib * 1024 * 1024
+    with StandInServer() as server:
+        url = server.add_file("/payload", data=urandom(size))
+        print(f"{'variant':<22}{'MiB/s':>10}{'peak KiB':>12}")
+        for name, download in _variants_():
+            best = min(_time_one_(download, url) for _ in range(args.repeat))
+            peak = _peak_memory_of_(download, url)
+            print(f"{name:<22}{args.size_mib / best:>10.0f}{peak / 1024:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""Runs the package's hot paths under the profiler and reports throughput and latency
+percentiles, for catching regressions.
+
+Run from the repository root:
+    python -m benchmarks.bench_suite [--count N] [--root DIR] [--json PATH]
+                                     [--baseline PATH] [--tolerance PCT]
+
+Downloads are of files served by a local stand-in server, and working directories
+and the bundle are made of generated trees (in --root, default is the system's
+temporary directory). Throughput is each case's operations over its wall time, and the
+percentiles are those of the profiler's spans. Spans themselves are measured too, both
+disabled and enabled, since they sit on every hot path.
+
+--json saves the results. Giving a previous run's as --baseline compares against it
+and exits with status 1 if any span's p50 grew or any case's throughput fell by more
+than --tolerance percent."""
+
+from argparse import ArgumentParser
+from json import dumps, loads
+from os import urandom
+from pathlib import Path
+from sys import exit
+from tempfile import TemporaryDirectory
+from time import perf_counter, perf_counter_ns
+from typing import Callable, Dict, List, Tuple
+from unittest import mock
+
+from src.xlib_commonpy.bundle import Bundle
+from src.xlib_commonpy.request import HTTPConnectionPool, download_file_from_
+from src.xlib_commonpy.time_related import Profiler, profiler
+from src.xlib_commonpy.tmpworkingdir import TMPWorkingDir
+from tests.stand_in_server import StandInServer
+
+_Case = Tuple[str, Callable[[], object], List[str]]
+
+
+def _make_tree_(dirpath: Path, dirs: int, files_per_dir: int) -> None:
+    for i in range(dirs):
+        subdir = dirpath.joinpath(f"dir{i}")
+        subdir.mkdir(parents=True)
+        for j in range(files_per_dir):
+            subdir.joinpath(f"{j}.bin").write_bytes(b"x")
+
+
+def _create_and_delete_(root: Path) -> None:
+    workingdir = TMPWorkingDir(dirpath_parent=root)
+    workingdir.create_workingdir()
+    workingdir.delete_workingdir()
+
+
+def _workingdir_with_tree_(root: Path) -> None:
+    with TMPWorkingDir(dirpath_parent=root) as workingdir:
+        _make_tree_(workingdir.dirpath, dirs=10, files_per_dir=20)
+
+
+def _span_ns_(uut: Profiler, count: int) -> float:
+    started = perf_counter_ns()
+    for _ in range(count):
+        with uut.span("overhead"):
+            pass
+    return (perf_counter_ns() - started) / count
+
+
+def _run_(cases: List[_Case], count: int) -> Dict[str, Dict[str, float]]:
+    results: Dict[str, Dict[str, float]] = {}
+    for name, op, spans in cases:
+        op()  # Warms up connections, caches and the like
+        profiler.reset()
+        profiler.enabled = True
+        try:
+            started = perf_counter()
+            for _ in range(count):
+                op()
+            elapsed_sec = perf_counter() - started
+        finally:
+            profiler.enabled = False
+        report = profiler.report()
+        results[name] = {"ops_per_sec": count / elapsed_sec}
+        for span in spans:
+            results[f"{name} / {span}"] = report.get(span, {})
+    return results
+
+
+def _print_(results: Dict[str, Dict[str, float]]) -> None:
+    print(f"{'case / span':<52}{'ops/s':>10}{'p50 ms':>10}{'p90 ms':>10}", end="")
+    print(f"{'p99 ms':>10}{'max ms':>10}")
+    for name, result in results.items():
+        if "ops_per_sec" in result:
+            print(f"{name:<52}{result['ops_per_sec']:>10,.0f}")
+            continue
+        print(f"{'  ' + name.split(' / ', 1)[1]:<52}{'':>10}", end="")
+        for key in ("p50_sec", "p90_sec", "p99_sec", "max_sec"):
+            print(f"{result.get(key, 0) * 1000:>10.3f}", end="")
+        print()
+
+
+def _regressions_(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float,
+) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if "ops_per_sec" in result and before.get("ops_per_sec"):
+            change = result["ops_per_sec"] / before["ops_per_sec"] - 1
+            if change < -tolerance:
+                regressions.append(f"{name}: throughput {change:+.0%}")
+        if result.get("p50_sec") and before.get("p50_sec"):
+            change = result["p50_sec"] / before["p50_sec"] - 1
+            if change > tolerance:
+                regressions.append(f"{name}: p50 {change:+.0%}")
+    return regressions
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--root", type=Path, default=None)
+    parser.add_argument("--json", type=Path, default=None)
+    parser.add_argument("--baseline", type=Path, default=None)
+    parser.add_argument("--tolerance", type=float, default=20)
+    args = parser.parse_args()
+
+    disabled_ns = _span_ns_(Profiler(), 1_000_000)
+    enabled_ns = _span_ns_(Profiler(enabled=True), 1_000_000)
+    print(f"span overhead: {disabled_ns:.0f} ns disabled, {enabled_ns:.0f} ns enabled")
+    print()
+
+    with TemporaryDirectory(
+        dir=args.root
+    ) as tmpdir, StandInServer() as server, HTTPConnectionPool() as pool:
+        root = Path(tmpdir)
+        dirpath_downloads = root.joinpath("downloads")
+        dirpath_downloads.mkdir()
+        dirpath_bundle = root.joinpath("bundle")
+        _make_tree_(dirpath_bundle, dirs=100, files_per_dir=10)
+        url_small = server.add_file("/small", data=urandom(64 * 1024))
+        url_large = server.add_file("/large", data=urandom(16 * 1024 * 1024))
+
+        def download_(url: str) -> None:
+            download_file_from_(url, dirpath_downloads, pool=pool).unlink()
+
+        download = "download_file_from_"
+        create = "TMPWorkingDir.create_workingdir"
+        delete = "TMPWorkingDir.delete_workingdir"
+        cases: List[_Case] = [
+            ("download 64 KiB", lambda: download_(url_small), [download]),
+            ("download 16 MiB", lambda: download_(url_large), [download]),
+            (
+                "empty working directory",
+                lambda: _create_and_delete_(root),
+                [create, delete],
+            ),
+            (
+                "working directory of 200 files",
+                lambda: _workingdir_with_tree_(root),
+                [create, delete],
+            ),
+            ("Bundle.list_dir (100 entries)", Bundle.list_dir, ["Bundle.list_dir"]),
+        ]
+        with mock.patch.object(Bundle, Bundle.dirpath.__name__, lambda: dirpath_bundle):
+            results = _run_(cases, args.count)
+    results["span overhead"] = {"disabled_ns": disabled_ns, "enabled_ns": enabled_ns}
+    _print_({k: v for k, v in results.items() if k != "span overhead"})
+
+    if args.json is not None:
+        args.json.write_text(dumps(results, indent=2))
+    if args.baseline is not None:
+        regressions = _regressions_(
+            results, loads(args.baseline.read_text()), args.tolerance / 100
+        )
+        print()
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            exit(1)
+        print(f"No regressions beyond {args.tolerance:.0f}%.")
+
+
+if __name__ == "__main__":
+    main()
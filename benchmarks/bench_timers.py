@@ -0,0 +1,92 @@
+"""Compares TimeoutTimerPassive against TimeoutTimerMonotonic and TimerArray.
+
+Run from the repository root:
+    python -m benchmarks.bench_timers [--count N] [--repeat N]
+
+Polling has each kind of timer answer "which of these have timed out" for --count
+running timers that haven't timed out yet, which is the usual case when checking on
+lots of in-flight operations. Memory is what --count timers take up, as measured by
+tracemalloc. Each time is the best of the repeats."""
+
+from argparse import ArgumentParser
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+from typing import Callable, List, Tuple
+
+from src.xlib_commonpy.time_related import (
+    TimerArray,
+    TimeoutTimerMonotonic,
+    TimeoutTimerPassive,
+)
+
+
+def _passive_timers_(count: int) -> List[TimeoutTimerPassive]:
+    timers = [TimeoutTimerPassive(3600) for _ in range(count)]
+    for timer in timers:
+        timer.start_timer()
+    return timers
+
+
+def _monotonic_timers_(count: int) -> List[TimeoutTimerMonotonic]:
+    timers = [TimeoutTimerMonotonic(3600) for _ in range(count)]
+    for timer in timers:
+        timer.start_timer()
+    return timers
+
+
+def _timer_array_(count: int) -> TimerArray:
+    timers = TimerArray()
+    for _ in range(count):
+        timers.add(3600, start=True)
+    return timers
+
+
+def _best_sec_(op: Callable[[], object], repeat: int) -> float:
+    best_sec = float("inf")
+    for _ in range(repeat):
+        started = perf_counter()
+        op()
+        best_sec = min(best_sec, perf_counter() - started)
+    return best_sec
+
+
+def _bytes_for_(make: Callable[[], object]) -> int:
+    start()
+    made = make()
+    used = get_traced_memory()[0]
+    stop()
+    del made
+    return used
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    passive = _passive_timers_(args.count)
+    monotonic = _monotonic_timers_(args.count)
+    array = _timer_array_(args.count)
+    cases: List[Tuple[str, Callable[[], object], Callable[[], object]]] = [
+        (
+            "TimeoutTimerPassive",
+            lambda: [t for t in passive if t.timed_out()],
+            lambda: _passive_timers_(args.count),
+        ),
+        (
+            "TimeoutTimerMonotonic",
+            lambda: [t for t in monotonic if t.timed_out()],
+            lambda: _monotonic_timers_(args.count),
+        ),
+        ("TimerArray", array.timed_out, lambda: _timer_array_(args.count)),
+    ]
+    print(f"{'timers':<24}{'poll ms':>10}{'bytes/timer':>14}")
+    for name, poll, make in cases:
+        poll_ms = _best_sec_(poll, args.repeat) * 1000
+        bytes_per_timer = _bytes_for_(make) / args.count
+        print(f"{name:<24}{poll_ms:>10.2f}{bytes_per_timer:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Compares TMPWorkingDir's parallel tree deletion against shutil.rmtree.
+
+Run from the repository root:
+    python -m benchmarks.bench_tree_deletion [--scale N] [--repeat N] [--root DIR]
+
+Every shape of tree is generated afresh before each timed deletion. Deletion time is
+the best of the repeats. The gap grows with how slow the file system is to answer each
+call, so pointing --root at a network or overlay mount shows it best."""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from shutil import rmtree
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, List, Tuple
+
+from src.xlib_commonpy.tmpworkingdir import _delete_tree_
+
+
+def _make_files_(dirpath: Path, count: int) -> None:
+    for i in range(count):
+        dirpath.joinpath(f"{i}.bin").write_bytes(b"x")
+
+
+def _flat_(dirpath: Path, scale: int) -> None:
+    dirpath.mkdir()
+    _make_files_(dirpath, 5000 * scale)
+
+
+def _wide_(dirpath: Path, scale: int) -> None:
+    dirpath.mkdir()
+    for i in range(100 * scale):
+        subdir = dirpath.joinpath(str(i))
+        subdir.mkdir()
+        _make_files_(subdir, 50)
+
+
+def _deep_(dirpath: Path, scale: int) -> None:
+    for i in range(200 * scale):
+        dirpath = dirpath.joinpath(str(i))
+        dirpath.mkdir(parents=True)
+        _make_files_(dirpath, 20)
+
+
+def _bushy_(dirpath: Path, scale: int, depth: int = 5) -> None:
+    dirpath.mkdir()
+    _make_files_(dirpath, 10)
+    if depth:
+        for i in range(3 + scale):
+            _bushy_(dirpath.joinpath(str(i)), scale, depth - 1)
+
+
+_SHAPES: List[Tuple[str, Callable[[Path, int], None]]] = [
+    ("flat", _flat_),
+    ("wide", _wide_),
+    ("deep", _deep_),
+    ("bushy", _bushy_),
+]
+_ENGINES: List[Tuple[str, Callable[[str], None]]] = [
+    ("rmtree", rmtree),
+    ("parallel", _delete_tree_),
+]
+
+
+def _time_one_(
+    make: Callable[[Path, int], None],
+    delete: Callable[[str], None],
+    root: Path,
+    scale: int,
+) -> Tuple[float, int]:
+    with TemporaryDirectory(dir=root) as tmpdir:
+        dirpath = Path(tmpdir).joinpath("tree")
+        make(dirpath, scale)
+        entries = sum(1 for _ in dirpath.rglob("*"))
+        started = perf_counter()
+        delete(str(dirpath))
+        return perf_counter() - started, entries
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--root", type=Path, default=None)
+    args = parser.parse_args()
+
+    print(
+        f"{'shape':<8}{'entries':>10}"
+        + "".join(f"{n + ' ms':>14}" for n, _ in _ENGINES)
+    )
+    for shape_name, make in _SHAPES:
+        row = ""
+        entries = 0
+        for _, delete in _ENGINES:
+            timings = [
+                _time_one_(make, delete, args.root, args.scale)
+                for _ in range(args.repeat)
+            ]
+            entries = timings[0][1]
+            row += f"{min(sec for sec, _ in timings) * 1000:>14.1f}"
+        print(f"{shape_name:<8}{entries:>10}{row}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Times how quickly TMPWorkingDirs are named, constructed, and created.
+
+Run from the repository root:
+    python -m benchmarks.bench_workingdir_creation [--count N] [--repeat N] [--root DIR]
+
+Naming compares uuid.uuid1 (which the names used to come from) with the names made now.
+Creating compares TMPWorkingDir's create and delete with tempfile.mkdtemp and rmdir,
+which is about as cheap as atomically creating a directory gets. Each figure is the
+best of the repeats, in operations per second."""
+
+from argparse import ArgumentParser
+from os import rmdir
+from pathlib import Path
+from sys import executable
+from tempfile import TemporaryDirectory, mkdtemp
+from time import perf_counter
+from typing import Callable, List, Tuple
+from uuid import uuid1
+
+from src.xlib_commonpy.tmpworkingdir import TMPWorkingDir, _naming
+
+
+def _uuid1_name_() -> str:
+    return "_tmp_" + Path(executable).stem + "_" + str(uuid1())
+
+
+def _create_and_delete_(root: Path) -> None:
+    workingdir = TMPWorkingDir(dirpath_parent=root)
+    workingdir.create_workingdir()
+    workingdir.delete_workingdir()
+
+
+def _mkdtemp_and_rmdir_(root: Path) -> None:
+    rmdir(mkdtemp(dir=root))
+
+
+def _ops_per_sec_(op: Callable[[], object], count: int, repeat: int) -> float:
+    best_sec = float("inf")
+    for _ in range(repeat):
+        started = perf_counter()
+        for _ in range(count):
+            op()
+        best_sec = min(best_sec, perf_counter() - started)
+    return count / best_sec
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--root", type=Path, default=None)
+    args = parser.parse_args()
+
+    with TemporaryDirectory(dir=args.root) as tmpdir:
+        root = Path(tmpdir)
+        cases: List[Tuple[str, Callable[[], object]]] = [
+            ("name with uuid1", _uuid1_name_),
+            ("name", _naming.new),
+            ("construct", lambda: TMPWorkingDir(dirpath_parent=root)),
+            ("create+delete", lambda: _create_and_delete_(root)),
+            ("mkdtemp+rmdir", lambda: _mkdtemp_and_rmdir_(root)),
+        ]
+        print(f"{'case':<18}{'ops/s':>14}")
+        for name, op in cases:
+            print(f"{name:<18}{_ops_per_sec_(op, args.count, args.repeat):>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+from sys import platform
+from typing import BinaryIO
+
+# From linux/fs.h; makes a file share another's data copy-on-write (i.e. a reflink)
+_FICLONE = 0x40049409
+
+
+def try_cloning_(fin: BinaryIO, fout: BinaryIO) -> bool:
+    """Makes fout share fin's data copy-on-write, and returns whether it could. That's
+    only on Linux, and only on file systems with reflinks (Btrfs, XFS, ...) and when
+    both files are on the same one."""
+    if not platform.startswith("linux"):
+        return False
+    # Imported here since fcntl doesn't exist on Windows
+    from fcntl import ioctl
+
+    try:
+        ioctl(fout.fileno(), _FICLONE, fin.fileno())
+    except OSError:
+        return False  # The file system doesn't support reflinks (or not across these)
+    return True
@@ -1,7 +1,324 @@
+import os
 import sys
-from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from fnmatch import translate
+from hashlib import new as new_hasher
+from json import dumps, loads
+from mmap import ACCESS_READ, mmap
+from pathlib import Path, PurePath
+from re import compile as compile_regex
 from sys import path
-from typing import List
+from threading import Lock, Thread
+from time import monotonic
+from typing import (
+    BinaryIO,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from .time_related import profiler
+
+# What Bundle.write_manifest writes into a bundle directory, for frozen builds to load
+# their index from instead of walking the bundle, and to verify files against
+_MANIFEST_FILENAME = ".bundle_manifest.json"
+_MANIFEST_VERSION = 2
+# Threads that files are hashed with. Hashing big chunks releases the GIL.
+_HASHING_WORKERS = 8
+_HASHING_CHUNK_SIZE = 1024 * 1024
+# While debugging, how long an index is trusted before it's checked against the bundle
+# again. Checking stats every directory, which is too much to do on every lookup.
+_INDEX_CHECK_INTERVAL_SEC = 1.0
+
+
+class BundleIntegrityError(ValueError):
+    """Raised when a bundled file doesn't match the bundle's manifest."""
+
+    def __init__(self, relpath: str, expected: Optional[str], actual: str) -> None:
+        if expected is None:
+            super().__init__(f"{relpath} isn't in the bundle's manifest.")
+        else:
+            super().__init__(f"{relpath} hashes to {actual}, not {expected}.")
+        self.relpath = relpath
+        self.expected = expected
+        self.actual = actual
+
+
+class BundleEntry(NamedTuple):
+    """A file or directory in the bundle directory."""
+
+    relpath: str  # Relative to the bundle directory, with "/" separating parts
+    path: Path
+    size: int  # As of when the bundle was indexed (0 for directories)
+    is_dir: bool
+
+
+class _BundleIndex:
+    """Everything in a bundle directory, recursively, keyed for quick lookups."""
+
+    def __init__(
+        self,
+        root: Path,
+        entries: Dict[str, Tuple[int, bool]],
+        dir_mtimes: Dict[str, Optional[int]],
+        hash_name: str = "",
+        digests: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Arguments:
+        root -- the bundle directory
+        entries -- size and whether it's a directory, keyed by relative path
+        dir_mtimes -- mtimes (in ns) of the bundle's directories as of indexing, which
+            tell when the index is out of date (None for one that didn't exist)
+        hash_name -- what hashlib algorithm the digests are of
+        digests -- hex digests of the files, keyed by relative path (only manifests
+            have them)
+        """
+        self.root = root
+        self.entries = entries
+        self._dir_mtimes = dir_mtimes
+        self._checked_at = monotonic()
+        self.hash_name = hash_name
+        self.digests = {} if digests is None else digests
+        self.top_level: List[str] = []
+        self.relpaths_by_name: Dict[str, List[str]] = {}
+        for relpath in entries:
+            dir_relpath, _, name = relpath.rpartition("/")
+            if not dir_relpath:
+                self.top_level.append(relpath)
+            self.relpaths_by_name.setdefault(name, []).append(relpath)
+
+    @classmethod
+    def walk(cls, root: Path) -> "_BundleIndex":
+        entries: Dict[str, Tuple[int, bool]] = {}
+        dir_mtimes: Dict[str, Optional[int]] = {}
+        # Symlinked directories are followed, but each directory's only walked once
+        walked: Set[Tuple[int, int]] = set()
+        pending = [(str(root), "")]
+        while pending:
+            dirpath, dir_relpath = pending.pop()
+            try:
+                # Taken before scanning so that changes made meanwhile show as stale
+                stat = os.stat(dirpath)
+                dir_mtimes[dirpath] = stat.st_mtime_ns
+                if (stat.st_dev, stat.st_ino) in walked:
+                    continue
+                walked.add((stat.st_dev, stat.st_ino))
+                entries_here = os.scandir(dirpath)
+            except FileNotFoundError:
+                dir_mtimes[dirpath] = None
+                continue
+            with entries_here:
+                for entry in entries_here:
+                    relpath = dir_relpath + entry.name
+                    if not dir_relpath and entry.name == _MANIFEST_FILENAME:
+                        continue
+                    if entry.is_dir():
+                        entries[relpath] = (0, True)
+                        pending.append((entry.path, relpath + "/"))
+                        continue
+                    try:
+                        size = entry.stat().st_size
+                    except FileNotFoundError:
+                        size = 0  # A broken symlink, or deleted while indexing
+                    entries[relpath] = (size, False)
+        return cls(root, entries, dir_mtimes)
+
+    @classmethod
+    def load(cls, root: Path) -> Optional["_BundleIndex"]:
+        """Returns None if there's no usable manifest."""
+        try:
+            manifest = loads(root.joinpath(_MANIFEST_FILENAME).read_bytes())
+        except (OSError, ValueError):
+            return None
+        if manifest.get("version") != _MANIFEST_VERSION:
+            return None
+        entries = {}
+        digests = {}
+        for relpath, size, is_dir, digest in manifest["entries"]:
+            entries[relpath] = (size, is_dir)
+            if digest is not None:
+                digests[relpath] = digest
+        return cls(root, entries, {}, manifest["hash_name"], digests)
+
+    def dumps(self) -> str:
+        return dumps(
+            {
+                "version": _MANIFEST_VERSION,
+                "hash_name": self.hash_name,
+                "entries": [
+                    [relpath, size, is_dir, self.digests.get(relpath)]
+                    for relpath, (size, is_dir) in sorted(self.entries.items())
+                ],
+            }
+        )
+
+    def hash_files(self, hash_name: str) -> None:
+        """Takes the digests of all the files, on many threads."""
+        relpaths = [
+            relpath for relpath, (_, is_dir) in self.entries.items() if not is_dir
+        ]
+        with ThreadPoolExecutor(max_workers=_HASHING_WORKERS) as executor:
+            digests = executor.map(
+                lambda relpath: _digest_of_(self.root.joinpath(relpath), hash_name),
+                relpaths,
+            )
+            self.digests = dict(zip(relpaths, digests))
+        self.hash_name = hash_name
+
+    def is_current(self, top_level: bool = False) -> bool:
+        """Only actually checks once every _INDEX_CHECK_INTERVAL_SEC, so changes take
+        up to that long to show. With top_level, the bundle directory itself is
+        checked every time regardless (a single stat)."""
+        now = monotonic()
+        if now - self._checked_at < _INDEX_CHECK_INTERVAL_SEC:
+            return not top_level or self._is_dir_current(str(self.root))
+        if not all(self._is_dir_current(dirpath) for dirpath in self._dir_mtimes):
+            return False
+        self._checked_at = now
+        return True
+
+    def _is_dir_current(self, dirpath: str) -> bool:
+        mtime = self._dir_mtimes.get(dirpath)
+        try:
+            return os.stat(dirpath).st_mtime_ns == mtime
+        except FileNotFoundError:
+            return mtime is None
+
+    def entry(self, relpath: str) -> BundleEntry:
+        size, is_dir = self.entries[relpath]
+        return BundleEntry(relpath, self.root.joinpath(relpath), size, is_dir)
+
+
+_index: Optional[_BundleIndex] = None
+_index_lock = Lock()
+
+
+def _digest_of_(fpath: Path, hash_name: str) -> str:
+    hasher = new_hasher(hash_name)
+    buffer = memoryview(bytearray(_HASHING_CHUNK_SIZE))
+    with open(fpath, "rb", buffering=0) as fin:
+        while True:
+            n = fin.readinto(buffer)
+            if not n:
+                return hasher.hexdigest()
+            hasher.update(buffer[:n])
+
+
+class _Mapping(NamedTuple):
+    mapped: Optional[mmap]  # None for empty files, which can't be mapped
+    # What the file was when it got mapped, to tell when it's been replaced
+    st_ino: int
+    st_mtime_ns: int
+    st_size: int
+    # Whether it's been checked against the manifest (or there isn't one)
+    verified: bool = False
+
+
+# Per process, keyed by absolute path
+_mappings: Dict[str, _Mapping] = {}
+_mappings_lock = Lock()
+
+
+def _map_(fin: BinaryIO) -> _Mapping:
+    stat = os.fstat(fin.fileno())
+    mapped = mmap(fin.fileno(), 0, access=ACCESS_READ) if stat.st_size else None
+    return _Mapping(mapped, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _digest_of_mapped_(mapped: Optional[mmap], hash_name: str) -> str:
+    hasher = new_hasher(hash_name)
+    if mapped is not None:
+        hasher.update(mapped)  # Releases the GIL, since it's big enough
+    return hasher.hexdigest()
+
+
+class _Verifier:
+    """Checks bundled files against the digests in the bundle's manifest. What's
+    hashed is the mapping that gets used, so the file can't be swapped out between
+    being checked and being read. Each file's only hashed once per process (as long as
+    it isn't changed). Whoever asks first does the hashing, and anyone asking
+    meanwhile (including verify_all's threads) waits on that rather than hashing
+    again."""
+
+    def __init__(self, manifest: _BundleIndex) -> None:
+        self.root = manifest.root
+        self._manifest = manifest
+        self._lock = Lock()
+        self._results: Dict[Tuple[str, int, int, int], "Future[None]"] = {}
+
+    def verify(self, relpath: str) -> None:
+        """For files that aren't kept mapped. They're mapped just for hashing."""
+        with open(self.root.joinpath(relpath), "rb") as fin:
+            mapping = _map_(fin)
+        try:
+            self.verify_mapped(relpath, mapping)
+        finally:
+            if mapping.mapped is not None:
+                mapping.mapped.close()
+
+    def verify_mapped(self, relpath: str, mapping: _Mapping) -> None:
+        key = (relpath, mapping.st_ino, mapping.st_mtime_ns, mapping.st_size)
+        with self._lock:
+            result = self._results.get(key)
+            is_first = result is None
+            if result is None:
+                result = self._results[key] = Future()
+        if is_first:
+            result.set_running_or_notify_cancel()
+            try:
+                self._check(relpath, mapping.mapped)
+            except Exception as e:
+                result.set_exception(e)
+            else:
+                result.set_result(None)
+        result.result()
+
+    def verify_all(self, max_workers: int) -> "Future[Dict[str, Exception]]":
+        everything: "Future[Dict[str, Exception]]" = Future()
+        everything.set_running_or_notify_cancel()
+        relpaths = [
+            relpath
+            for relpath, (_, is_dir) in self._manifest.entries.items()
+            if not is_dir
+        ]
+
+        def error_for_(relpath: str) -> Optional[Exception]:
+            try:
+                self.verify(relpath)
+            except Exception as e:
+                return e
+            return None
+
+        def verify_all_() -> None:
+            with ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="Bundle verifier"
+            ) as executor:
+                errors = list(executor.map(error_for_, relpaths))
+            everything.set_result(
+                {
+                    relpath: error
+                    for relpath, error in zip(relpaths, errors)
+                    if error is not None
+                }
+            )
+
+        Thread(target=verify_all_, name="Bundle verifier", daemon=True).start()
+        return everything
+
+    def _check(self, relpath: str, mapped: Optional[mmap]) -> None:
+        expected = self._manifest.digests.get(relpath)
+        actual = _digest_of_mapped_(mapped, self._manifest.hash_name)
+        if actual != expected:
+            raise BundleIntegrityError(relpath, expected, actual)
+
+
+_verifier: Optional[_Verifier] = None
+_verifier_lock = Lock()
 
 
 class Bundle:
@@ -13,6 +330,16 @@ class Bundle:
     your Python code can then use that shell script without worrying about where it's
     located on whatever machine you're running your binary/code on.
 
+    Looking things up (lookup, find_named, glob, iter_sizes) goes through an index of
+    the whole bundle that's built on first use and kept in memory, so it's cheap enough
+    for hot loops. While debugging, the index is checked against the mtimes of the
+    bundle's directories (a stat per directory) at most once a second, and rebuilt if
+    anything was added, removed or renamed. list_dir goes through it as well, but
+    checks the bundle directory itself every time, so it's never behind. Built bundles
+    can't change, so theirs is never checked, and if write_manifest was run on the
+    bundle before building, it's loaded from that rather than walking the bundle at
+    all.
+
     LEGAL DISCLAIMER (I'm not a lawyer, so this is not official legal advice): Be wary
     when bundling stuff with your binaries. Copyright laws and such could land you in
     legal hot water."""
@@ -21,7 +348,7 @@ class Bundle:
     def dirpath() -> Path:
         """Path to this application's bundle directory.
         Taken from https://stackoverflow.com/a/65327808/8462094"""
-        if getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS"):
+        if Bundle._is_frozen_():
             # Gets path to bundle when this program has been built
             return Path(sys._MEIPASS)  # type: ignore
         # Path to bundle when debugging
@@ -29,6 +356,217 @@ class Bundle:
 
     @staticmethod
     def list_dir() -> List[Path]:
-        if not Bundle.dirpath().exists():
-            return []
-        return list(Bundle.dirpath().iterdir())
+        """What's at the top level of the bundle directory."""
+        with profiler.span("Bundle.list_dir"):
+            # Always up to date with the top level, as when this listed it directly
+            index = Bundle._index_(top_level=True)
+            return [index.root.joinpath(relpath) for relpath in index.top_level]
+
+    @staticmethod
+    def lookup(relpath: Union[str, PurePath]) -> Optional[BundleEntry]:
+        """Returns what's at a path relative to the bundle directory (None if there's
+        nothing)."""
+        index = Bundle._index_()
+        if isinstance(relpath, PurePath):
+            relpath = relpath.as_posix()
+        if relpath not in index.entries:
+            return None
+        return index.entry(relpath)
+
+    @staticmethod
+    def find_named(name: str) -> List[BundleEntry]:
+        """Returns everything in the bundle with this file or directory name, at any
+        depth."""
+        index = Bundle._index_()
+        return [
+            index.entry(relpath) for relpath in index.relpaths_by_name.get(name, ())
+        ]
+
+    @staticmethod
+    def glob(pattern: str) -> List[BundleEntry]:
+        """Returns everything whose relative path (with "/" separating parts) matches a
+        shell-style pattern. Unlike with Path.glob, "*" also matches across "/", so
+        "*.sh" finds shell scripts at any depth and "tools/*" anything under tools."""
+        index = Bundle._index_()
+        matches = compile_regex(translate(pattern)).match
+        return [index.entry(relpath) for relpath in index.entries if matches(relpath)]
+
+    @staticmethod
+    def iter_sizes() -> Iterator[Tuple[str, int]]:
+        """Yields the relative path and size of each file in the bundle."""
+        for relpath, (size, is_dir) in Bundle._index_().entries.items():
+            if not is_dir:
+                yield relpath, size
+
+    @staticmethod
+    def map_file(relpath: Union[str, PurePath]) -> mmap:
+        """Returns a read-only memory map of a bundled file. Mappings are cached and
+        shared by everyone in the process who maps the same file, and the pages are the
+        OS's page cache, so processes mapping the same file share them too instead of
+        each reading a copy of it into memory. Empty files can't be mapped (ValueError).
+        See view_file for a memoryview instead.
+
+        While debugging, a file that's been replaced or changed since it was mapped
+        gets mapped anew. Replace files (write the new one next to it and rename it
+        over) rather than rewriting them in place: those with the old mapping keep
+        using the old file then, whereas reading past the end of a mapped file that
+        got shorter crashes. Built bundles can't change, so their mappings are used as
+        they are.
+
+        If the bundle has a manifest (see write_manifest), each mapping is checked
+        against it once before it's first returned, and BundleIntegrityError is raised
+        if it doesn't match. It's the mapped bytes that get hashed, so what's checked is
+        what's read."""
+        mapped = Bundle._mapping_of_(relpath)
+        if mapped is None:
+            raise ValueError(f"Empty files can't be memory-mapped: {relpath}")
+        return mapped
+
+    @staticmethod
+    def view_file(relpath: Union[str, PurePath]) -> memoryview:
+        """Returns a read-only memoryview of a bundled file, which slices without
+        copying. It's of the same shared mapping that map_file returns (or empty for
+        an empty file), checked against the manifest the same way."""
+        mapped = Bundle._mapping_of_(relpath)
+        return memoryview(b"" if mapped is None else mapped)
+
+    @staticmethod
+    def unmap_all() -> None:
+        """Drops the cached mappings. Each is unmapped once nothing else references it
+        (including memoryviews of it)."""
+        with _mappings_lock:
+            _mappings.clear()
+
+    @staticmethod
+    def _mapping_of_(relpath: Union[str, PurePath]) -> Optional[mmap]:
+        """Returns None for empty files. If the bundle has a manifest, what's mapped
+        is checked against it before it's handed out (BundleIntegrityError)."""
+        entry = Bundle.lookup(relpath)
+        if entry is None:
+            raise FileNotFoundError(Bundle.dirpath().joinpath(relpath))
+        if entry.is_dir:
+            raise IsADirectoryError(entry.path)
+        key = str(entry.path)
+        frozen = Bundle._is_frozen_()
+        with _mappings_lock:
+            mapping = _mappings.get(key)
+            if mapping is not None and not frozen:
+                stat = os.stat(key)
+                if (mapping.st_ino, mapping.st_mtime_ns, mapping.st_size) != (
+                    stat.st_ino,
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                ):
+                    mapping = None
+            if mapping is None:
+                with open(key, "rb") as fin:
+                    mapping = _mappings[key] = _map_(fin)
+        if not mapping.verified:
+            # Outside of the lock, since hashing a big file takes a while
+            verifier = Bundle._verifier_or_none_()
+            if verifier is not None:
+                verifier.verify_mapped(entry.relpath, mapping)
+            with _mappings_lock:
+                if _mappings.get(key) is mapping:
+                    _mappings[key] = mapping._replace(verified=True)
+        return mapping.mapped
+
+    @staticmethod
+    def verify(relpath: Union[str, PurePath]) -> Path:
+        """Checks a bundled file against the digest the bundle's manifest has for it,
+        and returns its path. Raises BundleIntegrityError if it doesn't match or isn't
+        in the manifest, and FileNotFoundError if there's no manifest. Each file's only
+        hashed the first time it's verified; after that, this returns (or raises) the
+        same right away for the rest of the process (unless it's changed), which includes
+        files that map_file or view_file checked already."""
+        if isinstance(relpath, PurePath):
+            relpath = relpath.as_posix()
+        verifier = Bundle._verifier_or_none_()
+        if verifier is None:
+            raise FileNotFoundError(Bundle.dirpath().joinpath(_MANIFEST_FILENAME))
+        verifier.verify(relpath)
+        return verifier.root.joinpath(relpath)
+
+    @staticmethod
+    def verify_all(
+        max_workers: int = _HASHING_WORKERS,
+    ) -> "Future[Dict[str, Exception]]":
+        """Starts verifying every file in the bundle's manifest in the background, and
+        returns a future of what failed (keyed by relative path; empty if nothing
+        did). Files are hashed on max_workers threads. verify calls for files that are
+        being or have been verified this way don't hash them again."""
+        verifier = Bundle._verifier_or_none_()
+        if verifier is None:
+            raise FileNotFoundError(Bundle.dirpath().joinpath(_MANIFEST_FILENAME))
+        return verifier.verify_all(max_workers)
+
+    @staticmethod
+    def write_manifest(
+        dirpath: Optional[Path] = None, hash_name: str = "sha256"
+    ) -> Path:
+        """Writes an index of a bundle directory into it (default is the bundle
+        directory while debugging), with the digests of its files, and returns where.
+        Run this right before building. Built programs then load that instead of
+        walking their bundles at startup, and verify checks files against it.
+
+        Arguments:
+        dirpath -- the bundle directory
+        hash_name -- the hashlib algorithm to take digests with
+        """
+        index = _BundleIndex.walk(Bundle.dirpath() if dirpath is None else dirpath)
+        index.hash_files(hash_name)
+        fpath = index.root.joinpath(_MANIFEST_FILENAME)
+        fpath_tmp = fpath.with_name(fpath.name + ".tmp")
+        fpath_tmp.write_text(index.dumps())
+        os.replace(str(fpath_tmp), str(fpath))
+        return fpath
+
+    @staticmethod
+    def _verifier_or_none_() -> Optional[_Verifier]:
+        """Returns None if the bundle has no manifest to verify against."""
+        global _verifier
+        root = Bundle.dirpath()
+        with _verifier_lock:
+            if _verifier is None or _verifier.root != root:
+                manifest = _BundleIndex.load(root)
+                if manifest is None:
+                    return None
+                _verifier = _Verifier(manifest)
+            return _verifier
+
+    @staticmethod
+    def _is_frozen_() -> bool:
+        return bool(getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS"))
+
+    @staticmethod
+    def _index_(top_level: bool = False) -> _BundleIndex:
+        """Arguments:
+        top_level -- whether the top level has to be up to date right now, rather than
+            as of the last check
+        """
+        global _index
+        root = Bundle.dirpath()
+        frozen = Bundle._is_frozen_()
+        index = _index
+        if (
+            index is not None
+            and index.root == root
+            and (frozen or index.is_current(top_level))
+        ):
+            return index
+        with _index_lock:
+            # Another thread may have rebuilt it while this one waited
+            index = _index
+            if (
+                index is not None
+                and index.root == root
+                and (frozen or index.is_current(top_level))
+            ):
+                return index
+            index = None
+            if frozen:
+                index = _BundleIndex.load(root)
+            if index is None:
+                index = _BundleIndex.walk(root)
+            _index = index
+            return index
@@ -1,14 +1,1154 @@
-from http.client import HTTPResponse
-from os import PathLike
+import os
+from asyncio import (
+    IncompleteReadError,
+    LimitOverrunError,
+    Semaphore,
+    StreamReader,
+    StreamWriter,
+    as_completed as as_completed_async,
+    create_task,
+    gather,
+    open_connection,
+    wait_for,
+)
+from asyncio import TimeoutError as AsyncTimeoutError
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from email.utils import parsedate_to_datetime
+from functools import partial
+from hashlib import new as new_hasher
+from hashlib import sha256
+from http.client import (
+    HTTPConnection,
+    HTTPException,
+    HTTPMessage,
+    HTTPResponse,
+    HTTPSConnection,
+    IncompleteRead,
+    RemoteDisconnected,
+    parse_headers,
+)
+from io import DEFAULT_BUFFER_SIZE, BytesIO
+from json import JSONDecodeError, dumps, loads
+from lzma import LZMADecompressor
+from os import PathLike, get_blocking, link, pipe, replace, unlink
 from pathlib import Path
-from shutil import copyfileobj
-from typing import Optional
+from random import uniform
+from re import fullmatch
+from shutil import copyfile, copyfileobj, rmtree
+from socket import _GLOBAL_DEFAULT_TIMEOUT  # type: ignore
+from socket import SOCK_STREAM, getaddrinfo, socket
+from socket import timeout as SocketTimeout
+from ssl import SSLContext, create_default_context
+from threading import Event, Lock, Thread
+from time import monotonic, sleep, time
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 from urllib import request
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit
 from uuid import uuid4
+from zlib import MAX_WBITS, decompressobj
+from zlib import error as ZlibError
+
+from ._reflink import try_cloning_
+from .time_related import Deadline, DeadlineExceeded, profiler
+
+try:  # Brotli is optional; without it, servers just aren't offered br
+    from brotli import Decompressor as _BrotliDecompressor
+except ImportError:  # pragma: no cover
+    try:
+        from brotlicffi import Decompressor as _BrotliDecompressor
+    except ImportError:
+        _BrotliDecompressor = None
+
+_REDIRECT_STATUSES = frozenset((301, 302, 303, 307, 308))
+# Files smaller than two of these aren't worth splitting up for a ranged download
+_MIN_PART_SIZE = 8 * 1024 * 1024
+# Big enough that per-chunk overhead is negligible; see benchmarks/bench_download.py
+DEFAULT_CHUNK_SIZE = 256 * 1024
+# How many bytes a resumable download may get through before its progress is recorded
+_CHECKPOINT_INTERVAL = 8 * 1024 * 1024
+# Status line and headers bigger than this are refused by the asyncio client
+_ASYNC_MAX_HEAD_SIZE = 64 * 1024
+# What servers are offered when a compressed transfer is asked for
+_ACCEPT_ENCODING = "gzip, deflate" + (", br" if _BrotliDecompressor else "")
+# How often a DownloadCache saves its index when there have only been hits
+_CACHE_INDEX_SAVE_INTERVAL_SEC = 30
+# Statuses that say trying again later may well work
+_RETRY_STATUSES = frozenset((408, 425, 429, 500, 502, 503, 504))
+# Error bodies up to this big are read out when discarded so the connection lives on
+_MAX_DRAINED_ERROR_SIZE = 64 * 1024
+
+_T = TypeVar("_T")
+
+
+class DownloadResult(NamedTuple):
+    """Outcome of downloading one URL as part of a batch. Exactly one of fpath and error
+    is set."""
+
+    url: str
+    fpath: Optional[Path]
+    error: Optional[Exception]
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+class DigestMismatchError(ValueError):
+    """Raised when a download doesn't hash to what it was expected to."""
+
+    def __init__(self, url: str, algorithm: str, expected: str, actual: str) -> None:
+        super().__init__(f"The {algorithm} of {url} is {actual}, not {expected}.")
+        self.url = url
+        self.algorithm = algorithm
+        self.expected = expected
+        self.actual = actual
+
+
+class DownloadProgress(NamedTuple):
+    """How far along a download is, as reported to DownloadObserver.on_progress."""
+
+    url: str
+    bytes_done: int
+    # From the Content-Length of the first response, when there was one
+    bytes_expected: Optional[int]
+    elapsed_sec: float
+    # Since the previous progress report (or the start of the body for the first one)
+    bytes_per_sec: float
+    average_bytes_per_sec: float
+
+
+class DownloadTimings(NamedTuple):
+    """Where the time of a finished download went, as reported to
+    DownloadObserver.on_finished.
+
+    DNS, connect and TLS are those of the connection the first request went over. They
+    are None when that connection was reused from an HTTPConnectionPool (in which case
+    there was none to set up), and TLS is None for plain HTTP."""
+
+    url: str
+    dns_sec: Optional[float]
+    connect_sec: Optional[float]
+    tls_sec: Optional[float]
+    # From the start of the download until the first response's headers arrived
+    ttfb_sec: float
+    # From then on until the download was done
+    transfer_sec: float
+    total_sec: float
+    # Off the network, so compressed bytes count as such and cache hits count nothing
+    bytes_transferred: int
+
+    @property
+    def average_bytes_per_sec(self) -> float:
+        return self.bytes_transferred / self.transfer_sec if self.transfer_sec else 0.0
+
+
+class DownloadObserver:
+    """Subclass this and override what's of interest to watch downloads, then pass an
+    instance to download_file_from_ or download_files_from_. The same instance can watch
+    many downloads at once.
+
+    Methods are called on the thread doing the download, in the middle of it, so they
+    should return quickly. async_download_file_from_ can't be observed."""
+
+    def __init__(self, progress_interval_sec: float = 0.5) -> None:
+        """Arguments:
+        progress_interval_sec -- the least time between two on_progress calls for the
+            same download, which keeps reporting from slowing the download down
+        """
+        self.progress_interval_sec = progress_interval_sec
+
+    def on_progress(self, progress: DownloadProgress) -> None:
+        pass
+
+    def on_finished(self, timings: DownloadTimings) -> None:
+        pass
+
+    def on_failed(self, url: str, error: Exception, elapsed_sec: float) -> None:
+        pass
+
+
+class DownloadStats(DownloadObserver):
+    """Observer that adds up every download it watches, for exporting to metrics."""
+
+    def __init__(self) -> None:
+        super().__init__(progress_interval_sec=float("inf"))
+        self._lock = Lock()
+        self._totals: Dict[str, float] = dict.fromkeys(
+            (
+                "downloads_succeeded",
+                "downloads_failed",
+                "bytes_transferred",
+                "dns_sec",
+                "connect_sec",
+                "tls_sec",
+                "ttfb_sec",
+                "transfer_sec",
+                "total_sec",
+                "connections_opened",
+            ),
+            0,
+        )
+        self._max_total_sec = 0.0
+
+    def on_finished(self, timings: DownloadTimings) -> None:
+        with self._lock:
+            totals = self._totals
+            totals["downloads_succeeded"] += 1
+            totals["bytes_transferred"] += timings.bytes_transferred
+            totals["ttfb_sec"] += timings.ttfb_sec
+            totals["transfer_sec"] += timings.transfer_sec
+            totals["total_sec"] += timings.total_sec
+            if timings.connect_sec is not None:
+                totals["connections_opened"] += 1
+                totals["connect_sec"] += timings.connect_sec
+                totals["dns_sec"] += timings.dns_sec or 0
+                totals["tls_sec"] += timings.tls_sec or 0
+            self._max_total_sec = max(self._max_total_sec, timings.total_sec)
+
+    def on_failed(self, url: str, error: Exception, elapsed_sec: float) -> None:
+        with self._lock:
+            self._totals["downloads_failed"] += 1
+            self._totals["total_sec"] += elapsed_sec
+
+    def snapshot(self) -> Dict[str, float]:
+        """The totals so far as a flat dict of metric names to numbers, plus averages
+        of them. Times are in seconds and averages are per successful download (DNS,
+        connect and TLS are per connection opened instead)."""
+        with self._lock:
+            totals = dict(self._totals)
+            max_total_sec = self._max_total_sec
+        succeeded = totals["downloads_succeeded"] or 1
+        opened = totals["connections_opened"] or 1
+        return {
+            **totals,
+            "max_total_sec": max_total_sec,
+            "mean_dns_sec": totals["dns_sec"] / opened,
+            "mean_connect_sec": totals["connect_sec"] / opened,
+            "mean_tls_sec": totals["tls_sec"] / opened,
+            "mean_ttfb_sec": totals["ttfb_sec"] / succeeded,
+            "mean_transfer_sec": totals["transfer_sec"] / succeeded,
+            "average_bytes_per_sec": (
+                totals["bytes_transferred"] / totals["transfer_sec"]
+                if totals["transfer_sec"]
+                else 0.0
+            ),
+        }
+
+
+class _DownloadTrace:
+    """Collects the timings of the download in progress on behalf of its observer.
+    Parts of a split download report into the same trace from their own threads."""
+
+    def __init__(self, url: str, observer: DownloadObserver) -> None:
+        self.url = url
+        self.observer = observer
+        self.started_at = monotonic()
+        self._lock = Lock()
+        self._dns_sec: Optional[float] = None
+        self._connect_sec: Optional[float] = None
+        self._tls_sec: Optional[float] = None
+        self._responded_at: Optional[float] = None
+        self._bytes_expected: Optional[int] = None
+        self._bytes_done = 0
+        self._reported_at = self.started_at
+        self._reported_bytes = 0
+
+    def connected(self, dns_sec: float, connect_sec: float) -> None:
+        if self._responded_at is None:
+            self._dns_sec, self._connect_sec = dns_sec, connect_sec
+
+    def secured(self, connection_setup_sec: float) -> None:
+        """For TLS connections, once the handshake is done too."""
+        if self._responded_at is None and self._connect_sec is not None:
+            self._tls_sec = max(
+                0.0, connection_setup_sec - self._connect_sec - (self._dns_sec or 0)
+            )
+
+    def responded(self, content_length: Optional[str]) -> None:
+        with self._lock:
+            if self._responded_at is None:
+                self._responded_at = self._reported_at = monotonic()
+                if content_length is not None and content_length.isdigit():
+                    self._bytes_expected = int(content_length)
+
+    def expecting(self, size: int) -> None:
+        """For when the first response was only part of the file."""
+        with self._lock:
+            self._bytes_expected = size
+
+    def transferred(self, n: int) -> None:
+        now = monotonic()
+        with self._lock:
+            self._bytes_done += n
+            since_reported = now - self._reported_at
+            if since_reported < self.observer.progress_interval_sec:
+                return
+            progress = DownloadProgress(
+                url=self.url,
+                bytes_done=self._bytes_done,
+                bytes_expected=self._bytes_expected,
+                elapsed_sec=now - self.started_at,
+                bytes_per_sec=(self._bytes_done - self._reported_bytes)
+                / since_reported,
+                average_bytes_per_sec=self._bytes_done
+                / (now - (self._responded_at or self.started_at)),
+            )
+            self._reported_at, self._reported_bytes = now, self._bytes_done
+        self.observer.on_progress(progress)
+
+    def timings(self) -> DownloadTimings:
+        now = monotonic()
+        responded_at = self._responded_at or now
+        return DownloadTimings(
+            url=self.url,
+            dns_sec=self._dns_sec,
+            connect_sec=self._connect_sec,
+            tls_sec=self._tls_sec,
+            ttfb_sec=responded_at - self.started_at,
+            transfer_sec=now - responded_at,
+            total_sec=now - self.started_at,
+            bytes_transferred=self._bytes_done,
+        )
+
+
+# The trace of the download being done in the current context, if it's observed
+_active_trace: ContextVar[Optional[_DownloadTrace]] = ContextVar(
+    "_active_trace", default=None
+)
+
+
+@contextmanager
+def _observed_(url: str, observer: Optional[DownloadObserver]) -> Iterator[None]:
+    if observer is None:
+        yield
+        return
+    trace = _DownloadTrace(url, observer)
+    token = _active_trace.set(trace)
+    try:
+        yield
+    except Exception as e:
+        observer.on_failed(url, e, monotonic() - trace.started_at)
+        raise
+    finally:
+        _active_trace.reset(token)
+    observer.on_finished(trace.timings())
+
+
+def _create_connection_timed_(
+    address: Tuple[str, int],
+    timeout: Optional[float],
+    source_address: Optional[Tuple[str, int]] = None,
+) -> socket:
+    """socket.create_connection, but resolving and connecting are timed separately for
+    the active trace."""
+    host, port = address
+    started_at = monotonic()
+    addresses = getaddrinfo(host, port, 0, SOCK_STREAM)
+    resolved_at = monotonic()
+    error: Optional[OSError] = None
+    for family, kind, proto, _, sockaddr in addresses:
+        sock = socket(family, kind, proto)
+        try:
+            # What urllib passes when no timeout is given, as socket does it
+            if timeout is not _GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+        except OSError as e:
+            sock.close()
+            error = e
+            continue
+        trace = _active_trace.get()
+        if trace is not None:
+            trace.connected(resolved_at - started_at, monotonic() - resolved_at)
+        return sock
+    raise error or OSError(f"Couldn't resolve {host}")
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_connection_timed_
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_connection_timed_
+
+    def connect(self) -> None:
+        started_at = monotonic()
+        super().connect()
+        trace = _active_trace.get()
+        if trace is not None:
+            trace.secured(monotonic() - started_at)
+
+
+class _TimedHTTPHandler(request.HTTPHandler):
+    def http_open(self, req: request.Request) -> HTTPResponse:
+        return self.do_open(_TimedHTTPConnection, req)
+
+
+class _TimedHTTPSHandler(request.HTTPSHandler):
+    def https_open(self, req: request.Request) -> HTTPResponse:
+        return self.do_open(_TimedHTTPSConnection, req, context=self._context)
+
+
+# What observed downloads open URLs with when there's no pool, so that connection setup
+# gets timed. build_opener swaps these in for the default handlers.
+_timed_opener = request.build_opener(_TimedHTTPHandler, _TimedHTTPSHandler)
+
+
+class _PooledHTTPResponse(HTTPResponse):
+    """HTTPResponse that hands its connection back to the pool it came from once it's
+    closed."""
+
+    _release: Optional[Callable[[bool], None]] = None
+
+    def close(self) -> None:
+        # The connection can only carry another request if this response's body was
+        # read to the end (which is when http.client drops fp) and the server didn't
+        # ask for the connection to be closed
+        reusable = self.fp is None and not self.will_close
+        try:
+            super().close()
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                release(reusable)
+
+
+class _IdleConnection(NamedTuple):
+    connection: HTTPConnection
+    idle_since: float
+
+
+_PoolKey = Tuple[str, str, Optional[int]]
+
+
+class HTTPConnectionPool:
+    """Keeps http.client connections alive per host so that consecutive downloads from
+    the same server skip TCP (and for HTTPS, TLS) setup.
+
+    Pass an instance to download_file_from_ or download_files_from_ and close it when
+    done (or use with-as syntax). It's safe to share one pool between threads.
+
+    Responses from this pool give their connection back to the pool once they're
+    closed. A connection is only kept if its response was read to the end and the
+    server didn't ask to close it. Idle connections are evicted once they've been idle
+    for longer than the idle timeout or when the pool is over its size limits."""
+
+    @property
+    def connections_created(self) -> int:
+        return self._connections_created
+
+    @property
+    def connections_reused(self) -> int:
+        return self._connections_reused
+
+    @property
+    def idle_count(self) -> int:
+        with self._lock:
+            return sum(len(idles) for idles in self._idle.values())
+
+    def __init__(
+        self,
+        max_idle_per_host: int = 4,
+        max_idle: int = 32,
+        idle_timeout_sec: float = 30,
+        timeout_sec: Optional[float] = None,
+        ssl_context: Optional[SSLContext] = None,
+    ) -> None:
+        """Arguments:
+        max_idle_per_host -- the most idle connections kept for any single host
+        max_idle -- the most idle connections kept across all hosts
+        idle_timeout_sec -- idle connections older than this are closed rather than
+            reused (servers drop idle connections eventually anyway)
+        timeout_sec -- socket timeout for connections the pool opens (default is no
+            timeout)
+        ssl_context -- context for HTTPS connections (default is http.client's)
+        """
+        if max_idle_per_host < 0 or max_idle < 0:
+            raise ValueError("Pool size limits cannot be negative.")
+        self._max_idle_per_host = max_idle_per_host
+        self._max_idle = max_idle
+        self._idle_timeout_sec = idle_timeout_sec
+        self._timeout_sec = timeout_sec
+        self._ssl_context = ssl_context
+        self._idle: Dict[_PoolKey, Deque[_IdleConnection]] = {}
+        self._lock = Lock()
+        self._connections_created = 0
+        self._connections_reused = 0
+
+    def __enter__(self) -> "HTTPConnectionPool":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Closes every idle connection. Connections still in use are closed instead of
+        being given back once their responses are closed."""
+        with self._lock:
+            idles = [idle for queue in self._idle.values() for idle in queue]
+            self._idle.clear()
+            self._max_idle = 0
+        for idle in idles:
+            idle.connection.close()
+
+    def urlopen(
+        self,
+        url: str,
+        headers: Optional[Mapping[str, str]] = None,
+        method: str = "GET",
+        max_redirects: int = 5,
+    ) -> HTTPResponse:
+        """Requests a URL over a pooled connection, following redirects. Like
+        urllib.request.urlopen, error statuses raise urllib.error.HTTPError."""
+        for _ in range(max_redirects + 1):
+            response = self._request(method, url, headers=headers or {})
+            if response.status in _REDIRECT_STATUSES and response.getheader("Location"):
+                with response:
+                    response.read()  # Drain so the connection can be reused
+                url = urljoin(url, response.getheader("Location"))
+                continue
+            if response.status >= 400:
+                raise HTTPError(
+                    url, response.status, response.reason, response.msg, response
+                )
+            response.url = url  # Same as what urllib leaves on its responses
+            return response
+        raise HTTPError(url, response.status, "Too many redirects", response.msg, None)
+
+    def _request(
+        self, method: str, url: str, headers: Mapping[str, str]
+    ) -> HTTPResponse:
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Connection pools only support HTTP(S) URLs: {url}")
+        key: _PoolKey = (parts.scheme, parts.hostname, parts.port)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        all_headers = {"User-Agent": f"Python-urllib/{request.__version__}"}
+        all_headers.update(headers)
+        timeout_sec = Deadline.timeout_sec_for_(self._timeout_sec)
+        while True:
+            connection, reused = self._checkout(key)
+            # Reused connections may have been opened under a different deadline
+            connection.timeout = timeout_sec
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout_sec)
+            try:
+                connection.request(method, target, headers=all_headers)
+                response = connection.getresponse()
+            except (RemoteDisconnected, ConnectionError):
+                connection.close()
+                if reused:
+                    continue  # The server dropped it while idle; try a fresh one
+                raise
+            except (HTTPException, OSError):
+                connection.close()
+                raise
+            assert isinstance(response, _PooledHTTPResponse)
+            response._release = partial(self._checkin, key, connection)
+            return response
+
+    def _checkout(self, key: _PoolKey) -> Tuple[HTTPConnection, bool]:
+        stale = []
+        connection = None
+        with self._lock:
+            idles = self._idle.get(key)
+            now = monotonic()
+            while idles:
+                # Most recently used first since it's the least likely to be dropped
+                idle = idles.pop()
+                if now - idle.idle_since <= self._idle_timeout_sec:
+                    connection = idle.connection
+                    self._connections_reused += 1
+                    break
+                stale.append(idle.connection)
+            else:
+                self._connections_created += 1
+        for stale_connection in stale:
+            stale_connection.close()
+        if connection is not None:
+            return connection, True
+        return self._new_connection_for_(key), False
+
+    def _new_connection_for_(self, key: _PoolKey) -> HTTPConnection:
+        scheme, host, port = key
+        connection: HTTPConnection
+        if scheme == "https":
+            connection = _TimedHTTPSConnection(
+                host, port, timeout=self._timeout_sec, context=self._ssl_context
+            )
+        else:
+            connection = _TimedHTTPConnection(host, port, timeout=self._timeout_sec)
+        connection.response_class = _PooledHTTPResponse
+        return connection
+
+    def _checkin(self, key: _PoolKey, connection: HTTPConnection, reusable: bool):
+        if not reusable:
+            connection.close()
+            return
+        evicted = []
+        with self._lock:
+            idles = self._idle.setdefault(key, deque())
+            idles.append(_IdleConnection(connection, monotonic()))
+            while len(idles) > self._max_idle_per_host:
+                evicted.append(idles.popleft().connection)
+            while sum(len(queue) for queue in self._idle.values()) > self._max_idle:
+                # Evict the connection that's been idle the longest across all hosts
+                oldest = min(
+                    (queue for queue in self._idle.values() if queue),
+                    key=lambda queue: queue[0].idle_since,
+                )
+                evicted.append(oldest.popleft().connection)
+        for evicted_connection in evicted:
+            evicted_connection.close()
+
+
+class _CacheEntry(NamedTuple):
+    digest: str
+    size: int
+    etag: Optional[str]
+    last_modified: Optional[str]
+    filename: Optional[str]
+    last_used: float
+
+
+class DownloadCache:
+    """Remembers downloads on disk so that downloading the same URL again only costs a
+    conditional request. Pass an instance to download_file_from_.
+
+    Bodies are stored once per distinct content (named by their SHA-256) in the cache
+    directory, along with an index of which URL has which content and the ETag and
+    Last-Modified it came with. Downloading a URL that's in the index sends
+    If-None-Match/If-Modified-Since, and if the server says it hasn't changed, the file
+    is made from the cached copy without transferring anything.
+
+    Files are made from cached copies as cheaply as the file system allows: a
+    copy-on-write clone (reflink) where supported, otherwise a hard link, otherwise a
+    copy. Cached copies are read-only, so a hard-linked download is too; replace it
+    rather than editing it in place.
+
+    Once the cache is over its size limit, the least recently used entries are evicted.
+    An instance is safe to share between threads but not between processes. Close it
+    (or use it with with-as syntax) when done, since when entries were last used is
+    only saved every so often."""
+
+    @property
+    def hits(self) -> int:
+        """Downloads that were served from the cache."""
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        """Downloads that had to transfer the file."""
+        return self._misses
+
+    @property
+    def evictions(self) -> int:
+        return self._evictions
+
+    @property
+    def size_bytes(self) -> int:
+        return self._size_bytes
+
+    def __init__(
+        self, dirpath: Path, max_size_bytes: int, allow_hardlinks: bool = True
+    ) -> None:
+        """Arguments:
+        dirpath -- where to keep the cache (created if needed, and reused if it was
+            already made by a previous instance)
+        max_size_bytes -- the most the cached content may add up to
+        allow_hardlinks -- whether downloads may be hard links to cached copies when
+            the file system can't clone; otherwise they're copies
+        """
+        if max_size_bytes < 0:
+            raise ValueError("Cache size limit cannot be negative.")
+        self._dirpath_objects = dirpath.joinpath("objects")
+        self._dirpath_tmp = dirpath.joinpath("tmp")
+        self._fpath_index = dirpath.joinpath("index.json")
+        self._max_size_bytes = max_size_bytes
+        self._allow_hardlinks = allow_hardlinks
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._dirpath_objects.mkdir(parents=True, exist_ok=True)
+        rmtree(str(self._dirpath_tmp), ignore_errors=True)  # Leftovers from crashes
+        self._dirpath_tmp.mkdir()
+        self._index: Dict[str, _CacheEntry] = {}
+        # How many URLs have each content, and what the distinct contents add up to
+        self._refcounts: Dict[str, int] = {}
+        self._size_bytes = 0
+        # Content being served outside the lock, by how many at once, which can't be
+        # evicted meanwhile. What's dropped from the cache meanwhile is deleted after.
+        self._pins: Dict[str, int] = {}
+        self._deleted_once_unpinned: Set[str] = set()
+        try:
+            for url, fields in loads(self._fpath_index.read_text()).items():
+                self._index[url] = _CacheEntry(**fields)
+        except (OSError, JSONDecodeError, TypeError):
+            pass  # Missing or mangled indexes just mean starting with nothing cached
+        for entry in self._index.values():
+            self._reference_unlocked(entry)
+        for fpath_object in self._dirpath_objects.iterdir():
+            if fpath_object.name not in self._refcounts:
+                fpath_object.unlink()  # Stored by a process that crashed before saving
+        self._saved_at = monotonic()
+        self._unsaved = False
+
+    def __enter__(self) -> "DownloadCache":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Saves when cached content was last used, which hits only save every so
+        often rather than every time."""
+        with self._lock:
+            if self._unsaved:
+                self._save_index()
+
+    def clear(self) -> None:
+        with self._lock:
+            for digest in self._refcounts:
+                self._delete_object_unlocked(digest)
+            self._index.clear()
+            self._refcounts.clear()
+            self._size_bytes = 0
+            self._save_index()
+
+    def _entry_for_(self, url: str) -> Optional[_CacheEntry]:
+        with self._lock:
+            entry = self._index.get(url)
+            if entry is not None and not self._fpath_object_for_(entry.digest).exists():
+                self._pop_unlocked(url)  # Someone deleted it behind our back
+                self._unsaved = True
+                return None
+            return entry
+
+    def _new_fpath_tmp(self) -> Path:
+        return self._dirpath_tmp.joinpath(str(uuid4()))
+
+    def _fpath_object_for_(self, digest: str) -> Path:
+        return self._dirpath_objects.joinpath(digest)
+
+    def _serve(self, url: str, entry: _CacheEntry, fpath_dest: Path) -> None:
+        with self._lock:  # So it can't be evicted out from under this
+            self._pins[entry.digest] = self._pins.get(entry.digest, 0) + 1
+        try:
+            # Outside of the lock, since without reflinks or hard links it's a copy
+            _clone_or_link_or_copy_(
+                self._fpath_object_for_(entry.digest),
+                fpath_dest,
+                self._allow_hardlinks,
+            )
+        except BaseException:
+            with self._lock:
+                self._unpin_unlocked(entry.digest)
+            raise
+        with self._lock:
+            self._unpin_unlocked(entry.digest)
+            self._hits += 1
+            if self._index.get(url) == entry:
+                self._index[url] = entry._replace(last_used=time())
+                self._unsaved = True
+                # Losing the last few of these to a crash only makes eviction a bit
+                # less accurate, so they aren't worth rewriting the index for each
+                if monotonic() - self._saved_at >= _CACHE_INDEX_SAVE_INTERVAL_SEC:
+                    self._save_index()
+
+    def _store(self, url: str, fpath_tmp: Path, entry: _CacheEntry, fpath_dest: Path):
+        """Moves a finished download into the cache and then makes fpath_dest from it."""
+        fpath_object = self._fpath_object_for_(entry.digest)
+        with self._lock:
+            if fpath_object.exists():
+                fpath_tmp.unlink()  # Same content is already cached (e.g. for a mirror)
+            else:
+                fpath_tmp.chmod(0o444)
+                fpath_tmp.replace(fpath_object)
+            self._misses += 1
+            self._put_unlocked(url, entry)
+            # Served before evicting in case this entry is itself what gets evicted
+            _clone_or_link_or_copy_(fpath_object, fpath_dest, self._allow_hardlinks)
+            self._evict_unlocked()
+            self._save_index()
+
+    def _put_unlocked(self, url: str, entry: _CacheEntry) -> None:
+        replaced = self._index.get(url)
+        self._index[url] = entry
+        self._reference_unlocked(entry)  # Before, in case it's the same content
+        if replaced is not None:
+            self._dereference_unlocked(replaced)
+
+    def _pop_unlocked(self, url: str) -> None:
+        self._dereference_unlocked(self._index.pop(url))
+
+    def _reference_unlocked(self, entry: _CacheEntry) -> None:
+        refcount = self._refcounts.get(entry.digest, 0)
+        if not refcount:
+            self._size_bytes += entry.size
+        self._refcounts[entry.digest] = refcount + 1
+
+    def _dereference_unlocked(self, entry: _CacheEntry) -> None:
+        refcount = self._refcounts.pop(entry.digest) - 1
+        if refcount:
+            self._refcounts[entry.digest] = refcount
+            return
+        self._size_bytes -= entry.size
+        self._delete_object_unlocked(entry.digest)  # Nothing points to it anymore
+
+    def _delete_object_unlocked(self, digest: str) -> None:
+        if digest in self._pins:
+            self._deleted_once_unpinned.add(digest)
+        else:
+            self._fpath_object_for_(digest).unlink(missing_ok=True)
+
+    def _unpin_unlocked(self, digest: str) -> None:
+        pins = self._pins.pop(digest) - 1
+        if pins:
+            self._pins[digest] = pins
+        elif digest in self._deleted_once_unpinned:
+            self._deleted_once_unpinned.discard(digest)
+            if digest not in self._refcounts:  # Unless it's been stored again since
+                self._fpath_object_for_(digest).unlink(missing_ok=True)
+
+    def _evict_unlocked(self) -> None:
+        if self._size_bytes <= self._max_size_bytes:
+            return
+        for url, entry in sorted(self._index.items(), key=lambda i: i[1].last_used):
+            if self._size_bytes <= self._max_size_bytes:
+                break
+            if entry.digest in self._pins:
+                continue  # Being served right now
+            self._pop_unlocked(url)
+            self._evictions += 1
+
+    def _save_index(self) -> None:
+        # Written to the side first so a crash mid-write can't leave it mangled
+        fpath_tmp = self._new_fpath_tmp()
+        fpath_tmp.write_text(
+            dumps({url: entry._asdict() for url, entry in self._index.items()})
+        )
+        replace(fpath_tmp, self._fpath_index)
+        self._saved_at = monotonic()
+        self._unsaved = False
+
+
+class RetryPolicy:
+    """How download_file_from_ tries again after failures that may well not happen
+    again: dropped and refused connections, timeouts, bodies cut short, and statuses
+    like 503 that say to come back later. Anything else (like a 404, a file that
+    already exists or a digest mismatch) is raised right away.
+
+    Waits between attempts back off exponentially with "full jitter", i.e. a random
+    amount between none and base_delay_sec * 2 ** (attempt - 1), capped at
+    max_delay_sec. That keeps many clients that failed at once from coming back at
+    once. When the server says how long to wait with Retry-After, that's waited
+    instead, unless it's longer than max_retry_after_sec, in which case the failure's
+    raised. Under a deadline (see time_related.deadline_after_), the failure's also
+    raised when the wait wouldn't end before the deadline does.
+
+    An instance holds no state of its own, so one can be shared by any number of
+    downloads."""
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay_sec: float = 0.25,
+        max_delay_sec: float = 30,
+        retry_statuses: Iterable[int] = _RETRY_STATUSES,
+        max_retry_after_sec: float = 120,
+    ) -> None:
+        """Arguments:
+        max_attempts -- how many times a download is tried in all (the first time
+            included)
+        base_delay_sec -- the most waited before the first retry, which doubles for
+            every retry after it
+        max_delay_sec -- the most waited before any retry, Retry-After aside
+        retry_statuses -- the HTTP statuses worth trying again after
+        max_retry_after_sec -- the longest Retry-After that's honored
+        """
+        if max_attempts <= 0:
+            raise ValueError("There has to be at least one attempt.")
+        if base_delay_sec < 0 or max_delay_sec < 0 or max_retry_after_sec < 0:
+            raise ValueError("Delays cannot be negative.")
+        self.max_attempts = max_attempts
+        self.base_delay_sec = base_delay_sec
+        self.max_delay_sec = max_delay_sec
+        self.retry_statuses = frozenset(retry_statuses)
+        self.max_retry_after_sec = max_retry_after_sec
+
+    def is_retryable(self, error: BaseException) -> bool:
+        if isinstance(error, HTTPError):
+            return error.code in self.retry_statuses
+        if isinstance(error, URLError):
+            # urllib wraps what went wrong connecting (refused, unreachable, timed
+            # out, ...) while failures to resolve a name come as socket.gaierror,
+            # which is an OSError too but won't resolve any better a moment later
+            return isinstance(error.reason, (ConnectionError, SocketTimeout))
+        if isinstance(error, DeadlineExceeded):
+            return False  # There's no time left to retry in
+        return isinstance(error, (ConnectionError, SocketTimeout, IncompleteRead))
+
+    def delay_sec_for_(self, attempt: int, error: BaseException) -> Optional[float]:
+        """Returns how long to wait before the given retry (1 for the first), or None
+        if the server asked for longer than max_retry_after_sec."""
+        retry_after_sec = _retry_after_sec_of_(error)
+        if retry_after_sec is not None:
+            if retry_after_sec > self.max_retry_after_sec:
+                return None
+            return retry_after_sec
+        return uniform(
+            0, min(self.max_delay_sec, self.base_delay_sec * 2 ** (attempt - 1))
+        )
+
+    def _run(self, attempt: Callable[[int], _T]) -> _T:
+        """Calls attempt with the number of retries so far until it returns, or until
+        it raises something that's not worth retrying."""
+        retries = 0
+        while True:
+            try:
+                return attempt(retries)
+            except Exception as e:
+                retries += 1
+                if retries >= self.max_attempts or not self.is_retryable(e):
+                    raise
+                delay_sec = self.delay_sec_for_(retries, e)
+                deadline = Deadline.current()
+                if delay_sec is None or (
+                    deadline is not None and delay_sec >= deadline.remaining_sec()
+                ):
+                    raise
+                if isinstance(e, HTTPError):
+                    _discard_error_(e)
+                sleep(delay_sec)
+
+
+def _discard_error_(error: HTTPError) -> None:
+    """Closes the response an HTTPError holds on to. For a pool's, that's what gives
+    the connection back, and a short body is read out first so it can be reused."""
+    with error:
+        error.read(_MAX_DRAINED_ERROR_SIZE)
+
+
+def _retry_after_sec_of_(error: BaseException) -> Optional[float]:
+    headers = getattr(error, "headers", None)
+    retry_after = None if headers is None else headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return float(retry_after)
+    try:  # It may also be an HTTP date
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time())
+    except (TypeError, ValueError):
+        return None  # Unusable, so it's as good as not given
+
+
+class HedgePolicy:
+    """How download_file_from_ hedges: when the server hasn't started answering
+    within a delay, the same request is sent again (to the next mirror, if there are
+    any), and whichever answers first is downloaded from. The other is closed as soon
+    as it answers, if it ever does.
+
+    The delay is the given percentile of how long recent downloads took to start
+    answering, so only the slowest few percent of requests get hedged, and that costs
+    only a few percent more requests. Until there have been min_samples downloads to
+    go by, initial_delay_sec is used. One instance should be shared by the downloads
+    it's meant to learn from; it's safe to share between threads.
+
+    A request that's been hedged keeps its thread until it's answered or times out,
+    so this is best paired with a timeout (a pool's, or a deadline)."""
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        initial_delay_sec: float = 1,
+        min_delay_sec: float = 0.01,
+        max_hedges: int = 1,
+        window: int = 1000,
+        min_samples: int = 20,
+    ) -> None:
+        """Arguments:
+        percentile -- which percentile of recent times to first byte to hedge after
+        initial_delay_sec -- the delay until there's enough to go by
+        min_delay_sec -- the shortest delay, so that very fast servers don't get every
+            request hedged over jitter
+        max_hedges -- the most extra requests sent for one download
+        window -- how many of the latest times to first byte are gone by
+        min_samples -- how many times to first byte there have to be before they're
+            gone by
+        """
+        if not 0 < percentile <= 100:
+            raise ValueError("The percentile has to be within (0, 100].")
+        if max_hedges < 0 or window <= 0 or min_samples <= 0:
+            raise ValueError("Hedge and sample counts must be positive.")
+        self.percentile = percentile
+        self.initial_delay_sec = initial_delay_sec
+        self.min_delay_sec = min_delay_sec
+        self.max_hedges = max_hedges
+        self._min_samples = min_samples
+        self._ttfbs_sec: Deque[float] = deque(maxlen=window)
+        self._lock = Lock()
+        self._hedged = 0
+
+    @property
+    def hedged(self) -> int:
+        """How many extra requests have been sent so far."""
+        return self._hedged
+
+    def delay_sec(self) -> float:
+        with self._lock:
+            if len(self._ttfbs_sec) < self._min_samples:
+                return max(self.min_delay_sec, self.initial_delay_sec)
+            ttfbs_sec = sorted(self._ttfbs_sec)
+        index = min(len(ttfbs_sec) - 1, int(len(ttfbs_sec) * self.percentile / 100))
+        return max(self.min_delay_sec, ttfbs_sec[index])
+
+    def _record(self, ttfb_sec: float) -> None:
+        with self._lock:
+            self._ttfbs_sec.append(ttfb_sec)
+
+    def _open(
+        self,
+        urls: Sequence[str],
+        pool: Optional["HTTPConnectionPool"],
+        headers: Optional[Mapping[str, str]],
+    ) -> HTTPResponse:
+        """Opens the first URL, hedging to the next ones in turn (wrapping around).
+        What's recorded is how long the download waited for an answer, which is from
+        when the first request was sent, not when the one that answered was."""
+        attempts: List[Future] = []
+        errors: List[BaseException] = []
+        started_at = monotonic()
+
+        def send() -> None:
+            url = urls[len(attempts) % len(urls)]
+            attempts.append(_in_thread_(_open_timed_, url, pool, headers))
+
+        send()
+        pending = list(attempts)
+        winner = None
+        try:
+            while winner is None:
+                can_hedge = len(attempts) <= self.max_hedges
+                done, _ = wait(
+                    pending,
+                    timeout=Deadline.timeout_sec_for_(
+                        self.delay_sec() if can_hedge else None
+                    ),
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    pending.remove(future)
+                    if future.exception() is None:
+                        winner = future
+                        break
+                    errors.append(future.exception())
+                if winner is not None:
+                    break
+                if not done:
+                    Deadline.timeout_sec_for_()  # Raises if that's why nothing's done
+                    if can_hedge:
+                        with self._lock:
+                            self._hedged += 1
+                        send()
+                        pending.append(attempts[-1])
+                elif not pending:
+                    raise errors[0]  # Every attempt failed, so it's up to retrying
+        finally:
+            for future in attempts:
+                if future is not winner:
+                    future.add_done_callback(_close_opened_)
+        response, answered_at = winner.result()
+        self._record(answered_at - started_at)
+        return response
+
+
+def _in_thread_(fn: Callable[..., _T], *args: Any) -> "Future[_T]":
+    """Runs fn on a thread of its own in a copy of the current context. Unlike an
+    executor's, the thread doesn't hold up the interpreter from exiting."""
+    future: "Future[_T]" = Future()
+    context = copy_context()
+
+    def run() -> None:
+        try:
+            future.set_result(context.run(fn, *args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    Thread(target=run, daemon=True).start()
+    return future
+
+
+def _open_timed_(
+    url: str, pool: Optional["HTTPConnectionPool"], headers: Optional[Mapping[str, str]]
+) -> Tuple[HTTPResponse, float]:
+    """Also gives the monotonic time the response came at."""
+    response = _open_(url, pool=pool, headers=headers)
+    return response, monotonic()
+
+
+def _close_opened_(future: Future) -> None:
+    if future.exception() is None:
+        future.result()[0].close()
+
+
+def _clone_or_link_or_copy_(fpath_src: Path, fpath_dest: Path, allow_link: bool):
+    """Gives fpath_dest (which must not exist yet) the contents of fpath_src as cheaply
+    as the file system allows."""
+    with open(fpath_src, "rb") as fin, open(fpath_dest, "xb") as fout:
+        if try_cloning_(fin, fout):
+            return
+        if not allow_link:
+            copyfileobj(fin, fout, DEFAULT_CHUNK_SIZE)
+            return
+    # Opening it claimed the name, so it has to be removed for the link to take it
+    fpath_dest.unlink()
+    try:
+        link(fpath_src, fpath_dest)
+    except FileExistsError:
+        raise
+    except OSError:
+        copyfile(fpath_src, fpath_dest)  # For file systems without hard links
+        fpath_dest.chmod(0o644)
 
 
 def _try_retrieving_filename_for_(
-    file_download_response: HTTPResponse,
+    file_download_response: Union[HTTPResponse, "_AsyncResponse"],
 ) -> Optional[str]:
     """Response header information is implemented via email.message.Message according to
     https://docs.python.org/3/library/http.client.html#httpmessage-objects.
@@ -19,19 +1159,1304 @@ def _try_retrieving_filename_for_(
     return file_download_response.info().get_filename()
 
 
-def download_file_from_(url: str, dest_dir: PathLike[str]) -> Path:
+def _dest_dirpath_from_(dest_dir: PathLike[str]) -> Path:
     dpath_dest = Path(dest_dir)
     if not dpath_dest.exists():
         raise FileNotFoundError(dpath_dest)
     if dpath_dest.is_file():
         raise NotADirectoryError(dpath_dest)
+    return dpath_dest
+
+
+def _open_(
+    url: str,
+    pool: Optional[HTTPConnectionPool],
+    headers: Optional[Mapping[str, str]] = None,
+) -> HTTPResponse:
+    response: HTTPResponse
     # Technique taken from https://docs.python.org/3/howto/urllib2.html#fetching-urls
-    with request.urlopen(url) as response:
-        filename = (  # When the server doesn't give a file name, just give it one
-            _try_retrieving_filename_for_(file_download_response=response)
-            or f"{uuid4()}.download"
-        )
-        fpath_dest = dpath_dest.joinpath(filename)
-        with open(fpath_dest, "x") as fin:  # Use "x" to raise exception if file exists
-            copyfileobj(response, fin)
+    if pool is not None:
+        response = pool.urlopen(url, headers=headers)
+    else:
+        # Only given when there's a deadline, so that socket's default applies if not
+        timeout_sec = Deadline.timeout_sec_for_()
+        kwargs = {} if timeout_sec is None else {"timeout": timeout_sec}
+        urlopen = request.urlopen if _active_trace.get() is None else _timed_opener.open
+        if not headers:
+            response = urlopen(url, **kwargs)
+        else:
+            response = urlopen(request.Request(url, headers=dict(headers)), **kwargs)
+    trace = _active_trace.get()
+    if trace is not None:
+        trace.responded(response.headers.get("Content-Length"))
+    return response
+
+
+def _dest_filepath_for_(
+    response: Union[HTTPResponse, "_AsyncResponse"], dpath_dest: Path
+) -> Path:
+    filename = (  # When the server doesn't give a file name, just give it one
+        _try_retrieving_filename_for_(file_download_response=response)
+        or f"{uuid4()}.download"
+    )
+    return dpath_dest.joinpath(filename)
+
+
+class _DigestVerifier:
+    """Hashes a download as it streams by and checks it against expected digests."""
+
+    def __init__(self, url: str, expected_digests: Mapping[str, str]) -> None:
+        self._url = url
+        self._expected = {
+            algorithm.lower(): digest.lower()
+            for algorithm, digest in expected_digests.items()
+        }
+        # Raises ValueError for algorithms hashlib doesn't know, before downloading
+        self._hashers = {
+            algorithm: new_hasher(algorithm) for algorithm in self._expected
+        }
+
+    def update(self, chunk: memoryview) -> None:
+        for hasher in self._hashers.values():
+            hasher.update(chunk)
+
+    def update_from_(self, fpath: Path, limit: Optional[int] = None) -> None:
+        """For bytes that are already on disk rather than streaming by."""
+        with open(fpath, "rb", buffering=0) as fin:
+            buffer = memoryview(bytearray(DEFAULT_CHUNK_SIZE))
+            remaining = limit
+            while remaining is None or remaining > 0:
+                n = fin.readinto(
+                    buffer
+                    if remaining is None
+                    else buffer[: min(remaining, len(buffer))]
+                )
+                if not n:
+                    break
+                self.update(buffer[:n])
+                if remaining is not None:
+                    remaining -= n
+
+    def verify(self) -> None:
+        for algorithm, hasher in self._hashers.items():
+            if hasher.hexdigest() != self._expected[algorithm]:
+                raise DigestMismatchError(
+                    self._url, algorithm, self._expected[algorithm], hasher.hexdigest()
+                )
+
+    def verify_file_(self, fpath: Path, known_sha256: str) -> None:
+        """Verifies a file whose SHA-256 is already known, which saves reading it if
+        that's the only digest expected."""
+        if set(self._expected) == {"sha256"}:
+            if known_sha256 != self._expected["sha256"]:
+                raise DigestMismatchError(
+                    self._url, "sha256", self._expected["sha256"], known_sha256
+                )
+            return
+        self.update_from_(fpath)
+        self.verify()
+
+
+def _chained_(
+    *callbacks: Optional[Callable[[memoryview], None]]
+) -> Optional[Callable[[memoryview], None]]:
+    present = [callback for callback in callbacks if callback is not None]
+    if len(present) <= 1:
+        return present[0] if present else None
+
+    def chained(chunk: memoryview) -> None:
+        for callback in present:
+            callback(chunk)
+
+    return chained
+
+
+def _write_all_(fout: Union[BinaryIO, "_DecodingWriter"], data: memoryview) -> None:
+    # Unbuffered files may write less than asked
+    while data:
+        data = data[fout.write(data) :]
+
+
+def _stream_body_(
+    response: HTTPResponse,
+    fout: Union[BinaryIO, "_DecodingWriter"],
+    chunk_size: int,
+    limit: Optional[int] = None,
+    on_chunk: Optional[Callable[[memoryview], None]] = None,
+    zero_copy: bool = False,
+    cancelled: Optional[Event] = None,
+) -> int:
+    """Copies a response body into a file opened in binary mode and returns how many
+    bytes were copied.
+
+    Bytes are read into one preallocated buffer and written straight out of it, so the
+    buffer is the only copy made between the socket and the file (open the file
+    unbuffered to keep it that way). With zero_copy, plain HTTP bodies on Linux skip
+    even that by being spliced from the socket into the file inside the kernel.
+
+    Arguments:
+    limit -- stop after this many bytes even if there are more
+    on_chunk -- called with each chunk right after it's written (the view is only
+        valid until it returns). The zero-copy path is skipped when this is given
+        since those bytes never pass through Python.
+    cancelled -- stop early (between chunks) once this is set
+
+    Under a deadline, each read times out after what's left of it, and
+    DeadlineExceeded is raised once it's passed.
+    """
+    if zero_copy and on_chunk is None and _can_splice_(response):
+        return _splice_body_(response, fout, chunk_size, limit, cancelled)
+    trace = _active_trace.get()
+    deadline = Deadline.current()
+    sock = None if deadline is None else _socket_of_(response)
+    # Whatever it was opened with (e.g. a pool's timeout) still applies when shorter
+    timeout_sec = None if sock is None else sock.gettimeout()
+    buffer = memoryview(bytearray(chunk_size))
+    total = 0
+    while limit is None or total < limit:
+        if cancelled is not None and cancelled.is_set():
+            break
+        if sock is not None:
+            # Set anew for every read, since what's left keeps shrinking
+            sock.settimeout(Deadline.timeout_sec_for_(timeout_sec))
+        try:
+            n = response.readinto(
+                buffer if limit is None else buffer[: min(chunk_size, limit - total)]
+            )
+        except SocketTimeout as e:
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded("The deadline has passed.") from e
+            raise
+        if not n:
+            # http.client quietly stops short when a connection drops mid-body, so
+            # check whether everything promised arrived. (urlopen's responses for
+            # other schemes like file: don't track this, hence getattr.)
+            if getattr(response, "length", None):
+                raise IncompleteRead(b"", response.length)
+            break
+        chunk = buffer[:n]
+        _write_all_(fout, chunk)
+        total += n
+        if on_chunk is not None:
+            on_chunk(chunk)
+        if trace is not None:
+            trace.transferred(n)
+        if deadline is not None:
+            deadline.check()
+    return total
+
+
+def _socket_of_(response: HTTPResponse) -> Optional[socket]:
+    """The socket a response is read from, if it's an HTTP(S) response that has one."""
+    raw = getattr(getattr(response, "fp", None), "raw", None)
+    return getattr(raw, "_sock", None)
+
+
+def _can_splice_(response: HTTPResponse) -> bool:
+    # The scheme matters because a TLS socket's descriptor carries ciphertext, and a
+    # socket with a timeout is non-blocking underneath, which splice can't wait on
+    return (
+        hasattr(os, "splice")
+        and isinstance(response, HTTPResponse)
+        and not response.chunked
+        and response.length is not None
+        and urlsplit(getattr(response, "url", None) or "").scheme == "http"
+        and get_blocking(response.fileno())
+    )
+
+
+def _splice_body_(
+    response: HTTPResponse,
+    fout: BinaryIO,
+    chunk_size: int,
+    limit: Optional[int],
+    cancelled: Optional[Event],
+) -> int:
+    assert response.length is not None
+    remaining = response.length if limit is None else min(limit, response.length)
+    # http.client may have buffered some of the body while parsing the headers. One
+    # read1 of the buffer's size hands all of it over.
+    head = response.read1(min(remaining, DEFAULT_BUFFER_SIZE))
+    _write_all_(fout, memoryview(head))
+    total = len(head)
+    remaining -= len(head)
+    trace = _active_trace.get()
+    if trace is not None and head:
+        trace.transferred(len(head))
+    fd_socket, fd_file = response.fileno(), fout.fileno()
+    fd_pipe_out, fd_pipe_in = pipe()
+    try:
+        # Imported here since fcntl doesn't exist on Windows, and only Linux (which is
+        # the only place this runs) has F_SETPIPE_SZ
+        from fcntl import F_SETPIPE_SZ, fcntl
+
+        try:
+            fcntl(fd_pipe_in, F_SETPIPE_SZ, chunk_size)
+        except OSError:
+            pass  # Just means more trips through the (default 64 KiB) pipe
+        while remaining and not (cancelled is not None and cancelled.is_set()):
+            n = os.splice(fd_socket, fd_pipe_in, min(remaining, chunk_size))
+            if not n:
+                raise IncompleteRead(b"", remaining)
+            moved = 0
+            while moved < n:
+                moved += os.splice(fd_pipe_out, fd_file, n - moved)
+            total += n
+            remaining -= n
+            response.length -= n
+            if trace is not None:
+                trace.transferred(n)
+    finally:
+        os.close(fd_pipe_in)
+        os.close(fd_pipe_out)
+    if not response.length:
+        response.read()  # Lets http.client finish up so the connection can be reused
+    return total
+
+
+class _ZlibDecoder:
+    """Decodes a gzip, zlib or raw deflate stream a chunk at a time, handing out at
+    most max_out bytes at once so that a tiny input can't balloon in memory."""
+
+    def __init__(
+        self,
+        wbits: int,
+        max_out: int,
+        multi_member: bool = False,
+        may_be_raw: bool = False,
+    ) -> None:
+        """Arguments:
+        multi_member -- keep decoding streams that follow the first (gzip files may be
+            several gzip members back to back); otherwise anything after it is ignored
+        may_be_raw -- fall back to raw deflate if the stream has no zlib header, since
+            plenty of servers send that for Content-Encoding: deflate
+        """
+        self._wbits = wbits
+        self._max_out = max_out
+        self._multi_member = multi_member
+        self._may_be_raw = may_be_raw
+        self._decompressor = decompressobj(wbits)
+        self._fed = False
+
+    def decode(self, data: Union[bytes, memoryview]) -> Iterator[bytes]:
+        while True:
+            if self._decompressor.eof:
+                if not self._multi_member:
+                    return
+                data = self._decompressor.unused_data + data
+                self._decompressor, self._fed = decompressobj(self._wbits), False
+            if not self._fed:
+                data = bytes(data).lstrip(b"\0")  # Padding between members
+                if not data:
+                    return
+                self._fed = True
+            elif not data:
+                return
+            try:
+                out = self._decompressor.decompress(data, self._max_out)
+            except ZlibError:
+                if not self._may_be_raw:
+                    raise
+                self._decompressor = decompressobj(-MAX_WBITS)
+                out = self._decompressor.decompress(data, self._max_out)
+            self._may_be_raw = False
+            # Past the end of a stream, what's left is in unused_data (and possibly
+            # also in unconsumed_tail, so that has to be ignored then)
+            data = b"" if self._decompressor.eof else self._decompressor.unconsumed_tail
+            if out:
+                yield out
+
+    def finish(self) -> Iterator[bytes]:
+        if not self._fed:
+            return
+        out = self._decompressor.flush()
+        if out:
+            yield out
+        if not self._decompressor.eof:
+            raise EOFError("Compressed stream ended before its end marker")
+
+
+class _LZMADecoder:
+    """Decodes an xz (or legacy lzma) stream a chunk at a time, handing out at most
+    max_out bytes at once. Streams that follow the first are decoded too."""
+
+    def __init__(self, max_out: int) -> None:
+        self._max_out = max_out
+        self._decompressor = LZMADecompressor()
+        self._fed = False
+
+    def decode(self, data: Union[bytes, memoryview]) -> Iterator[bytes]:
+        while True:
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data + data
+                self._decompressor, self._fed = LZMADecompressor(), False
+            if not self._fed:
+                data = bytes(data).lstrip(b"\0")  # Padding between streams
+                if not data:
+                    return
+                self._fed = True
+            elif not data and self._decompressor.needs_input:
+                return
+            out = self._decompressor.decompress(data, self._max_out)
+            data = b""
+            if out:
+                yield out
+
+    def finish(self) -> Iterator[bytes]:
+        if self._fed and not self._decompressor.eof:
+            raise EOFError("Compressed stream ended before its end marker")
+        return iter(())
+
+
+class _BrotliDecoder:
+    def __init__(self) -> None:
+        assert _BrotliDecompressor is not None
+        self._decompressor = _BrotliDecompressor()
+
+    def decode(self, data: Union[bytes, memoryview]) -> Iterator[bytes]:
+        out = self._decompressor.process(bytes(data))
+        if out:
+            yield out
+
+    def finish(self) -> Iterator[bytes]:
+        if not self._decompressor.is_finished():
+            raise EOFError("Compressed stream ended before its end marker")
+        return iter(())
+
+
+class _Tap:
+    """Passes data through untouched, showing it to a callback on the way."""
+
+    def __init__(self, callback: Callable[[memoryview], None]) -> None:
+        self._callback = callback
+
+    def decode(self, data: Union[bytes, memoryview]) -> Iterator[bytes]:
+        self._callback(memoryview(data))
+        yield data
+
+    def finish(self) -> Iterator[bytes]:
+        return iter(())
+
+
+_Stage = Union[_ZlibDecoder, _LZMADecoder, _BrotliDecoder, _Tap]
+
+
+class _DecodingWriter:
+    """Stands in for the destination file of _stream_body_, running what's written
+    through stages one after another before it reaches the real file. Call finish
+    once the body is through so the stages can flush and check they saw an end."""
+
+    def __init__(self, fout: BinaryIO, stages: List[_Stage]) -> None:
+        self._fout = fout
+        self._stages = stages
+
+    def write(self, data: Union[bytes, memoryview]) -> int:
+        self._push_(0, data)
+        return len(data)
+
+    def finish(self) -> None:
+        for i, stage in enumerate(self._stages):
+            for out in stage.finish():
+                self._push_(i + 1, out)
+
+    def _push_(self, i: int, data: Union[bytes, memoryview]) -> None:
+        if i == len(self._stages):
+            _write_all_(self._fout, memoryview(data))
+            return
+        for out in self._stages[i].decode(data):
+            self._push_(i + 1, out)
+
+
+def _content_decoders_for_(response: HTTPResponse, max_out: int) -> List[_Stage]:
+    # Encodings are listed in the order they were applied, so undo them backwards
+    encodings = (response.headers.get("Content-Encoding") or "").lower().split(",")
+    decoders: List[_Stage] = []
+    for encoding in map(str.strip, reversed(encodings)):
+        if encoding in ("", "identity"):
+            continue
+        if encoding in ("gzip", "x-gzip"):
+            decoders.append(_ZlibDecoder(16 + MAX_WBITS, max_out, multi_member=True))
+        elif encoding == "deflate":
+            decoders.append(_ZlibDecoder(MAX_WBITS, max_out, may_be_raw=True))
+        elif encoding == "br" and _BrotliDecompressor is not None:
+            decoders.append(_BrotliDecoder())
+        else:
+            raise HTTPException(f"Unsupported Content-Encoding: {encoding}")
+    return decoders
+
+
+def _unpacking_for_(fpath: Path, max_out: int) -> Optional[Tuple[Path, _Stage]]:
+    """Where a .gz or .xz file goes once decompressed, and what decompresses it."""
+    suffix = fpath.suffix.lower()
+    if suffix == ".gz":
+        return fpath.with_suffix(""), _ZlibDecoder(
+            16 + MAX_WBITS, max_out, multi_member=True
+        )
+    if suffix == ".tgz":
+        return fpath.with_suffix(".tar"), _ZlibDecoder(
+            16 + MAX_WBITS, max_out, multi_member=True
+        )
+    if suffix == ".xz":
+        return fpath.with_suffix(""), _LZMADecoder(max_out)
+    if suffix == ".txz":
+        return fpath.with_suffix(".tar"), _LZMADecoder(max_out)
+    return None
+
+
+def download_file_from_(
+    url: str,
+    dest_dir: PathLike[str],
+    pool: Optional[HTTPConnectionPool] = None,
+    parts: int = 1,
+    resumable: bool = False,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    zero_copy: bool = False,
+    cache: Optional[DownloadCache] = None,
+    expected_digests: Optional[Mapping[str, str]] = None,
+    compressed_transfer: bool = False,
+    decompress: bool = False,
+    observer: Optional[DownloadObserver] = None,
+    retry: Optional[RetryPolicy] = None,
+    hedge: Optional[HedgePolicy] = None,
+    mirror_urls: Sequence[str] = (),
+) -> Path:
+    """Downloads a URL into a directory, naming the file after what the server calls
+    it when it says (otherwise it gets a random name).
+
+    Under a deadline (see time_related.deadline_after_), connecting and every read
+    time out after what's left of it, and DeadlineExceeded is raised as soon as it
+    passes, including before anything's requested if it already has. Split downloads
+    keep their parts under it as well.
+
+    Arguments:
+    url -- what to download
+    dest_dir -- the existing directory to save the download into
+    pool -- connections to reuse instead of opening a new one for this download
+    parts -- when more than 1, large files are split into this many byte ranges that
+        are downloaded concurrently (if the server supports ranges; otherwise it's
+        downloaded as one stream like usual)
+    resumable -- download into a .part file next to a checkpoint of how far it got,
+        so calling this again for the same URL and directory after an interruption
+        continues where it left off instead of starting over. The file only takes its
+        real name once it's complete. Can't be combined with parts.
+    chunk_size -- how many bytes are moved from the socket to the file at a time
+    zero_copy -- on Linux, move the bytes of plain HTTP downloads from the socket to
+        the file inside the kernel (using splice) rather than through Python. Other
+        downloads quietly take the usual path.
+    cache -- serve the file from here if the server says the cached copy is still
+        current, and cache it otherwise. Can't be combined with parts or resumable.
+    expected_digests -- hex digests the download must have, keyed by the name hashlib
+        knows the algorithm by (e.g. "sha256", "sha512" or "blake2b"). They're
+        computed on the chunks as they stream to disk (which rules out zero_copy), and
+        if any doesn't match, DigestMismatchError is raised and the file is deleted.
+        Bytes that don't stream by in order are read back from disk instead: those of
+        split downloads, and those a resumed download already had.
+    compressed_transfer -- offer to take the body gzip, deflate or (if the brotli
+        package is installed) brotli compressed, which servers that oblige send in a
+        fraction of the bytes. It's decoded on the way to the file, so what's saved is
+        the same as without this. Can't be combined with parts, resumable or cache.
+    decompress -- save .gz and .xz files (and .tgz and .txz ones) decompressed,
+        without the compression suffix (.tgz and .txz become .tar). They're decoded on
+        the way to the file rather than afterwards. Expected digests are still those
+        of the compressed file, as served. Can't be combined with parts, resumable or
+        cache.
+    observer -- told how the download progresses and where its time went
+    retry -- try again after failures that may not happen again, like dropped
+        connections and 503s, waiting in between as the policy says. A failed attempt
+        doesn't leave a partial file behind, except resumable ones, which the next
+        attempt picks up from.
+    hedge -- if the server's slow to start answering, send the request again (to the
+        next mirror, if there are any) and download from whichever answers first. Can't
+        be combined with parts, resumable or cache.
+    mirror_urls -- other URLs of the same file. Each retry goes to the next of url and
+        these in turn, and so does each hedged request.
+    """
+    if chunk_size <= 0:
+        raise ValueError("Chunk size must be positive.")
+    if (compressed_transfer or decompress) and (
+        parts > 1 or resumable or cache is not None
+    ):
+        raise ValueError("Decoded downloads can't be split, resumable or cached.")
+    if cache is not None and (parts > 1 or resumable):
+        raise ValueError("Cached downloads can't be split or resumable.")
+    if resumable and parts > 1:
+        raise ValueError("Resumable downloads can't be split into parts.")
+    if hedge is not None and (parts > 1 or resumable or cache is not None):
+        raise ValueError("Hedged downloads can't be split, resumable or cached.")
+    dpath_dest = _dest_dirpath_from_(dest_dir)
+    urls = [url, *mirror_urls]
+    download = partial(
+        _download_,
+        dpath_dest=dpath_dest,
+        pool=pool,
+        parts=parts,
+        resumable=resumable,
+        chunk_size=chunk_size,
+        zero_copy=zero_copy,
+        cache=cache,
+        expected_digests=expected_digests,
+        compressed_transfer=compressed_transfer,
+        decompress=decompress,
+        hedge=hedge,
+    )
+    with profiler.span("download_file_from_"), _observed_(url, observer):
+        if retry is None:
+            return download(urls)
+        # Each retry starts at the next mirror (if there are any)
+        return retry._run(
+            lambda retries: download(
+                urls[retries % len(urls) :] + urls[: retries % len(urls)]
+            )
+        )
+
+
+def _download_(
+    urls: List[str],
+    dpath_dest: Path,
+    pool: Optional[HTTPConnectionPool],
+    parts: int,
+    resumable: bool,
+    chunk_size: int,
+    zero_copy: bool,
+    cache: Optional[DownloadCache],
+    expected_digests: Optional[Mapping[str, str]],
+    compressed_transfer: bool,
+    decompress: bool,
+    hedge: Optional[HedgePolicy],
+) -> Path:
+    """One attempt at download_file_from_, from the first of the URLs (hedging to the
+    rest)."""
+    url = urls[0]
+    verifier = (
+        None if expected_digests is None else _DigestVerifier(url, expected_digests)
+    )
+    if cache is not None:
+        return _download_through_cache_(
+            url, dpath_dest, pool, chunk_size, cache, verifier
+        )
+    if resumable:
+        return _download_resumably_(
+            url, dpath_dest, pool, chunk_size, zero_copy, verifier
+        )
+    if parts > 1:
+        fpath_dest = _try_downloading_in_parts_(
+            url, dpath_dest, pool, parts, chunk_size, zero_copy
+        )
+        if fpath_dest is not None:
+            if verifier is not None:
+                verifier.update_from_(fpath_dest)
+                _verify_or_delete_(verifier, fpath_dest)
+            return fpath_dest
+    headers = {"Accept-Encoding": _ACCEPT_ENCODING} if compressed_transfer else None
+    opened = (
+        _open_(url, pool=pool, headers=headers)
+        if hedge is None
+        else hedge._open(urls, pool, headers)
+    )
+    with opened as response:
+        fpath_dest = _dest_filepath_for_(response, dpath_dest)
+        stages = (
+            _content_decoders_for_(response, max_out=chunk_size)
+            if compressed_transfer
+            else []
+        )
+        unpacking = _unpacking_for_(fpath_dest, chunk_size) if decompress else None
+        if verifier is not None and (stages or unpacking is not None):
+            # Digests are of the file as served, so they're taken before unpacking
+            stages.append(_Tap(verifier.update))
+        if unpacking is not None:
+            fpath_dest, unpacker = unpacking
+            stages.append(unpacker)
+        # Use "x" to raise exception if file exists, "b" because response bodies
+        # are bytes, and no buffering since chunks are already big
+        with open(fpath_dest, "xb", buffering=0) as fout:
+            try:
+                if not stages:
+                    _stream_body_(
+                        response,
+                        fout,
+                        chunk_size,
+                        on_chunk=None if verifier is None else verifier.update,
+                        zero_copy=zero_copy,
+                    )
+                else:
+                    writer = _DecodingWriter(fout, stages)
+                    _stream_body_(response, writer, chunk_size)
+                    writer.finish()
+            except BaseException:
+                # What little came would only be in the way of trying again
+                fout.close()
+                unlink(fpath_dest)
+                raise
+    if verifier is not None:
+        _verify_or_delete_(verifier, fpath_dest)
+    return fpath_dest
+
+
+def _verify_or_delete_(verifier: _DigestVerifier, *fpaths: Path) -> None:
+    try:
+        verifier.verify()
+    except DigestMismatchError:
+        for fpath in fpaths:
+            fpath.unlink(missing_ok=True)
+        raise
+
+
+def _try_downloading_in_parts_(
+    url: str,
+    dpath_dest: Path,
+    pool: Optional[HTTPConnectionPool],
+    parts: int,
+    chunk_size: int,
+    zero_copy: bool,
+) -> Optional[Path]:
+    """Returns None without downloading anything when the server doesn't support
+    ranges, won't say how big the file is, or the file is too small to be worth
+    splitting."""
+    # Asked for with a one byte range rather than HEAD, which plenty of servers don't
+    # allow (presigned S3 URLs answer it with 403, others with 405). A 206 answer
+    # also shows ranges work better than Accept-Ranges would.
+    try:
+        response = _open_(url, pool=pool, headers={"Range": "bytes=0-0"})
+    except HTTPError as e:
+        _discard_error_(e)
+        return None  # Whatever's wrong, the normal download gets to deal with it
+    with response:
+        match = fullmatch(
+            r"bytes 0-0/(\d+)", response.getheader("Content-Range", "").strip()
+        )
+        if response.status != 206 or match is None:
+            return None  # Closed unread, so a whole file won't be waited for
+        response.read()
+        size = int(match.group(1))
+        trace = _active_trace.get()
+        if trace is not None:
+            trace.expecting(size)  # Rather than the one byte this said it was
+        if size < 2 * _MIN_PART_SIZE:
+            return None
+        # If the file changes between requests, If-Range makes the server send all of
+        # the new file instead of a range of it, which gets caught below
+        validator = response.getheader("ETag") or response.getheader("Last-Modified")
+        fpath_dest = _dest_filepath_for_(response, dpath_dest)
+
+    part_size = max(_MIN_PART_SIZE, -(-size // parts))
+    ranges = [
+        (start, min(start + part_size, size)) for start in range(0, size, part_size)
+    ]
+    with open(fpath_dest, "xb") as fout:
+        fout.truncate(size)  # Preallocate so every part can be written at its offset
+    cancelled = Event()
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures: List[Future] = [
+                executor.submit(
+                    # Parts report into the same trace as the rest of the download
+                    copy_context().run,
+                    _download_range_,
+                    url,
+                    pool,
+                    fpath_dest,
+                    start,
+                    end,
+                    validator,
+                    cancelled,
+                    chunk_size,
+                    zero_copy,
+                )
+                for start, end in ranges
+            ]
+            try:
+                # In order of completion so that the first failure is what's raised,
+                # not a part that stopped because of it
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                cancelled.set()
+                raise
+    except BaseException:
+        unlink(fpath_dest)
+        raise
+    return fpath_dest
+
+
+def _download_range_(
+    url: str,
+    pool: Optional[HTTPConnectionPool],
+    fpath_dest: Path,
+    start: int,
+    end: int,
+    validator: Optional[str],
+    cancelled: Event,
+    chunk_size: int,
+    zero_copy: bool,
+) -> None:
+    """Downloads bytes [start, end) of a URL into the same place in the file."""
+    headers = {"Range": f"bytes={start}-{end - 1}"}
+    if validator is not None:
+        headers["If-Range"] = validator
+    with _open_(url, pool=pool, headers=headers) as response:
+        content_range = response.getheader("Content-Range", "")
+        if response.status != 206 or not content_range.startswith(
+            f"bytes {start}-{end - 1}/"
+        ):
+            raise HTTPException(
+                f"Expected bytes {start}-{end - 1} of {url} but got status "
+                f"{response.status} with Content-Range '{content_range}' (did the file "
+                "change?)"
+            )
+        if cancelled.is_set():
+            return
+        with open(fpath_dest, "r+b", buffering=0) as fout:
+            fout.seek(start)
+            copied = _stream_body_(
+                response,
+                fout,
+                chunk_size,
+                limit=end - start,
+                zero_copy=zero_copy,
+                cancelled=cancelled,
+            )
+        if cancelled.is_set():
+            return  # Another part failed, and the whole download with it
+        if copied != end - start:
+            raise HTTPException(f"{url} ended {end - start - copied} bytes early")
+
+
+class _Checkpoint(NamedTuple):
+    """What's recorded next to a resumable download's .part file. The validator is the
+    ETag (or Last-Modified) the bytes so far were downloaded under."""
+
+    url: str
+    bytes_done: int
+    validator: Optional[str]
+
+    @staticmethod
+    def load_from_(fpath: Path, url: str) -> Optional["_Checkpoint"]:
+        try:
+            checkpoint = _Checkpoint(**loads(fpath.read_text()))
+        except (OSError, JSONDecodeError, TypeError):
+            return None  # Missing or mangled checkpoints just mean starting over
+        return checkpoint if checkpoint.url == url else None
+
+    def save_to_(self, fpath: Path) -> None:
+        # Written to the side first so a crash mid-write can't leave it mangled
+        fpath_tmp = fpath.with_name(fpath.name + ".tmp")
+        fpath_tmp.write_text(dumps(self._asdict()))
+        replace(fpath_tmp, fpath)
+
+
+def _download_resumably_(
+    url: str,
+    dpath_dest: Path,
+    pool: Optional[HTTPConnectionPool],
+    chunk_size: int,
+    zero_copy: bool,
+    verifier: Optional[_DigestVerifier],
+) -> Path:
+    # The server only says what the file is called after it's been asked for it, so
+    # in-progress files are named after the URL to be able to find them again
+    fpath_part = dpath_dest.joinpath(sha256(url.encode()).hexdigest()[:32] + ".part")
+    fpath_checkpoint = fpath_part.with_name(fpath_part.name + ".json")
+    checkpoint = _Checkpoint.load_from_(fpath_checkpoint, url)
+    bytes_done = 0
+    headers: Dict[str, str] = {}
+    if checkpoint is not None and checkpoint.validator and fpath_part.exists():
+        # Progress is recorded after the bytes it covers are written, so the file can
+        # only be ahead of the checkpoint; anything past it gets trimmed off
+        bytes_done = min(checkpoint.bytes_done, fpath_part.stat().st_size)
+        headers = {"Range": f"bytes={bytes_done}-", "If-Range": checkpoint.validator}
+    try:
+        response = _open_(url, pool=pool, headers=headers)
+    except HTTPError as e:
+        if e.code != 416:
+            raise
+        _discard_error_(e)
+        # The server won't serve from where the checkpoint says to, so start over
+        bytes_done = 0
+        response = _open_(url, pool=pool)
+    with response:
+        if response.status != 206 or not response.getheader(
+            "Content-Range", ""
+        ).startswith(f"bytes {bytes_done}-"):
+            bytes_done = 0  # The server sent the whole thing (e.g. it changed)
+        fpath_dest = _dest_filepath_for_(response, dpath_dest)
+        if fpath_dest.exists():
+            raise FileExistsError(fpath_dest)
+        checkpoint = _Checkpoint(
+            url=url,
+            bytes_done=bytes_done,
+            validator=response.getheader("ETag") or response.getheader("Last-Modified"),
+        )
+        if verifier is not None and bytes_done:
+            verifier.update_from_(fpath_part, limit=bytes_done)
+        mode = "r+b" if fpath_part.exists() else "xb"
+        with open(fpath_part, mode, buffering=0) as fout:
+            fout.truncate(bytes_done)
+            fout.seek(bytes_done)
+            checkpoint_at = bytes_done + _CHECKPOINT_INTERVAL
+
+            def checkpoint_progress(chunk: memoryview) -> None:
+                nonlocal checkpoint_at
+                if fout.tell() >= checkpoint_at:
+                    checkpoint._replace(bytes_done=fout.tell()).save_to_(
+                        fpath_checkpoint
+                    )
+                    checkpoint_at = fout.tell() + _CHECKPOINT_INTERVAL
+
+            try:
+                _stream_body_(
+                    response,
+                    fout,
+                    chunk_size,
+                    # Spliced bytes never pass through Python, so with zero_copy
+                    # progress is only recorded when the download fails
+                    on_chunk=_chained_(
+                        None if zero_copy else checkpoint_progress,
+                        None if verifier is None else verifier.update,
+                    ),
+                    zero_copy=zero_copy,
+                )
+            except BaseException:
+                # Record everything that made it so that resuming loses nothing
+                checkpoint._replace(bytes_done=fout.tell()).save_to_(fpath_checkpoint)
+                raise
+    if verifier is not None:
+        # Resuming wrong bytes would only make them more wrong, so start over next time
+        _verify_or_delete_(verifier, fpath_part, fpath_checkpoint)
+    try:
+        # Linking fails if something took the name in the meantime, unlike renaming
+        # which would silently clobber it on some platforms
+        link(fpath_part, fpath_dest)
+        unlink(fpath_part)
+    except FileExistsError:
+        raise
+    except OSError:
+        fpath_part.rename(fpath_dest)  # For file systems without hard links
+    try:
+        unlink(fpath_checkpoint)
+    except FileNotFoundError:
+        pass  # Downloads that finished before their first checkpoint never made one
+    return fpath_dest
+
+
+def _download_through_cache_(
+    url: str,
+    dpath_dest: Path,
+    pool: Optional[HTTPConnectionPool],
+    chunk_size: int,
+    cache: DownloadCache,
+    verifier: Optional[_DigestVerifier],
+) -> Path:
+    entry = cache._entry_for_(url)
+    headers: Dict[str, str] = {}
+    if entry is not None and entry.etag:
+        headers["If-None-Match"] = entry.etag
+    if entry is not None and entry.last_modified:
+        headers["If-Modified-Since"] = entry.last_modified
+    try:
+        response = _open_(url, pool=pool, headers=headers)
+    except HTTPError as e:
+        if e.code != 304 or entry is None:
+            raise
+        response = e  # urllib considers "not modified" an error
+    with response:
+        if response.status == 304 and entry is not None:
+            response.read()  # Nothing to read, but it lets a pool reuse the connection
+            if verifier is not None:
+                verifier.verify_file_(
+                    cache._fpath_object_for_(entry.digest), known_sha256=entry.digest
+                )
+            filename = entry.filename or f"{uuid4()}.download"
+            fpath_dest = dpath_dest.joinpath(filename)
+            cache._serve(url, entry, fpath_dest)
+            return fpath_dest
+        fpath_dest = _dest_filepath_for_(response, dpath_dest)
+        if fpath_dest.exists():
+            raise FileExistsError(fpath_dest)  # Before spending time downloading
+        fpath_tmp = cache._new_fpath_tmp()
+        hasher = sha256()
+        try:
+            with open(fpath_tmp, "xb", buffering=0) as fout:
+                size = _stream_body_(
+                    response,
+                    fout,
+                    chunk_size,
+                    on_chunk=_chained_(
+                        hasher.update, None if verifier is None else verifier.update
+                    ),
+                )
+        except BaseException:
+            fpath_tmp.unlink(missing_ok=True)
+            raise
+        if verifier is not None:
+            _verify_or_delete_(verifier, fpath_tmp)  # Before it can poison the cache
+        entry = _CacheEntry(
+            digest=hasher.hexdigest(),
+            size=size,
+            etag=response.getheader("ETag"),
+            last_modified=response.getheader("Last-Modified"),
+            filename=_try_retrieving_filename_for_(file_download_response=response),
+            last_used=time(),
+        )
+    cache._store(url, fpath_tmp, entry, fpath_dest)
     return fpath_dest
+
+
+def download_files_from_(
+    urls: Iterable[str],
+    dest_dir: PathLike[str],
+    max_workers: int = 8,
+    max_per_host: int = 2,
+    pool: Optional[HTTPConnectionPool] = None,
+    observer: Optional[DownloadObserver] = None,
+) -> Iterator[DownloadResult]:
+    """Downloads many URLs into one directory concurrently, yielding a result for each
+    URL as soon as its download finishes (i.e. not in the order given).
+
+    The destination directory is checked before anything is downloaded, so the same
+    errors download_file_from_ raises for a missing or non-directory destination are
+    raised immediately. Failures of individual downloads (like a file that already
+    exists) don't stop the batch; they're reported in that URL's result instead.
+
+    Arguments:
+    urls -- the URLs to download
+    dest_dir -- the directory every download is saved into
+    max_workers -- the most downloads that may be in flight at once
+    max_per_host -- the most downloads that may be in flight at once against any
+        single host, so that a batch doesn't hammer one server
+    pool -- connections to share between the downloads (keeping max_idle_per_host at
+        least max_per_host lets every worker reuse its connection)
+    observer -- told about every download of the batch (from the worker threads, so
+        it has to be thread-safe like DownloadStats is)
+    """
+    if max_workers <= 0 or max_per_host <= 0:
+        raise ValueError("Worker limits must be positive.")
+    dpath_dest = _dest_dirpath_from_(dest_dir)
+    return _iter_batch_results_(
+        urls=urls,
+        dpath_dest=dpath_dest,
+        max_workers=max_workers,
+        max_per_host=max_per_host,
+        pool=pool,
+        observer=observer,
+    )
+
+
+def _download_as_result_(
+    url: str,
+    dpath_dest: Path,
+    pool: Optional[HTTPConnectionPool],
+    observer: Optional[DownloadObserver],
+) -> DownloadResult:
+    try:
+        fpath = download_file_from_(url, dpath_dest, pool, observer=observer)
+        return DownloadResult(url, fpath, None)
+    except Exception as e:
+        return DownloadResult(url, None, e)
+
+
+def _iter_batch_results_(
+    urls: Iterable[str],
+    dpath_dest: Path,
+    max_workers: int,
+    max_per_host: int,
+    pool: Optional[HTTPConnectionPool],
+    observer: Optional[DownloadObserver],
+) -> Iterator[DownloadResult]:
+    # URLs are queued per host and only handed to the pool when their host has a free
+    # slot. That way a worker never sits blocked waiting on a busy host while URLs for
+    # other hosts are waiting behind it.
+    queued_per_host: Dict[str, Deque[str]] = {}
+    for url in urls:
+        queued_per_host.setdefault(urlsplit(url).netloc.lower(), deque()).append(url)
+    in_flight_per_host = {host: 0 for host in queued_per_host}
+    in_flight: Dict[Future, str] = {}
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while True:
+            for host, queue in queued_per_host.items():
+                while (
+                    queue
+                    and in_flight_per_host[host] < max_per_host
+                    and len(in_flight) < max_workers
+                ):
+                    future = executor.submit(
+                        # So that downloads are under the caller's deadline, if any
+                        copy_context().run,
+                        _download_as_result_,
+                        queue.popleft(),
+                        dpath_dest,
+                        pool,
+                        observer,
+                    )
+                    in_flight[future] = host
+                    in_flight_per_host[host] += 1
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                in_flight_per_host[in_flight.pop(future)] -= 1
+                yield future.result()
+    finally:
+        # Also runs when the caller stops iterating early, in which case nothing new
+        # gets started and only what's already in flight is waited on
+        executor.shutdown(wait=True)
+
+
+class _AsyncResponse:
+    """The status and headers of a response being read over asyncio streams, with
+    info() like HTTPResponse so the same filename logic applies."""
+
+    def __init__(self, status: int, reason: str, headers: HTTPMessage) -> None:
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    def info(self) -> HTTPMessage:
+        return self.headers
+
+
+async def async_download_file_from_(
+    url: str,
+    dest_dir: PathLike[str],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ssl_context: Optional[SSLContext] = None,
+    max_redirects: int = 5,
+) -> Path:
+    """The asyncio counterpart of download_file_from_, speaking HTTP/1.1 over asyncio
+    streams so that in-flight downloads cost a coroutine each rather than a thread.
+    The destination directory and file name rules are the same. There's no observer
+    (see DownloadObserver) to pass, since these downloads can't be observed yet.
+
+    Bodies are read only as fast as they're written, so a slow disk slows the sender
+    down (through TCP flow control) instead of piling data up in memory. Writes to
+    the file are plain blocking writes, which land in the OS's page cache and are
+    quick enough not to stall the event loop in practice.
+
+    Cancelling a download closes its connection and deletes its partial file. So does
+    running out of time under a deadline, which raises DeadlineExceeded, and failing in
+    any other way (e.g. the body being cut short).
+
+    Arguments:
+    url -- what to download (HTTP or HTTPS)
+    dest_dir -- the existing directory to save the download into
+    chunk_size -- the most bytes read from the connection at a time
+    ssl_context -- context for HTTPS connections (default is ssl's default context)
+    max_redirects -- how many redirects to follow before giving up
+    """
+    if chunk_size <= 0:
+        raise ValueError("Chunk size must be positive.")
+    dpath_dest = _dest_dirpath_from_(dest_dir)
+    if Deadline.current() is None:
+        return await _async_download_(
+            url, dpath_dest, chunk_size, ssl_context, max_redirects
+        )
+    try:
+        # Being cancelled when time's up also deletes the partial file
+        return await wait_for(
+            _async_download_(url, dpath_dest, chunk_size, ssl_context, max_redirects),
+            Deadline.timeout_sec_for_(),
+        )
+    except AsyncTimeoutError as e:
+        raise DeadlineExceeded("The deadline has passed.") from e
+
+
+async def _async_download_(
+    url: str,
+    dpath_dest: Path,
+    chunk_size: int,
+    ssl_context: Optional[SSLContext],
+    max_redirects: int,
+) -> Path:
+    for _ in range(max_redirects + 1):
+        reader, writer = await _async_request_(url, ssl_context)
+        try:
+            response = await _async_read_response_head_(reader)
+            location = response.headers.get("Location")
+            if response.status in _REDIRECT_STATUSES and location:
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                raise HTTPError(
+                    url, response.status, response.reason, response.headers, None
+                )
+            fpath_dest = _dest_filepath_for_(response, dpath_dest)
+            with open(fpath_dest, "xb", buffering=0) as fout:
+                try:
+                    async for chunk in _async_iter_body_(reader, response, chunk_size):
+                        _write_all_(fout, memoryview(chunk))
+                except BaseException:
+                    # Like with download_file_from_, a partial file would only be in the
+                    # way of trying again, whatever cut it short (being cancelled too)
+                    fout.close()
+                    unlink(fpath_dest)
+                    raise
+            return fpath_dest
+        finally:
+            # Aborting rather than closing since nothing more is coming, and it can't
+            # get stuck waiting on a peer (which matters when being cancelled)
+            writer.transport.abort()
+    raise HTTPError(url, response.status, "Too many redirects", response.headers, None)
+
+
+def async_download_files_from_(
+    urls: Iterable[str],
+    dest_dir: PathLike[str],
+    max_concurrency: int = 100,
+    max_per_host: int = 8,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ssl_context: Optional[SSLContext] = None,
+) -> AsyncIterator[DownloadResult]:
+    """The asyncio counterpart of download_files_from_. Iterate the result with async
+    for to get each URL's result as soon as its download finishes.
+
+    The destination directory is checked right away, and failures of individual
+    downloads are reported in their results. If iteration stops early (or the
+    iterating task is cancelled), downloads still in flight are cancelled.
+
+    Arguments:
+    urls -- the URLs to download
+    dest_dir -- the directory every download is saved into
+    max_concurrency -- the most downloads that may be in flight at once (thousands
+        are fine as far as the event loop is concerned; open file limits are usually
+        what runs out first)
+    max_per_host -- the most downloads that may be in flight at once against any
+        single host
+    """
+    if max_concurrency <= 0 or max_per_host <= 0:
+        raise ValueError("Concurrency limits must be positive.")
+    dpath_dest = _dest_dirpath_from_(dest_dir)
+    return _async_iter_batch_results_(
+        urls=urls,
+        dpath_dest=dpath_dest,
+        max_concurrency=max_concurrency,
+        max_per_host=max_per_host,
+        chunk_size=chunk_size,
+        ssl_context=ssl_context,
+    )
+
+
+async def _async_iter_batch_results_(
+    urls: Iterable[str],
+    dpath_dest: Path,
+    max_concurrency: int,
+    max_per_host: int,
+    chunk_size: int,
+    ssl_context: Optional[SSLContext],
+) -> AsyncIterator[DownloadResult]:
+    slots = Semaphore(max_concurrency)
+    slots_per_host: Dict[str, Semaphore] = {}
+
+    async def download_as_result(url: str) -> DownloadResult:
+        host = urlsplit(url).netloc.lower()
+        # The host's slot is taken first so that downloads waiting on a busy host
+        # don't hold up downloads for other hosts
+        async with slots_per_host.setdefault(host, Semaphore(max_per_host)), slots:
+            try:
+                fpath = await async_download_file_from_(
+                    url, dpath_dest, chunk_size=chunk_size, ssl_context=ssl_context
+                )
+                return DownloadResult(url, fpath, None)
+            except Exception as e:
+                return DownloadResult(url, None, e)
+
+    tasks = [create_task(download_as_result(url)) for url in urls]
+    try:
+        for next_done in as_completed_async(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+        await gather(*tasks, return_exceptions=True)
+
+
+async def _async_request_(
+    url: str, ssl_context: Optional[SSLContext]
+) -> Tuple[StreamReader, StreamWriter]:
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError(f"Only HTTP(S) URLs can be downloaded asynchronously: {url}")
+    is_https = parts.scheme == "https"
+    reader, writer = await open_connection(
+        parts.hostname,
+        parts.port or (443 if is_https else 80),
+        ssl=(ssl_context or create_default_context()) if is_https else None,
+        limit=_ASYNC_MAX_HEAD_SIZE,
+    )
+    target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    writer.write(
+        (
+            f"GET {target} HTTP/1.1\r\n"
+            f"Host: {parts.netloc.rpartition('@')[2]}\r\n"
+            f"User-Agent: Python-urllib/{request.__version__}\r\n"
+            "Accept-Encoding: identity\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+        ).encode("latin-1")
+    )
+    await writer.drain()
+    return reader, writer
+
+
+async def _async_read_response_head_(reader: StreamReader) -> _AsyncResponse:
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except IncompleteReadError as e:
+        raise RemoteDisconnected("Connection closed before a response came") from e
+    except LimitOverrunError as e:
+        raise HTTPException("Response headers are too big") from e
+    status_line, _, header_lines = head.partition(b"\r\n")
+    version, _, rest = status_line.decode("latin-1").partition(" ")
+    status, _, reason = rest.partition(" ")
+    if not version.startswith("HTTP/") or not status.isdigit():
+        raise HTTPException(f"Malformed status line: {status_line!r}")
+    return _AsyncResponse(
+        int(status), reason.strip(), parse_headers(BytesIO(header_lines))
+    )
+
+
+async def _async_iter_body_(
+    reader: StreamReader, response: _AsyncResponse, chunk_size: int
+) -> AsyncIterator[bytes]:
+    if "chunked" in response.headers.get("Transfer-Encoding", "").lower():
+        async for chunk in _async_iter_chunked_body_(reader, chunk_size):
+            yield chunk
+        return
+    content_length = response.headers.get("Content-Length")
+    remaining = int(content_length) if content_length is not None else None
+    while remaining is None or remaining > 0:
+        chunk = await reader.read(
+            chunk_size if remaining is None else min(chunk_size, remaining)
+        )
+        if not chunk:
+            if remaining:
+                raise IncompleteRead(b"", remaining)
+            return  # Without a length, the body ends when the connection does
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+async def _async_iter_chunked_body_(
+    reader: StreamReader, chunk_size: int
+) -> AsyncIterator[bytes]:
+    try:
+        while True:
+            size_line = await reader.readline()
+            try:
+                size = int(size_line.split(b";")[0], 16)
+            except ValueError as e:
+                raise HTTPException(f"Malformed chunk size: {size_line!r}") from e
+            if size == 0:
+                # Skip any trailers up to the blank line that ends them
+                while (await reader.readline()).strip():
+                    pass
+                return
+            while size:
+                chunk = await reader.readexactly(min(size, chunk_size))
+                size -= len(chunk)
+                yield chunk
+            await reader.readexactly(2)  # The CRLF after each chunk
+    except IncompleteReadError as e:
+        raise IncompleteRead(e.partial) from e
@@ -1,4 +1,25 @@
-from time import time
+from array import array
+from contextlib import contextmanager
+from contextvars import ContextVar
+from heapq import heapify, heappop, heappush
+from itertools import compress, count
+from threading import Condition, Lock, Thread
+from time import monotonic, monotonic_ns, perf_counter_ns, time
+from traceback import print_exc
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Generic,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+_Item = TypeVar("_Item")
 
 
 class TimeoutTimerPassive:
@@ -70,3 +91,561 @@ class TimeoutTimerPassive:
             self._timestart_unixts
         ):
             self.reset()
+
+
+def _ns_from_sec_(timeout_time_sec: float) -> int:
+    if timeout_time_sec <= 0:
+        raise RuntimeError(
+            "Timeout limit cannot be "
+            f"{'negative' if timeout_time_sec < 0 else 'zero'}."
+        )
+    return max(1, round(timeout_time_sec * 1_000_000_000))
+
+
+class TimeoutTimerMonotonic:
+    """Works just like TimeoutTimerPassive (you still have to poll it), but it's
+    cheaper and it's safe from the system clock getting changed.
+    TimeoutTimerPassive goes by time(), so an NTP adjustment can make it time out way
+    early or way late. This one goes by time.monotonic_ns() instead. It also takes
+    fractions of a second, keeps its state in __slots__ rather than a dict, and only
+    reads the clock once per check.
+
+    If you have lots of these to poll at once, have a look at TimerArray."""
+
+    __slots__ = ("_timeout_ns", "_deadline_ns")
+
+    def __init__(self, timeout_time_sec: float) -> None:
+        self._timeout_ns = _ns_from_sec_(timeout_time_sec)
+        self._deadline_ns: Optional[int] = None
+
+    def get_timeout_time_sec(self) -> float:
+        return self._timeout_ns / 1_000_000_000
+
+    def is_active(self) -> bool:
+        return self._deadline_ns is not None and monotonic_ns() < self._deadline_ns
+
+    def start_timer(self) -> None:
+        now = monotonic_ns()
+        if self._deadline_ns is not None and now < self._deadline_ns:
+            raise RuntimeError(
+                "Can't start a timer that has already started. If you want to start ov"
+                "er, reset this timer and start it after that."
+            )
+        self._deadline_ns = now + self._timeout_ns
+
+    def reset(self) -> None:
+        self._deadline_ns = None
+
+    def timed_out(self, raise_on_timeout: bool = False) -> bool:
+        if self._deadline_ns is None:
+            # Technically a timeout never occured if just initialized or reset
+            return False
+        overdue_ns = monotonic_ns() - self._deadline_ns
+        if overdue_ns < 0:
+            return False
+        self._deadline_ns = None
+        if raise_on_timeout:
+            raise RuntimeError(
+                f"Time out occurred {overdue_ns / 1_000_000_000} second(s) ago."
+            )
+        return True
+
+
+class TimerArray:
+    """A whole bunch of TimeoutTimerMonotonics packed into a couple of arrays.
+    Each timer is just an index. Their limits and deadlines sit in contiguous arrays of
+    64-bit nanoseconds, so asking which of them have timed out reads the clock once and
+    goes through all of them in one pass that stays in C, rather than calling a method
+    on every timer.
+
+    Like the single timer, a timer that's reported as timed out goes back to not
+    running, so each timeout only gets reported once."""
+
+    # Deadline of a timer that isn't running. Nothing monotonic_ns() returns reaches it
+    _NOT_RUNNING = 2**63 - 1
+
+    __slots__ = ("_timeouts_ns", "_deadlines_ns")
+
+    def __init__(self) -> None:
+        self._timeouts_ns = array("q")
+        self._deadlines_ns = array("q")
+
+    def __len__(self) -> int:
+        return len(self._timeouts_ns)
+
+    def add(self, timeout_time_sec: float, start: bool = False) -> int:
+        """Returns the index of the new timer."""
+        timeout_ns = _ns_from_sec_(timeout_time_sec)
+        self._timeouts_ns.append(timeout_ns)
+        self._deadlines_ns.append(
+            monotonic_ns() + timeout_ns if start else self._NOT_RUNNING
+        )
+        return len(self._timeouts_ns) - 1
+
+    def get_timeout_time_sec(self, index: int) -> float:
+        return self._timeouts_ns[index] / 1_000_000_000
+
+    def is_active(self, index: int) -> bool:
+        return self._is_running(index, monotonic_ns())
+
+    def start_timer(self, index: int) -> None:
+        now = monotonic_ns()
+        if self._is_running(index, now):
+            raise RuntimeError(
+                "Can't start a timer that has already started. If you want to start ov"
+                "er, reset this timer and start it after that."
+            )
+        self._deadlines_ns[index] = now + self._timeouts_ns[index]
+
+    def start_all(self) -> None:
+        """(Re)starts every timer, whether it was running or not."""
+        now = monotonic_ns()
+        self._deadlines_ns = array("q", [now + t for t in self._timeouts_ns])
+
+    def reset(self, index: int) -> None:
+        self._deadlines_ns[index] = self._NOT_RUNNING
+
+    def _is_running(self, index: int, now: int) -> bool:
+        deadline_ns = self._deadlines_ns[index]
+        return deadline_ns != self._NOT_RUNNING and now < deadline_ns
+
+    def timed_out(self) -> List[int]:
+        """Returns the indexes of the timers that have timed out since the last call,
+        in index order."""
+        deadlines_ns = self._deadlines_ns
+        indexes = list(
+            compress(range(len(deadlines_ns)), map(monotonic_ns().__ge__, deadlines_ns))
+        )
+        for index in indexes:
+            deadlines_ns[index] = self._NOT_RUNNING
+        return indexes
+
+
+class PendingTimeout(Generic[_Item]):
+    """What DeadlineManager.add gives back, so you can cancel the timeout later on."""
+
+    __slots__ = ("item", "deadline", "_manager", "_done")
+
+    def __init__(
+        self, manager: "DeadlineManager[_Item]", item: _Item, deadline: float
+    ) -> None:
+        self.item = item
+        # On the manager's clock, which is monotonic by default (not a unix timestamp)
+        self.deadline = deadline
+        self._manager = manager
+        self._done = False
+
+    def cancel(self) -> bool:
+        return self._manager.cancel(self)
+
+    def is_pending(self) -> bool:
+        return not self._done
+
+
+class DeadlineManager(Generic[_Item]):
+    """Use this class to keep track of lots of timeouts at once.
+    Where TimeoutTimerPassive is one timer per thing you're waiting on and has to be
+    polled one by one, this keeps every deadline in a single heap. Adding a timeout
+    costs O(log N), cancelling one costs O(1), and expired() hands back just the items
+    that have timed out, so checking on tens of thousands of in-flight operations
+    doesn't mean looking at every one of them.
+
+    There are two ways of using it:
+    - Passively, by calling expired() every now and then (e.g. once per tick of your
+      event loop) and dealing with whatever it returns.
+    - Actively, by giving it a callback and calling start() (or using it as a context
+      manager). A background thread then sleeps until the next deadline and calls the
+      callback with each item as it expires. The callback runs on that thread, so keep
+      it short and don't let it raise; if it does, the traceback gets printed and the
+      thread keeps going.
+
+    Arguments:
+    callback -- What to call with each expired item in active mode
+    clock -- Where the time comes from, in seconds. Defaults to time.monotonic, so
+             changes to the system clock don't make everything time out at once"""
+
+    # Cancelled timeouts are left in the heap until they reach the top. When they make
+    # up more than this fraction of it, the heap gets rebuilt without them.
+    _COMPACTION_RATIO = 0.5
+    _COMPACTION_MIN_SIZE = 64
+
+    def __init__(
+        self,
+        callback: Optional[Callable[[_Item], Any]] = None,
+        clock: Callable[[], float] = monotonic,
+    ) -> None:
+        self._callback = callback
+        self._clock = clock
+        self._heap: List[Tuple[float, int, PendingTimeout[_Item]]] = []
+        self._seq = count()
+        self._cancelled_count = 0
+        self._condition = Condition()
+        self._thread: Optional[Thread] = None
+        self._stopping = False
+
+    def __enter__(self) -> "DeadlineManager[_Item]":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._heap) - self._cancelled_count
+
+    def add(self, item: _Item, timeout_sec: float) -> PendingTimeout[_Item]:
+        if timeout_sec <= 0:
+            raise RuntimeError(
+                "Timeout limit cannot be "
+                f"{'negative' if timeout_sec < 0 else 'zero'}."
+            )
+        return self.add_at(item, self._clock() + timeout_sec)
+
+    def add_at(self, item: _Item, deadline: float) -> PendingTimeout[_Item]:
+        pending = PendingTimeout(self, item, deadline)
+        with self._condition:
+            heappush(self._heap, (deadline, next(self._seq), pending))
+            # Only wake the background thread if it'd otherwise oversleep this one
+            if self._heap[0][2] is pending:
+                self._condition.notify()
+        return pending
+
+    def cancel(self, pending: PendingTimeout[_Item]) -> bool:
+        """Returns whether the timeout was still pending (i.e. False if it already
+        expired or got cancelled before)."""
+        with self._condition:
+            if pending._done or pending._manager is not self:
+                return False
+            pending._done = True
+            self._cancelled_count += 1
+            if (
+                len(self._heap) >= self._COMPACTION_MIN_SIZE
+                and self._cancelled_count > len(self._heap) * self._COMPACTION_RATIO
+            ):
+                self._compact()
+            return True
+
+    def next_deadline(self) -> Optional[float]:
+        with self._condition:
+            self._drop_cancelled_at_top()
+            return self._heap[0][0] if self._heap else None
+
+    def expired(self) -> List[_Item]:
+        """Returns the items whose deadlines have passed, earliest first, and forgets
+        about them."""
+        with self._condition:
+            return self._pop_expired(self._clock())
+
+    def start(self) -> None:
+        if self._callback is None:
+            raise ValueError("Need a callback to call when things expire.")
+        with self._condition:
+            if self._thread is not None:
+                raise RuntimeError("Already started.")
+            self._stopping = False
+            self._thread = Thread(
+                target=self._fire_callbacks, name="DeadlineManager", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the background thread. Whatever hasn't expired yet stays put, so you
+        can still call expired() or start() again afterwards."""
+        with self._condition:
+            thread = self._thread
+            self._stopping = True
+            self._condition.notify()
+        if thread is not None:
+            thread.join()
+        with self._condition:
+            self._thread = None
+
+    def _fire_callbacks(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    now = self._clock()
+                    self._drop_cancelled_at_top()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._condition.wait(self._heap[0][0] - now if self._heap else None)
+                if self._stopping:
+                    return
+                items = self._pop_expired(now)
+            for item in items:
+                try:
+                    self._callback(item)  # type: ignore
+                except Exception:
+                    print_exc()
+
+    def _pop_expired(self, now: float) -> List[_Item]:
+        heap = self._heap
+        items = []
+        while heap and heap[0][0] <= now:
+            pending = heappop(heap)[2]
+            if pending._done:
+                self._cancelled_count -= 1
+                continue
+            pending._done = True
+            items.append(pending.item)
+        return items
+
+    def _drop_cancelled_at_top(self) -> None:
+        heap = self._heap
+        while heap and heap[0][2]._done:
+            heappop(heap)
+            self._cancelled_count -= 1
+
+    def _compact(self) -> None:
+        self._heap = [entry for entry in self._heap if not entry[2]._done]
+        heapify(self._heap)
+        self._cancelled_count = 0
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised by work that was asked to happen after the deadline it's under passed."""
+
+
+class Deadline:
+    """A point in (monotonic) time by which a whole job has to be done, however many
+    calls and threads it's spread over. Rather than being passed around, it's put in
+    effect with deadline_after_ and picked up with Deadline.current() by whatever
+    runs under it:
+
+        with deadline_after_(30):
+            download_file_from_(url, dest_dir)  # Gives up once the 30 seconds are up
+            ...
+
+    It's kept in a context variable, so asyncio tasks created under it are under it
+    too. Threads aren't unless they run in a copy of the context (see
+    contextvars.copy_context), which is what this package's own thread pools do."""
+
+    __slots__ = ("_deadline_ns",)
+
+    def __init__(self, timeout_sec: float) -> None:
+        self._deadline_ns = monotonic_ns() + _ns_from_sec_(timeout_sec)
+
+    @staticmethod
+    def current() -> Optional["Deadline"]:
+        """Returns the deadline in effect, if any."""
+        return _current_deadline.get()
+
+    @staticmethod
+    def timeout_sec_for_(timeout_sec: Optional[float] = None) -> Optional[float]:
+        """Returns what to time a blocking call out after: timeout_sec or what's left
+        of the deadline in effect, whichever is shorter (None if there's neither).
+        Raises DeadlineExceeded if the deadline's passed already."""
+        deadline = _current_deadline.get()
+        if deadline is None:
+            return timeout_sec
+        remaining_sec = deadline.remaining_sec()
+        if remaining_sec <= 0:
+            raise DeadlineExceeded("The deadline has passed.")
+        return remaining_sec if timeout_sec is None else min(timeout_sec, remaining_sec)
+
+    def remaining_sec(self) -> float:
+        return max(0.0, (self._deadline_ns - monotonic_ns()) / 1_000_000_000)
+
+    def expired(self) -> bool:
+        return monotonic_ns() >= self._deadline_ns
+
+    def check(self) -> None:
+        if self.expired():
+            raise DeadlineExceeded("The deadline has passed.")
+
+
+_current_deadline: ContextVar[Optional[Deadline]] = ContextVar(
+    "_current_deadline", default=None
+)
+
+
+@contextmanager
+def deadline_after_(timeout_sec: float) -> Iterator[Deadline]:
+    """Puts a deadline of timeout_sec from now in effect for the duration of the
+    with-block, and yields the one in effect. A deadline that's already in effect and
+    sooner stays in effect, so nested calls can only ever shorten the time left."""
+    deadline = Deadline(timeout_sec)
+    outer = _current_deadline.get()
+    if outer is not None and outer._deadline_ns <= deadline._deadline_ns:
+        deadline = outer
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+class LatencyHistogram:
+    """Counts latencies (in nanoseconds) HDR histogram style: into buckets that are
+    exact below 128 ns and from there on are 1/64th of a power of two wide, so any
+    percentile it gives is within about 1.6% of the real one, from nanoseconds to
+    centuries. Recording is O(1) and the whole thing is a few KiB however much gets
+    recorded. It's safe to record into from many threads."""
+
+    # Values below 2 ** _PRECISION_BITS get a bucket each; after that, every power of
+    # two is split into half that many buckets
+    _PRECISION_BITS = 7
+    _EXACT = 1 << _PRECISION_BITS
+    _PER_POWER = _EXACT >> 1
+
+    __slots__ = ("_counts", "_count", "_total_ns", "_min_ns", "_max_ns", "_lock")
+
+    def __init__(self) -> None:
+        self._counts = array("q")
+        self._count = 0
+        self._total_ns = 0
+        self._min_ns = 0
+        self._max_ns = 0
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def record(self, value_ns: int) -> None:
+        if value_ns < 0:
+            value_ns = 0
+        if value_ns < self._EXACT:
+            index = value_ns
+        else:
+            shift = value_ns.bit_length() - self._PRECISION_BITS
+            index = self._EXACT + (shift - 1) * self._PER_POWER
+            index += (value_ns >> shift) - self._PER_POWER
+        with self._lock:
+            counts = self._counts
+            if index >= len(counts):
+                counts.frombytes(bytes(8 * (index + 1 - len(counts))))
+            counts[index] += 1
+            if not self._count or value_ns < self._min_ns:
+                self._min_ns = value_ns
+            if value_ns > self._max_ns:
+                self._max_ns = value_ns
+            self._count += 1
+            self._total_ns += value_ns
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        with other._lock:
+            counts = array("q", other._counts)
+            count, total_ns = other._count, other._total_ns
+            min_ns, max_ns = other._min_ns, other._max_ns
+        if not count:
+            return
+        with self._lock:
+            if len(counts) > len(self._counts):
+                self._counts.frombytes(bytes(8 * (len(counts) - len(self._counts))))
+            for index, n in enumerate(counts):
+                self._counts[index] += n
+            self._min_ns = min_ns if not self._count else min(self._min_ns, min_ns)
+            self._max_ns = max(self._max_ns, max_ns)
+            self._count += count
+            self._total_ns += total_ns
+
+    def percentile_ns(self, percentile: float) -> int:
+        """Returns the latency at or below which the given percent of those recorded
+        are (0 if there are none). The top of a bucket stands in for everything in it,
+        clamped to the largest recorded."""
+        with self._lock:
+            if not self._count:
+                return 0
+            rank = max(1, -(-self._count * percentile // 100))
+            seen = 0
+            for index, n in enumerate(self._counts):
+                seen += n
+                if seen >= rank:
+                    return min(self._max_ns, self._bucket_top_(index))
+            return self._max_ns
+
+    def summary(self) -> Dict[str, float]:
+        """The count plus the usual latency figures, in seconds."""
+        with self._lock:
+            count, total_ns = self._count, self._total_ns
+            min_ns, max_ns = self._min_ns, self._max_ns
+        summary = {
+            "count": count,
+            "total_sec": total_ns / 1_000_000_000,
+            "mean_sec": total_ns / count / 1_000_000_000 if count else 0.0,
+            "min_sec": min_ns / 1_000_000_000,
+        }
+        for percentile, name in ((50, "p50"), (90, "p90"), (99, "p99"), (99.9, "p999")):
+            summary[f"{name}_sec"] = self.percentile_ns(percentile) / 1_000_000_000
+        summary["max_sec"] = max_ns / 1_000_000_000
+        return summary
+
+    @classmethod
+    def _bucket_top_(cls, index: int) -> int:
+        if index < cls._EXACT:
+            return index
+        shift, mantissa = divmod(index - cls._EXACT, cls._PER_POWER)
+        shift += 1
+        return ((mantissa + cls._PER_POWER + 1) << shift) - 1
+
+
+class _Span:
+    __slots__ = ("_histogram", "_started_ns")
+
+    def __init__(self, histogram: LatencyHistogram) -> None:
+        self._histogram = histogram
+
+    def __enter__(self) -> "_Span":
+        self._started_ns = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self._histogram.record(perf_counter_ns() - self._started_ns)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        return None
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Profiler:
+    """Times named spans of code into a LatencyHistogram per name:
+
+        with profiler.span("parsing"):
+            ...
+
+    While disabled (which it starts out as), span hands back one shared do-nothing
+    context manager, so instrumented code costs about one method call per span. This
+    package's own hot paths (downloads, creating and deleting working directories,
+    listing the bundle) report into the module's profiler; enable it to see where
+    their time goes."""
+
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._lock = Lock()
+
+    def span(self, name: str) -> ContextManager[Any]:
+        if not self.enabled:
+            return _NO_SPAN
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, LatencyHistogram())
+        return _Span(histogram)
+
+    def histogram(self, name: str) -> Optional[LatencyHistogram]:
+        return self._histograms.get(name)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """Every span's summary (see LatencyHistogram.summary), by name."""
+        with self._lock:
+            histograms = dict(self._histograms)
+        return {name: histogram.summary() for name, histogram in histograms.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms = {}
+
+
+# What this package's own hot paths report into
+profiler = Profiler()
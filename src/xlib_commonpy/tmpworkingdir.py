@@ -1,11 +1,629 @@
+import os
+import re
+from atexit import register
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import count
 from pathlib import Path
-from shutil import rmtree
+from queue import Full, Queue
+from random import getrandbits
+from shutil import copyfile, rmtree
+from stat import S_IMODE
 from sys import executable
-from typing import Any
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, time, time_ns
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 # Operations here are tied to the file system, and uuid1 basically prevents collisions
 # with respect to the host
-from uuid import uuid1
+from uuid import UUID, getnode
+
+from ._reflink import try_cloning_
+from .time_related import Deadline, profiler
+
+try:
+    from fcntl import LOCK_EX, LOCK_NB, flock
+except ImportError:  # Windows
+    flock = None  # type: ignore
+
+# The most tombstones that may wait for the reaper before deletions happen inline again
+_MAX_PENDING_DELETIONS = 1024
+# Tells apart tombstones of the same working directory (which can be deleted many times)
+_tombstone_numbers = count()
+# Threads that trees are deleted with. Deleting is mostly waiting on the file system, so
+# more threads than cores pays off, especially on network and overlay file systems.
+_DELETION_WORKERS = 16
+# How many files of one directory a single task unlinks before handing the rest out
+_UNLINK_BATCH_SIZE = 256
+# Deleting relative to directory descriptors needs support that Windows lacks
+_CAN_DELETE_WITH_DIR_FD = (
+    os.unlink in os.supports_dir_fd
+    and os.scandir in os.supports_fd
+    and hasattr(os, "O_DIRECTORY")
+    and hasattr(os, "O_NOFOLLOW")
+)
+_deletion_executor: Optional[ThreadPoolExecutor] = None
+_deletion_executor_lock = Lock()
+# Names of working directories (with who owns them, if they're of a version that says),
+# and of what they get renamed to
+_WORKINGDIR_NAME = re.compile(
+    r"(_tmp_.*?_(?:(\d+-[0-9a-f]{8})_)?"
+    r"([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}))"
+    r"(\.deleting\d+|\.quarantined)?"
+)
+# Lockfiles saying an owner's working directories next to them are still in use
+_OWNER_LOCK_NAME = re.compile(r"_tmp_owner_(\d+-[0-9a-f]{8})\.lock")
+# 100 ns intervals from when uuid1 timestamps start (1582-10-15) to the Unix epoch
+_UUID1_EPOCH_OFFSET = 0x01B21DD213814000
+# Orphaned working directories deleted at once when sweeping (each with many threads)
+_SWEEPING_WORKERS = 8
+# Threads that templates are copied with, for the same reasons as deleting
+_SEEDING_WORKERS = 16
+_seeding_executor: Optional[ThreadPoolExecutor] = None
+_seeding_executor_lock = Lock()
+# Where RAM-backed file systems are conventionally mounted for everyone to use
+_RAM_BACKED_DIRPATHS = (Path("/dev/shm"), Path("/run/shm"))
+_RAM_BACKED_FS_TYPES = frozenset(("tmpfs", "ramfs"))
+# Directory modification times this recent can't be trusted to change with the next
+# modification, since file systems take them from a clock that only ticks every so often
+_RACY_MTIME_NS = 50 * 10**6
+
+
+class _DirToDelete:
+    """A directory of a tree being deleted, which can be removed itself once none of
+    the work on what's inside it is pending."""
+
+    def __init__(self, path: str, parent: Optional["_DirToDelete"]) -> None:
+        self.path = path
+        self.parent = parent
+        self.pending = 1  # For scanning it
+
+
+class _TreeDeletion:
+    """Deletes a directory tree by scanning each directory once, unlinking its files
+    relative to its descriptor, and handing its subdirectories and big batches of its
+    files to the deletion threads. Directories are removed as soon as everything inside
+    them is, so no task ever waits on another (which could starve the threads)."""
+
+    def __init__(self, path: str, executor: ThreadPoolExecutor) -> None:
+        self._executor = executor
+        self._lock = Lock()
+        self._finished = Event()
+        self._errors: List[OSError] = []
+        self._root = _DirToDelete(path, parent=None)
+
+    def run(self) -> None:
+        # Scanning the top directory here spares small trees the trip to the threads
+        self._scan(self._root)
+        self._finished.wait()
+        if self._errors:
+            raise self._errors[0]
+
+    def _scan(self, node: _DirToDelete) -> None:
+        # Carrying on with a subdirectory here rather than handing all of them out
+        # saves a trip through the threads per level, which is what deep trees cost
+        next_node: Optional[_DirToDelete] = node
+        while next_node is not None:
+            next_node = self._scan_one(next_node)
+
+    def _scan_one(self, node: _DirToDelete) -> Optional[_DirToDelete]:
+        """Returns a subdirectory left for the caller to scan next, if there is one."""
+        try:
+            # No following symlinks, which could point anywhere
+            fd = os.open(node.path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+        except OSError as e:
+            self._fail(node, e)
+            return None
+        scan_next = None
+        try:
+            filenames = []
+            subdirs = []
+            with os.scandir(fd) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(
+                            _DirToDelete(os.path.join(node.path, entry.name), node)
+                        )
+                    else:
+                        filenames.append(entry.name)
+            batches = [
+                filenames[start : start + _UNLINK_BATCH_SIZE]
+                for start in range(0, len(filenames), _UNLINK_BATCH_SIZE)
+            ]
+            with self._lock:
+                node.pending += max(0, len(batches) - 1) + len(subdirs)
+            if subdirs:
+                scan_next = subdirs.pop()
+            for subdir in subdirs:
+                self._submit(self._scan, subdir)
+            for batch in batches[1:]:
+                self._submit(self._unlink_batch, node, batch)
+            if batches:
+                self._unlink_all_(fd, batches[0])
+        except OSError as e:
+            self._errors.append(e)
+        finally:
+            os.close(fd)
+        self._finish_one(node)
+        return scan_next
+
+    def _submit(self, task: Callable[..., None], *args: Any) -> None:
+        try:
+            self._executor.submit(task, *args)
+        except RuntimeError:
+            # The threads are gone when the interpreter's exiting (e.g. when deferred
+            # deletions are drained then), but what's started still has to finish
+            task(*args)
+
+    def _unlink_batch(self, node: _DirToDelete, filenames: List[str]) -> None:
+        try:
+            fd = os.open(node.path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+            try:
+                self._unlink_all_(fd, filenames)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            self._errors.append(e)
+        self._finish_one(node)
+
+    def _unlink_all_(self, dir_fd: int, filenames: List[str]) -> None:
+        for filename in filenames:
+            try:
+                os.unlink(filename, dir_fd=dir_fd)
+            except FileNotFoundError:
+                pass  # Something else deleted it first, which is just as good
+            except OSError as e:
+                self._errors.append(e)  # But the rest of them can still go
+
+    def _finish_one(self, node: Optional[_DirToDelete]) -> None:
+        while node is not None:
+            with self._lock:
+                node.pending -= 1
+                if node.pending:
+                    return
+            try:
+                os.rmdir(node.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self._errors.append(e)
+            if node.parent is None:
+                self._finished.set()
+            node = node.parent
+
+    def _fail(self, node: _DirToDelete, error: OSError) -> None:
+        # Subdirectories that vanish were deleted by something else, which is fine
+        if not isinstance(error, FileNotFoundError) or node.parent is None:
+            self._errors.append(error)
+        # Whatever's inside stays, so removing it (and so its parents) fails too, but
+        # the rest of the tree still gets deleted
+        self._finish_one(node)
+
+
+def _delete_tree_(dirpath: str) -> None:
+    """Deletes a directory and everything in it, like shutil.rmtree, but with many
+    threads. Raises FileNotFoundError if there's no such directory, and otherwise the
+    first error it ran into once it's deleted all it could."""
+    if not _CAN_DELETE_WITH_DIR_FD:
+        rmtree(dirpath)
+        return
+    global _deletion_executor
+    with _deletion_executor_lock:
+        if _deletion_executor is None:
+            _deletion_executor = ThreadPoolExecutor(
+                max_workers=_DELETION_WORKERS,
+                thread_name_prefix="TMPWorkingDir deleter",
+            )
+    _TreeDeletion(dirpath, _deletion_executor).run()
+
+
+def _seed_from_(dirpath_template: Path, dirpath: Path) -> None:
+    """Fills a directory (which must exist) with the tree of a template directory. Each
+    file is reflinked if the file system can, hard-linked if it's read-only (sharing
+    is safe when nobody's meant to write it), and copied otherwise, with the copies
+    made on many threads. Symlinks are recreated as they are. Directories are left
+    writable whatever the template's are, so that the working directory can still be
+    deleted."""
+    global _seeding_executor
+    with _seeding_executor_lock:
+        if _seeding_executor is None:
+            _seeding_executor = ThreadPoolExecutor(
+                max_workers=_SEEDING_WORKERS,
+                thread_name_prefix="TMPWorkingDir seeder",
+            )
+    futures = []
+    pending = [(str(dirpath_template), str(dirpath))]
+    try:
+        while pending:
+            dirpath_src, dirpath_dest = pending.pop()
+            with os.scandir(dirpath_src) as entries:
+                for entry in entries:
+                    path_dest = os.path.join(dirpath_dest, entry.name)
+                    if entry.is_symlink():
+                        os.symlink(os.readlink(entry.path), path_dest)
+                    elif entry.is_dir():
+                        os.mkdir(path_dest)
+                        pending.append((entry.path, path_dest))
+                    else:
+                        mode = entry.stat().st_mode
+                        try:
+                            futures.append(
+                                _seeding_executor.submit(
+                                    _seed_file_, entry.path, path_dest, mode
+                                )
+                            )
+                        except RuntimeError:
+                            # The interpreter's exiting, so there are no threads to use
+                            _seed_file_(entry.path, path_dest, mode)
+    finally:
+        # Even when failing, what's been handed out has to finish first, or it could
+        # still be writing while the working directory's deleted
+        errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+
+
+def _seed_file_(fpath_src: str, fpath_dest: str, mode: int) -> None:
+    with open(fpath_src, "rb") as fin, open(fpath_dest, "xb") as fout:
+        if try_cloning_(fin, fout):
+            os.chmod(fpath_dest, S_IMODE(mode))
+            return
+    if not mode & 0o222:
+        # Opening it claimed the name, so it has to be removed for the link to take it
+        os.unlink(fpath_dest)
+        try:
+            os.link(fpath_src, fpath_dest)
+            return
+        except OSError:
+            pass  # Across file systems, or on one without hard links
+    # Uses the kernel's copying (e.g. sendfile) where there is any
+    copyfile(fpath_src, fpath_dest)
+    os.chmod(fpath_dest, S_IMODE(mode))
+
+
+class _Naming:
+    """Makes working directory names, "_tmp_<executable>_<owner>_<uuid1>", where the
+    owner is the PID and a random number, which sweeping uses to find the owner's
+    lockfile. The uuid1s are put together here rather than with uuid.uuid1, which can
+    ask libuuid (and through it a daemon or a lockfile) for each one. The node ID is
+    only looked up for the first, the clock sequence is random per process, and
+    timestamps are bumped past the last one when the clock hasn't moved, which leaves a
+    clock read and some formatting."""
+
+    def __init__(self) -> None:
+        self._prefix = "_tmp_" + Path(executable).stem + "_"
+        self.reseed()
+        self._last_timestamp = 0
+
+    def reseed(self) -> None:
+        """Forked children need an owner and a clock sequence of their own, or they'd
+        make the same names as their parent."""
+        self._lock = Lock()
+        self.owner = "%d-%08x" % (os.getpid(), getrandbits(32))
+        self._suffix: Optional[str] = None  # Clock sequence and node
+
+    def is_own(self, name: str) -> bool:
+        """Whether this process made the name (as opposed to its parent, if it's a forked
+        child)."""
+        return name.startswith(self._prefix + self.owner + "_")
+
+    def new(self) -> str:
+        with self._lock:
+            if self._suffix is None:
+                self._suffix = "-%04x-%012x" % (0x8000 | getrandbits(14), getnode())
+            timestamp = max(
+                time_ns() // 100 + _UUID1_EPOCH_OFFSET, self._last_timestamp + 1
+            )
+            self._last_timestamp = timestamp
+            suffix = self._suffix
+        return "%s%s_%08x-%04x-%04x%s" % (
+            self._prefix,
+            self.owner,
+            timestamp & 0xFFFFFFFF,
+            (timestamp >> 32) & 0xFFFF,
+            0x1000 | (timestamp >> 48) & 0x0FFF,
+            suffix,
+        )
+
+
+_naming = _Naming()
+
+
+class _OwnerLocks:
+    """Lockfiles (with the owner's PID in them) that are held for as long as the process
+    is alive, one in each directory it's made working directories in, which is how
+    sweeping tells that the working directories there are still in use. The kernel
+    lets go of the locks however the owner dies. Being next to what they're about, they
+    get found by whoever sweeps, whatever temp directory each of them has."""
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._fds: Dict[str, int] = {}  # By parent directory
+
+    def reseed(self) -> None:
+        """Forked children keep the descriptors they inherited, and so keep the parent's
+        working directories alive too (they may well be using them), but take locks of
+        their own for what they create."""
+        self._lock = Lock()
+        self._fds = {}
+
+    def claim(self, dirpath_parent: Path) -> None:
+        """Makes sure the process holds the lock in the directory, which only costs
+        taking it the first time."""
+        key = str(dirpath_parent)
+        with self._lock:
+            fd = self._fds.get(key)
+            if fd is not None:
+                if os.fstat(fd).st_nlink:
+                    return
+                # Its lockfile got deleted (e.g. along with the directory), so it no
+                # longer says anything to sweeping
+                os.close(fd)
+            self._fds[key] = _take_owner_lock_(dirpath_parent, _naming.owner)
+
+    def release_all(self) -> None:
+        """Lets go of the locks when the interpreter exits, which is only tidier than
+        leaving them to the kernel and to sweeping."""
+        with self._lock:
+            fds, self._fds = self._fds, {}
+        for dirpath_parent, fd in fds.items():
+            fpath = _fpath_owner_lock_for_(Path(dirpath_parent), _naming.owner)
+            try:
+                # Unlinked while still locked so nobody opens it unlocked in between
+                os.unlink(str(fpath))
+            except OSError:
+                pass
+            os.close(fd)
+
+
+_owner_locks = _OwnerLocks()
+# Registered before anything deferred is, so that deferred deletions are drained first
+register(_owner_locks.release_all)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_naming.reseed)
+    os.register_at_fork(after_in_child=_owner_locks.reseed)
+
+
+def _fpath_owner_lock_for_(dirpath_parent: Path, owner: str) -> Path:
+    return dirpath_parent.joinpath("_tmp_owner_" + owner + ".lock")
+
+
+def _take_owner_lock_(dirpath_parent: Path, owner: str) -> int:
+    """Returns the descriptor of the lockfile, making the directory first if need be."""
+    fpath = str(_fpath_owner_lock_for_(dirpath_parent, owner))
+    pid = b"%d\n" % os.getpid()
+    if flock is None:
+        # Windows won't delete files that are open, which sweeping relies on instead
+        try:
+            fd = os.open(fpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileNotFoundError:
+            dirpath_parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(fpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        os.write(fd, pid)
+        return fd
+    # Locked under another name first so that it's never seen unlocked, and then
+    # linked (which fails if the name's taken, unlike renaming) to its own
+    fpath_new = fpath + ".new"
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    try:
+        fd = os.open(fpath_new, flags, 0o644)
+    except FileNotFoundError:
+        dirpath_parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(fpath_new, flags, 0o644)
+    try:
+        flock(fd, LOCK_EX | LOCK_NB)
+        os.write(fd, pid)
+        os.link(fpath_new, fpath)
+    except BaseException:
+        os.close(fd)
+        raise
+    finally:
+        os.unlink(fpath_new)
+    return fd
+
+
+def _owner_is_alive_(dirpath_parent: Path, owner: str) -> bool:
+    """Tells by the owner's lockfile, deleting it if the owner's dead."""
+    fpath = str(_fpath_owner_lock_for_(dirpath_parent, owner))
+    if flock is None:
+        try:
+            os.unlink(fpath)
+        except FileNotFoundError:
+            return False
+        except PermissionError:
+            return True  # Its owner has it open
+        return False
+    try:
+        fd = os.open(fpath, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        try:
+            flock(fd, LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            return True
+        try:
+            if os.stat(fpath).st_ino != os.fstat(fd).st_ino:
+                return True  # The owner let go of it just now and took a new one
+        except FileNotFoundError:
+            return True  # The owner let go of it just now, so it's not an orphan
+        try:
+            os.unlink(fpath)
+        except PermissionError:
+            pass  # Another user's, and they're dead all the same
+        return False
+    finally:
+        os.close(fd)
+
+
+def _sweep_orphans_(
+    dirpath_parent: Path, min_age_sec: float, include_quarantined: bool
+) -> int:
+    node = getnode()
+    # Without a MAC address to go by, the node is random per process and can't tell
+    # which host a working directory is from
+    node_is_random = bool(node & 0x010000000000)
+    oldest_created = time() - min_age_sec
+    reclaimed = 0
+    in_flight: Deque["Future[None]"] = deque()
+    # Owners typically have lots of working directories, so each is only asked once
+    alive: Dict[str, bool] = {}
+
+    def is_alive_(owner: str) -> bool:
+        if owner not in alive:
+            alive[owner] = _owner_is_alive_(dirpath_parent, owner)
+        return alive[owner]
+
+    with ThreadPoolExecutor(
+        max_workers=_SWEEPING_WORKERS, thread_name_prefix="TMPWorkingDir sweeper"
+    ) as executor, os.scandir(str(dirpath_parent)) as entries:
+        # Scanned as a stream, and with only what's in flight kept around, so memory
+        # stays flat however many entries there are
+        for entry in entries:
+            match = _WORKINGDIR_NAME.fullmatch(entry.name)
+            if match is None:
+                match = _OWNER_LOCK_NAME.fullmatch(entry.name)
+                if match is not None:
+                    is_alive_(match.group(1))  # Which deletes it if its owner's dead
+                continue
+            _, owner, uuid_str, suffix = match.groups()
+            if suffix == ".quarantined" and not include_quarantined:
+                continue
+            uuid = UUID(uuid_str)
+            if uuid.version != 1 or not (node_is_random or uuid.node == node):
+                continue  # Lockfiles only say anything about this host
+            created = (uuid.time - _UUID1_EPOCH_OFFSET) / 10**7
+            if created > oldest_created:
+                continue  # Too young to judge without its lockfile
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            # Pools never hand out what they've quarantined again, so whether its owner
+            # is alive doesn't matter. Older versions didn't say who the owner was.
+            if suffix != ".quarantined" and owner is not None and is_alive_(owner):
+                continue
+            in_flight.append(executor.submit(_delete_tree_, entry.path))
+            if len(in_flight) >= 4 * _SWEEPING_WORKERS:
+                reclaimed += in_flight.popleft().exception() is None
+        while in_flight:
+            reclaimed += in_flight.popleft().exception() is None
+    return reclaimed
+
+
+class _Reaper:
+    """Deletes tombstoned working directories on a background thread. The thread starts
+    with the first submission, and whatever's still queued when the interpreter exits
+    gets deleted before it does."""
+
+    def __init__(self, max_pending: int) -> None:
+        self._queue: "Queue[Tuple[Path, Optional[Event]]]" = Queue(maxsize=max_pending)
+        self._done = Condition()
+        self._unfinished = 0
+        self._thread: Optional[Thread] = None
+
+    def submit(self, dirpath: Path, deleted: Optional[Event] = None) -> bool:
+        """Returns False without queueing anything when the queue is full. The event is
+        set once the directory's deleted (or failed to be)."""
+        with self._done:
+            if self._thread is None:
+                self._thread = Thread(
+                    target=self._run, name="TMPWorkingDir reaper", daemon=True
+                )
+                self._thread.start()
+                register(self.drain)
+            try:
+                self._queue.put_nowait((dirpath, deleted))
+            except Full:
+                return False
+            self._unfinished += 1
+            return True
+
+    def drain(self, timeout_sec: Optional[float] = None) -> bool:
+        """Returns whether everything queued got deleted before the timeout."""
+        with self._done:
+            return self._done.wait_for(lambda: not self._unfinished, timeout_sec)
+
+    def _run(self) -> None:
+        while True:
+            dirpath, deleted = self._queue.get()
+            try:
+                _delete_tree_(str(dirpath))
+            except Exception:
+                # Nobody's left to hear about failures; anything left behind is still
+                # recognizable as a tombstone
+                pass
+            if deleted is not None:
+                deleted.set()
+            with self._done:
+                self._unfinished -= 1
+                self._done.notify_all()
+
+
+_reaper = _Reaper(max_pending=_MAX_PENDING_DELETIONS)
+
+
+def _ram_backed_dirpath_() -> Optional[Path]:
+    """Returns the first conventional RAM-backed mount that's usable, if any is."""
+    try:
+        with open("/proc/self/mounts") as mounts:
+            mountpoints = {
+                # Spaces and such in mount points are octal-escaped
+                fields[1].encode().decode("unicode_escape")
+                for fields in (line.split() for line in mounts)
+                if len(fields) > 2 and fields[2] in _RAM_BACKED_FS_TYPES
+            }
+    except OSError:
+        return None  # Not Linux, or no /proc to tell with
+    for dirpath in _RAM_BACKED_DIRPATHS:
+        if str(dirpath.resolve()) in mountpoints and os.access(
+            str(dirpath), os.W_OK | os.X_OK
+        ):
+            return dirpath
+    return None
+
+
+def _bytes_used_by_(dirpath: Path) -> int:
+    """Bytes the files of a directory tree take up (as opposed to their sizes, which is
+    different for sparse files)."""
+    used = 0
+    pending = [str(dirpath)]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except FileNotFoundError:
+            continue  # Deleted while counting
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                used += _bytes_used_for_(stat)
+    return used
+
+
+def _bytes_used_by_file_(fpath: str) -> int:
+    try:
+        return _bytes_used_for_(os.stat(fpath, follow_symlinks=False))
+    except FileNotFoundError:
+        return 0  # Not written yet, or deleted already
+
+
+def _bytes_used_for_(stat: os.stat_result) -> int:
+    # Windows has no st_blocks, but it has no tmpfs either
+    return getattr(stat, "st_blocks", stat.st_size // 512) * 512
 
 
 class TMPWorkingDir:
@@ -21,18 +639,81 @@ class TMPWorkingDir:
     def dirpath(self) -> Path:
         return self._DIRPATH_CURRENT
 
-    def __init__(self, dirpath_parent: Path = Path().absolute()) -> None:
+    @property
+    def spill_dirpath(self) -> Optional[Path]:
+        """Where files go once the memory budget's used up, or None if the working
+        directory isn't in memory to begin with."""
+        return self._DIRPATH_SPILL
+
+    @property
+    def memory_bytes_used(self) -> int:
+        """How much memory the working directory's taking up (0 if it's not in
+        memory). It's kept as a running total rather than counted each time, so it
+        costs the same however many files there are: the last file filepath_for handed
+        out is counted as what it takes up (or as its size hint, if that's more), and
+        those before it as they were when the next one was handed out. Files that
+        change after that are only seen once filepath_for would otherwise spill and the
+        directory's changed since it last counted them all."""
+        if self._DIRPATH_SPILL is None:
+            return 0
+        self._settle_last_handed_out()
+        return self._memory_counted_bytes + self._memory_handed_out_bytes
+
+    def __init__(
+        self,
+        dirpath_parent: Optional[Path] = None,
+        defer_deletion: bool = False,
+        memory_budget_bytes: Optional[int] = None,
+        dirpath_memory: Optional[Path] = None,
+        dirpath_template: Optional[Path] = None,
+    ) -> None:
         """This does not create the working directory. You may use a with-statement to
         do that, or simply call the specific method.
 
         Arguments:
         dirpath_parent -- the parent directory for which the working directory to be
-            managed will be created within (default directory is just a folder next to
-            the Python script)
+            managed will be created within (default directory is the current working
+            directory at the time, i.e. Path's default location)
+        defer_deletion -- deleting only renames the working directory out of the way
+            (to a tombstone next to it), and a background thread deletes it from there.
+            That makes deleting big working directories instant for the caller. See
+            drain for waiting on the background deletions.
+        memory_budget_bytes -- put the working directory on a RAM-backed file system
+            (like tmpfs on /dev/shm) when one's available, for scratch files to be read
+            and written at memory speed. Once it takes up this many bytes, filepath_for
+            hands out paths in a directory of the same name in dirpath_parent instead.
+            Without a RAM-backed file system, it's just a normal working directory.
+        dirpath_memory -- the RAM-backed mount to use (default is to look for one in
+            the usual places, which is only done on Linux)
+        dirpath_template -- creating the working directory fills it with the contents
+            of this directory. Files are shared copy-on-write where the file system
+            supports reflinks (Btrfs, XFS, ...), so that seeding costs about the same
+            however big the template is. Read-only files are hard-linked otherwise,
+            and the rest are copied in parallel. Mind that a hard-linked file is the
+            template's own file, so don't make it writable and change it.
         """
-        self._DIRPATH_CURRENT = dirpath_parent.absolute().joinpath(
-            "_tmp_" + Path(executable).stem + "_" + str(uuid1())
-        )
+        if dirpath_parent is None:
+            dirpath_parent = Path()
+        dirname = _naming.new()
+        self._DIRPATH_CURRENT = dirpath_parent.absolute().joinpath(dirname)
+        self._DIRPATH_SPILL: Optional[Path] = None
+        self._MEMORY_BUDGET_BYTES = memory_budget_bytes
+        if memory_budget_bytes is not None:
+            if dirpath_memory is None:
+                dirpath_memory = _ram_backed_dirpath_()
+            if dirpath_memory is not None:
+                self._DIRPATH_SPILL = self._DIRPATH_CURRENT
+                self._DIRPATH_CURRENT = dirpath_memory.absolute().joinpath(dirname)
+        # What was in memory when last counted, along with when the working directory
+        # was last modified then, plus what's been handed out since
+        self._memory_counted_bytes = 0
+        self._memory_counted_mtime_ns: Optional[int] = None
+        self._memory_handed_out_bytes = 0
+        # The last file handed out in memory, its size hint, and what it's counted as
+        self._memory_last_handed_out: Optional[Tuple[str, int, int]] = None
+        self._DEFER_DELETION = defer_deletion
+        self._DIRPATH_TEMPLATE = dirpath_template
+        self._created = False
 
     def __enter__(self) -> "TMPWorkingDir":
         self.create_workingdir()
@@ -41,15 +722,468 @@ class TMPWorkingDir:
     def __exit__(self, *args: Any) -> None:
         self.delete_workingdir()
 
+    @staticmethod
+    def drain(timeout_sec: Optional[float] = None) -> bool:
+        """Waits for deferred deletions to finish and returns whether they all did
+        before the timeout (default is to wait as long as it takes). Those still
+        pending when the interpreter exits are waited on regardless."""
+        return _reaper.drain(timeout_sec)
+
+    @staticmethod
+    def sweep_orphans(
+        dirpath_parent: Optional[Path] = None,
+        min_age_sec: float = 60,
+        include_quarantined: bool = False,
+    ) -> int:
+        """Deletes working directories (and their tombstones) in dirpath_parent that
+        were left behind by processes that died without cleaning up (e.g. that got
+        SIGKILLed), and returns how many it deleted. It's meant to be run at startup.
+
+        Only names are looked at to pick out candidates, and their owners' lockfiles
+        (which are in dirpath_parent too, and which names say the owner of) to tell
+        whether they're orphans, so nothing inside any of them gets looked at unless
+        it's deleted. That and deleting many at once keeps it quick on directories with
+        millions of entries. Lockfiles left by dead owners are deleted along the way.
+
+        Arguments:
+        dirpath_parent -- where to look (same default as the working directories')
+        min_age_sec -- leave alone working directories named less than this long ago
+            (uuid1 says when). That's for those of older versions, whose names don't
+            say who owns them, and it saves looking at the lockfiles of the youngest.
+        include_quarantined -- also delete what pools quarantined, which is otherwise
+            left for people to look into (even if the pool's process is still alive,
+            since it never uses them again)
+        """
+        return _sweep_orphans_(
+            Path() if dirpath_parent is None else dirpath_parent,
+            min_age_sec,
+            include_quarantined,
+        )
+
     def create_workingdir(self) -> Path:
-        self._DIRPATH_CURRENT.absolute().mkdir(exist_ok=True, parents=True)
-        return self._DIRPATH_CURRENT
+        """Creates the working directory with O_EXCL semantics like tempfile.mkdtemp
+        does: if something else has taken its name, it's given a new one (so dirpath
+        changes) rather than shared. Creating it again before deleting it is fine, and
+        leaves it as it is. If seeding it from the template fails, it's deleted again.
+
+        Raises DeadlineExceeded rather than creating anything if the deadline in effect
+        (see time_related.deadline_after_) has passed."""
+        with profiler.span("TMPWorkingDir.create_workingdir"):
+            deadline = Deadline.current()
+            if deadline is not None:
+                deadline.check()
+            if not self._created and not _naming.is_own(self._DIRPATH_CURRENT.name):
+                # Named before a fork, so the name says it's the parent's
+                self._rename(_naming.new())
+            while True:
+                try:
+                    _owner_locks.claim(self._DIRPATH_CURRENT.parent)
+                    self._DIRPATH_CURRENT.mkdir(parents=True)
+                    made = True
+                    break
+                except FileExistsError:
+                    if self._created:
+                        made = False
+                        break  # It's this one's own, and it's been seeded already
+                    self._rename(_naming.new())
+            self._created = True
+            if made and self._DIRPATH_TEMPLATE is not None:
+                try:
+                    _seed_from_(self._DIRPATH_TEMPLATE, self._DIRPATH_CURRENT)
+                except BaseException:
+                    # Raised from __enter__, there'd be no __exit__ to clean it up
+                    self.delete_workingdir()
+                    raise
+            return self._DIRPATH_CURRENT
+
+    def filepath_for(self, filename: str, size_hint: int = 0) -> Path:
+        """Returns where to put a new file: in the working directory while it's within
+        the memory budget, and in the spill directory once it's not (or once the
+        RAM-backed file system itself is running out of room). Give size_hint when the
+        file's size is known up front so that files too big for what's left go straight
+        to disk."""
+        dirpath_spill = self._DIRPATH_SPILL
+        if dirpath_spill is None:
+            return self._DIRPATH_CURRENT.joinpath(filename)
+        if self._fits_in_memory(size_hint):
+            fpath = self._DIRPATH_CURRENT.joinpath(filename)
+            self._memory_last_handed_out = (str(fpath), size_hint, size_hint)
+            self._memory_handed_out_bytes += size_hint
+            return fpath
+        _owner_locks.claim(dirpath_spill.parent)
+        dirpath_spill.mkdir(exist_ok=True, parents=True)
+        return dirpath_spill.joinpath(filename)
+
+    def _fits_in_memory(self, size: int) -> bool:
+        assert self._MEMORY_BUDGET_BYTES is not None
+        remaining = self._MEMORY_BUDGET_BYTES - self.memory_bytes_used
+        if (remaining <= 0 or size > remaining) and self._recount_memory():
+            # Files may have been deleted (or shrunk) since, making room
+            remaining = self._MEMORY_BUDGET_BYTES - self.memory_bytes_used
+        if remaining <= 0 or size > remaining:
+            return False
+        if not hasattr(os, "statvfs"):
+            return True  # Nothing to check with on Windows
+        # The budget's moot if the memory's not actually there. Asked of the mount
+        # rather than the working directory, which may not have been created yet.
+        stat = os.statvfs(str(self._DIRPATH_CURRENT.parent))
+        return size < stat.f_bavail * stat.f_frsize
+
+    def _settle_last_handed_out(self) -> None:
+        if self._memory_last_handed_out is None:
+            return
+        fpath, size_hint, counted = self._memory_last_handed_out
+        # What's hinted at is kept for it while it's being written
+        used = max(_bytes_used_by_file_(fpath), size_hint)
+        self._memory_handed_out_bytes += used - counted
+        self._memory_last_handed_out = (fpath, size_hint, used)
+
+    def _recount_memory(self) -> bool:
+        """Counts what's in memory from scratch, unless nothing's been added to or
+        deleted from the working directory since it last was. Returns whether it did."""
+        try:
+            mtime_ns = os.stat(str(self._DIRPATH_CURRENT)).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        if mtime_ns is not None and mtime_ns == self._memory_counted_mtime_ns:
+            return False
+        self._memory_counted_bytes = _bytes_used_by_(self._DIRPATH_CURRENT)
+        self._memory_handed_out_bytes = 0
+        if self._memory_last_handed_out is not None:
+            # Counting only saw what's been written of it so far
+            fpath, size_hint, _ = self._memory_last_handed_out
+            written = _bytes_used_by_file_(fpath)
+            self._memory_handed_out_bytes = max(0, size_hint - written)
+            self._memory_last_handed_out = (fpath, size_hint, max(written, size_hint))
+        if mtime_ns is not None and time_ns() - mtime_ns < _RACY_MTIME_NS:
+            mtime_ns = None  # The next change might not show, so it's counted again
+        self._memory_counted_mtime_ns = mtime_ns
+        return True
 
     def delete_workingdir(self):
+        """Under a deadline (see time_related.deadline_after_), this waits on deleting
+        only as long as what's left of it, and leaves the rest to happen in the
+        background like with defer_deletion."""
+        with profiler.span("TMPWorkingDir.delete_workingdir"):
+            self._created = False
+            deadline = Deadline.current()
+            for dirpath in (self._DIRPATH_CURRENT, self._DIRPATH_SPILL):
+                if dirpath is None:
+                    continue
+                if self._DEFER_DELETION:
+                    self._tombstone_(dirpath)
+                    continue
+                if deadline is not None:
+                    self._tombstone_(dirpath, deadline)
+                    continue
+                try:
+                    _delete_tree_(str(dirpath.resolve()))
+                except FileNotFoundError:
+                    pass  # It's ok if it's not there; it's already been cleaned up
+
+    def _rename(self, dirname: str) -> None:
+        self._DIRPATH_CURRENT = self._DIRPATH_CURRENT.with_name(dirname)
+        if self._DIRPATH_SPILL is not None:
+            self._DIRPATH_SPILL = self._DIRPATH_SPILL.with_name(dirname)
+        self._created = False
+
+    @staticmethod
+    def _tombstone_(dirpath: Path, deadline: Optional[Deadline] = None) -> None:
+        """Hands the directory to the reaper, and then waits for it to be deleted
+        until the deadline if there is one."""
+        dirpath_tombstone = dirpath.with_name(
+            "{}.deleting{}".format(dirpath.name, next(_tombstone_numbers))
+        )
         try:
-            rmtree(str(self._DIRPATH_CURRENT.resolve()))
+            # Renaming within the same directory is atomic, and as quick as deleting an
+            # empty directory regardless of what's inside
+            dirpath.rename(dirpath_tombstone)
         except FileNotFoundError:
-            pass  # It's ok if it's not there; just means it's already been cleaned up
+            return  # Already cleaned up
+        deleted = None if deadline is None else Event()
+        if _reaper.submit(dirpath_tombstone, deleted):
+            if deleted is not None:
+                deleted.wait(deadline.remaining_sec())  # type: ignore
+        else:
+            # The reaper's too far behind, so this caller pays like it normally would
+            _delete_tree_(str(dirpath_tombstone))
+
+
+def _wipe_(dirpath: Path) -> None:
+    """Deletes everything inside a directory but not the directory itself."""
+    with os.scandir(str(dirpath)) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                _delete_tree_(entry.path)
+            else:
+                os.unlink(entry.path)
+
+
+class _PooledTMPWorkingDir(TMPWorkingDir):
+    """Working directory leased from a TMPWorkingDirPool. It exists already, and
+    deleting it gives it back to the pool instead."""
+
+    def __init__(self, pool: "TMPWorkingDirPool", dirpath_parent: Path) -> None:
+        super().__init__(dirpath_parent=dirpath_parent)
+        self._pool = pool
+        self._leased = False
+
+    def create_workingdir(self) -> Path:
+        return self._DIRPATH_CURRENT  # The pool made it ahead of time
+
+    def delete_workingdir(self):
+        self._pool._release(self)
+
+
+class _ReadyWorkingDir(NamedTuple):
+    workingdir: _PooledTMPWorkingDir
+    ready_since: float
+
+
+class TMPWorkingDirPool:
+    """Keeps working directories created ahead of time, so that getting one doesn't
+    cost creating it and giving it back doesn't cost deleting it. Normal usage is
+    with-as syntax on what workingdir returns, just like with a TMPWorkingDir:
+
+        with pool.workingdir() as workingdir: ...
+
+    Once that context closes, the directory belongs to the pool again, which wipes it
+    in the background and hands it out again later. Directories that can't be wiped
+    clean (or that got replaced by something other than a directory) are quarantined
+    instead: renamed with a .quarantined suffix and left alone to be looked into.
+
+    The pool grows past min_ready when more directories are in use than that, up to
+    max_dirs, and ready directories beyond min_ready are deleted once they've gone
+    unused for idle_timeout_sec. It's safe to share one pool between threads. Close it
+    when done (or use with-as syntax), which deletes the directories it's holding."""
+
+    @property
+    def ready_count(self) -> int:
+        with self._lock:
+            return len(self._ready)
+
+    @property
+    def leased_count(self) -> int:
+        with self._lock:
+            return self._leased
+
+    @property
+    def quarantined_count(self) -> int:
+        with self._lock:
+            return self._quarantined
+
+    def __init__(
+        self,
+        dirpath_parent: Optional[Path] = None,
+        min_ready: int = 4,
+        max_dirs: int = 64,
+        idle_timeout_sec: float = 60,
+    ) -> None:
+        """Creates min_ready directories right away.
+
+        Arguments:
+        dirpath_parent -- where the working directories are created (same default as
+            TMPWorkingDir's)
+        min_ready -- how many directories are kept ready to hand out
+        max_dirs -- the most directories the pool may have at once, counting those in
+            use and those being wiped
+        idle_timeout_sec -- how long ready directories beyond min_ready are kept
+        """
+        if min_ready < 0 or max_dirs <= 0 or min_ready > max_dirs:
+            raise ValueError("Pool sizes must satisfy 0 <= min_ready <= max_dirs.")
+        # Pinned now so that changing directories later doesn't move the pool
+        self._dirpath_parent = (
+            Path() if dirpath_parent is None else dirpath_parent
+        ).absolute()
+        self._min_ready = min_ready
+        self._max_dirs = max_dirs
+        self._idle_timeout_sec = idle_timeout_sec
+        self._lock = Condition()
+        self._ready: Deque[_ReadyWorkingDir] = deque()
+        self._leased = 0
+        # Directories the pool is responsible for: ready, leased and being wiped
+        self._total = 0
+        self._quarantined = 0
+        self._closed = False
+        # One thread is plenty since wiping and creating are quick on their own; the
+        # point is only that they don't happen on the caller's time
+        self._maintenance = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="TMPWorkingDirPool maintenance"
+        )
+        for _ in range(min_ready):
+            self._ready.append(_ReadyWorkingDir(self._new_workingdir(), monotonic()))
+            self._total += 1
+
+    def __enter__(self) -> "TMPWorkingDirPool":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def workingdir(self, timeout_sec: Optional[float] = None) -> TMPWorkingDir:
+        """Leases a working directory that already exists and is empty. If the pool's
+        at max_dirs, this waits for one to be given back, raising TimeoutError if
+        none is before the timeout (default is to wait as long as it takes). The
+        deadline in effect, if any, cuts the timeout short."""
+        timeout_sec = Deadline.timeout_sec_for_(timeout_sec)
+        deadline = None if timeout_sec is None else monotonic() + timeout_sec
+        workingdir: Optional[_PooledTMPWorkingDir] = None
+        with self._lock:
+            while True:
+                if self._closed:
+                    raise ValueError("The pool is closed.")
+                if self._ready:
+                    # Most recently used first since it's the likeliest to be cached
+                    workingdir = self._ready.pop().workingdir
+                    break
+                if self._total < self._max_dirs:
+                    self._total += 1
+                    break
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("No working directory was given back in time.")
+                self._lock.wait(remaining)
+            self._leased += 1
+            stale = self._evict_stale_unlocked()
+            needs_replenishing = len(self._ready) < self._min_ready
+        if stale or needs_replenishing:
+            self._maintenance.submit(self._tidy_up, stale)
+        if workingdir is None:
+            try:
+                # Only when demand outgrew what was ready is this on the caller's time
+                workingdir = self._new_workingdir()
+            except BaseException:
+                with self._lock:
+                    self._total -= 1
+                    self._leased -= 1
+                    self._lock.notify()
+                raise
+        workingdir._leased = True
+        return workingdir
+
+    def close(self) -> None:
+        """Deletes the directories that are ready. Those in use are deleted once
+        they're given back instead."""
+        with self._lock:
+            self._closed = True
+            ready = [ready.workingdir for ready in self._ready]
+            self._ready.clear()
+            self._total -= len(ready)
+            self._lock.notify_all()
+        self._maintenance.shutdown(wait=True)
+        for workingdir in ready:
+            self._delete_(workingdir)
+
+    def _wait_for_maintenance(self) -> None:
+        # The one maintenance thread works in order, so this runs after what's queued
+        self._maintenance.submit(lambda: None).result()
+
+    def _new_workingdir(self) -> _PooledTMPWorkingDir:
+        workingdir = _PooledTMPWorkingDir(self, self._dirpath_parent)
+        TMPWorkingDir.create_workingdir(workingdir)
+        return workingdir
+
+    def _release(self, workingdir: _PooledTMPWorkingDir) -> None:
+        with self._lock:
+            if not workingdir._leased:
+                return  # Already given back
+            workingdir._leased = False
+            self._leased -= 1
+        try:
+            self._maintenance.submit(self._recycle, workingdir)
+        except RuntimeError:
+            self._forget_one()  # The pool's closed
+            self._delete_(workingdir)
+
+    def _recycle(self, workingdir: _PooledTMPWorkingDir) -> None:
+        dirpath = workingdir.dirpath
+        if not os.path.lexists(str(dirpath)):
+            self._forget_one()  # Somebody deleted it already
+            self._tidy_up([])
+            return
+        try:
+            if dirpath.is_symlink() or not dirpath.is_dir():
+                raise NotADirectoryError(dirpath)
+            _wipe_(dirpath)
+        except OSError:
+            self._quarantine(workingdir)
+            self._tidy_up([])
+            return
+        with self._lock:
+            if self._closed:
+                closed = True
+            else:
+                closed = False
+                self._ready.append(_ReadyWorkingDir(workingdir, monotonic()))
+                self._lock.notify()
+            stale = self._evict_stale_unlocked()
+        if closed:
+            self._forget_one()
+            self._delete_(workingdir)
+        self._tidy_up(stale)
+
+    def _quarantine(self, workingdir: _PooledTMPWorkingDir) -> None:
+        dirpath = workingdir.dirpath
+        try:
+            dirpath.rename(dirpath.with_name(dirpath.name + ".quarantined"))
+        except OSError:
+            pass  # Then it's left where it is, which keeps it out of the pool all same
+        with self._lock:
+            self._quarantined += 1
+        self._forget_one()
+
+    def _forget_one(self) -> None:
+        with self._lock:
+            self._total -= 1
+            self._lock.notify()
+
+    def _evict_stale_unlocked(self) -> List[_PooledTMPWorkingDir]:
+        stale = []
+        now = monotonic()
+        # Least recently used are on the left
+        while (
+            len(self._ready) > self._min_ready
+            and now - self._ready[0].ready_since > self._idle_timeout_sec
+        ):
+            stale.append(self._ready.popleft().workingdir)
+            self._total -= 1
+        return stale
+
+    def _tidy_up(self, stale: List[_PooledTMPWorkingDir]) -> None:
+        """Deletes directories the pool no longer needs and creates ones it's short
+        of."""
+        for workingdir in stale:
+            self._delete_(workingdir)
+        while True:
+            with self._lock:
+                if (
+                    self._closed
+                    or len(self._ready) >= self._min_ready
+                    or self._total >= self._max_dirs
+                ):
+                    return
+                self._total += 1
+            try:
+                workingdir = self._new_workingdir()
+            except OSError:
+                self._forget_one()
+                return  # It'll be tried again next time something's leased
+            with self._lock:
+                closed = self._closed
+                if not closed:
+                    self._ready.append(_ReadyWorkingDir(workingdir, monotonic()))
+                    self._lock.notify()
+            if closed:
+                self._forget_one()  # The pool closed while this was being made
+                self._delete_(workingdir)
+                return
+
+    @staticmethod
+    def _delete_(workingdir: TMPWorkingDir) -> None:
+        try:
+            _delete_tree_(str(workingdir.dirpath))
+        except OSError:
+            pass  # It's out of the pool either way
 
 
 if __name__ == "__main__":
@@ -0,0 +1,300 @@
+from email.utils import formatdate
+from gzip import compress as gzip_compress
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from re import fullmatch
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Any, Dict, List, Optional, Tuple
+from zlib import compressobj
+from zlib import compress as zlib_compress
+
+
+class StandInFile:
+    """Something the stand-in server can serve, plus knobs for how to serve it."""
+
+    def __init__(
+        self,
+        data: bytes,
+        filename: Optional[str] = None,
+        delay_sec: float = 0,
+        redirect_to: Optional[str] = None,
+        hang_up_after: bool = False,
+        accept_ranges: bool = True,
+        drop_after_bytes: Optional[int] = None,
+        chunked: bool = False,
+        stall_mid_body_sec: float = 0,
+        content_encoding: Optional[str] = None,
+        delay_first: Optional[int] = None,
+        fail_first: int = 0,
+        fail_status: int = 503,
+        retry_after: Optional[str] = None,
+        head_status: Optional[int] = None,
+    ) -> None:
+        """Arguments:
+        data -- the response body
+        filename -- sent via Content-Disposition when given
+        delay_sec -- how long to stall before responding
+        redirect_to -- answer with a 302 to this URL path instead of the data
+        hang_up_after -- silently drop the connection after responding even though
+            the response says it's kept alive (like a server reaping idle connections)
+        accept_ranges -- whether Range requests are honored (otherwise they're
+            ignored and the whole file is sent)
+        drop_after_bytes -- hang up after sending this many bytes of the body (like a
+            flaky connection would)
+        chunked -- send the body with chunked transfer encoding instead of a length
+        stall_mid_body_sec -- how long to stall after sending half of the body
+        content_encoding -- compress the body like this ("gzip" or "deflate") when the
+            request accepts it. "raw-deflate" sends deflate without the zlib header
+            (which plenty of real servers do) while calling it deflate.
+        delay_first -- only stall the first this many requests (default is all)
+        fail_first -- answer the first this many requests with fail_status
+        fail_status -- what failing requests are answered with
+        retry_after -- sent via Retry-After with failing requests when given
+        head_status -- answer HEAD requests with this instead when given (like servers
+            that only allow GET)
+        """
+        self.data = data
+        self.filename = filename
+        self.delay_sec = delay_sec
+        self.redirect_to = redirect_to
+        self.hang_up_after = hang_up_after
+        self.accept_ranges = accept_ranges
+        self.drop_after_bytes = drop_after_bytes
+        self.chunked = chunked
+        self.stall_mid_body_sec = stall_mid_body_sec
+        self.content_encoding = content_encoding
+        self.delay_first = delay_first
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.retry_after = retry_after
+        self.head_status = head_status
+        self.served_count = 0
+        self.last_modified = formatdate(time(), usegmt=True)
+
+    @property
+    def etag(self) -> str:
+        return f'"{sha256(self.data).hexdigest()[:16]}"'
+
+
+class StandInServer:
+    """Local HTTP/1.1 server that serves in-memory files so request tests and benchmarks
+    don't need the internet. Use it with with-as syntax; it listens on an ephemeral
+    port of 127.0.0.1 until the context closes."""
+
+    def __init__(self) -> None:
+        self.files: Dict[str, StandInFile] = {}
+        self._lock = Lock()
+        self._in_flight = 0
+        self.max_in_flight = 0
+        self.request_count = 0
+        self.connection_count = 0
+        self.body_bytes_sent = 0
+        # (method, path, headers) of every request received, in order
+        self.requests: List[Tuple[str, str, Dict[str, str]]] = []
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler_for_(self))
+        self._httpd.daemon_threads = True
+        self._thread = Thread(
+            target=self._httpd.serve_forever,
+            kwargs={"poll_interval": 0.01},
+            daemon=True,
+        )
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    def url_for(self, urlpath: str, host: str = "127.0.0.1") -> str:
+        return f"http://{host}:{self.port}{urlpath}"
+
+    def add_file(self, urlpath: str, data: bytes, **kwargs: Any) -> str:
+        self.files[urlpath] = StandInFile(data=data, **kwargs)
+        return self.url_for(urlpath)
+
+    def __enter__(self) -> "StandInServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def _track_connection(self) -> None:
+        with self._lock:
+            self.connection_count += 1
+
+    def _track_request_start(self, handler: BaseHTTPRequestHandler) -> None:
+        with self._lock:
+            self.requests.append((handler.command, handler.path, dict(handler.headers)))
+            self.request_count += 1
+            self._in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+
+    def _track_body_sent(self, n: int) -> None:
+        with self._lock:
+            self.body_bytes_sent += n
+
+    def _track_request_end(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+
+def _make_handler_for_(server: StandInServer) -> type:
+    class _Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args: Any) -> None:
+            pass  # Keep test output clean
+
+        def setup(self) -> None:
+            super().setup()
+            server._track_connection()
+
+        def do_GET(self) -> None:
+            server._track_request_start(self)
+            try:
+                self._serve(send_body=True)
+            finally:
+                server._track_request_end()
+
+        def do_HEAD(self) -> None:
+            server._track_request_start(self)
+            try:
+                self._serve(send_body=False)
+            finally:
+                server._track_request_end()
+
+        def _serve(self, send_body: bool) -> None:
+            stand_in = server.files.get(self.path)
+            if stand_in is None:
+                self.send_error(404)
+                return
+            if not send_body and stand_in.head_status is not None:
+                self.send_response(stand_in.head_status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            with server._lock:
+                nth = stand_in.served_count
+                stand_in.served_count += 1
+            if stand_in.delay_sec and (
+                stand_in.delay_first is None or nth < stand_in.delay_first
+            ):
+                sleep(stand_in.delay_sec)
+            if nth < stand_in.fail_first:
+                self.send_response(stand_in.fail_status)
+                if stand_in.retry_after is not None:
+                    self.send_header("Retry-After", stand_in.retry_after)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if stand_in.hang_up_after:
+                self.close_connection = True
+            if stand_in.redirect_to is not None:
+                self.send_response(302)
+                self.send_header("Location", stand_in.redirect_to)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if self._is_cached_copy_current_(stand_in):
+                self.send_response(304)
+                self.send_header("ETag", stand_in.etag)
+                self.end_headers()
+                return
+            body = stand_in.data
+            byte_range = self._requested_range_of_(stand_in)
+            encoding = self._agreed_encoding_for_(stand_in)
+            if encoding is not None:
+                body = _compressed_(body, encoding)
+                self.send_response(200)
+                self.send_header("Content-Encoding", encoding.replace("raw-", ""))
+            elif byte_range is None:
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                body = stand_in.data[start : end + 1]
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{end}/{len(stand_in.data)}"
+                )
+            if stand_in.chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            else:
+                self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", stand_in.etag)
+            self.send_header("Last-Modified", stand_in.last_modified)
+            if stand_in.accept_ranges:
+                self.send_header("Accept-Ranges", "bytes")
+            if stand_in.filename is not None:
+                self.send_header(
+                    "Content-Disposition",
+                    f'attachment; filename="{stand_in.filename}"',
+                )
+            self.end_headers()
+            if not send_body:
+                return
+            if stand_in.drop_after_bytes is not None:
+                body = body[: stand_in.drop_after_bytes]
+                self.close_connection = True
+            server._track_body_sent(len(body))
+            if stand_in.chunked:
+                self._write_chunked(body)
+            elif stand_in.stall_mid_body_sec:
+                self.wfile.write(body[: len(body) // 2])
+                self.wfile.flush()
+                sleep(stand_in.stall_mid_body_sec)
+                self.wfile.write(body[len(body) // 2 :])
+            else:
+                self.wfile.write(body)
+
+        def _write_chunked(self, body: bytes, chunk_size: int = 1000) -> None:
+            for start in range(0, len(body), chunk_size):
+                chunk = body[start : start + chunk_size]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _is_cached_copy_current_(self, stand_in: StandInFile) -> bool:
+            if_none_match = self.headers.get("If-None-Match")
+            if if_none_match is not None:
+                return if_none_match == stand_in.etag
+            return self.headers.get("If-Modified-Since") == stand_in.last_modified
+
+        def _agreed_encoding_for_(self, stand_in: StandInFile) -> Optional[str]:
+            if stand_in.content_encoding is None:
+                return None
+            accepted = {
+                encoding.strip()
+                for encoding in self.headers.get("Accept-Encoding", "").split(",")
+            }
+            if stand_in.content_encoding.replace("raw-", "") not in accepted:
+                return None
+            return stand_in.content_encoding
+
+        def _requested_range_of_(
+            self, stand_in: StandInFile
+        ) -> Optional[Tuple[int, int]]:
+            """Only single "bytes=start-[end]" ranges are supported."""
+            match = fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if not stand_in.accept_ranges or match is None:
+                return None
+            if_range = self.headers.get("If-Range")
+            if if_range is not None and if_range != stand_in.etag:
+                return None
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(stand_in.data) - 1
+            return start, min(end, len(stand_in.data) - 1)
+
+    return _Handler
+
+
+def _compressed_(data: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        return gzip_compress(data)
+    if encoding == "deflate":
+        return zlib_compress(data)
+    if encoding == "raw-deflate":
+        compressor = compressobj(wbits=-15)
+        return compressor.compress(data) + compressor.flush()
+    raise ValueError(f"Unknown encoding: {encoding}")
@@ -4,7 +4,8 @@ from unittest import TestCase
 from unittest.mock import patch
 
 from src.xlib_commonpy import bundle
-from src.xlib_commonpy.bundle import Bundle
+from src.xlib_commonpy.bundle import Bundle, BundleEntry, BundleIntegrityError
+from src.xlib_commonpy.time_related import profiler
 from src.xlib_commonpy.tmpworkingdir import TMPWorkingDir
 
 
@@ -45,3 +46,246 @@ class TestBundle(TestCase):
             mock_bundlepath.side_effect = lambda: tmpdir.dirpath
 
             self.assertSetEqual(set(Bundle.list_dir()), expected)
+
+            # Listing shall be timed while profiling's enabled
+            profiler.reset()
+            profiler.enabled = True
+            try:
+                Bundle.list_dir()
+            finally:
+                profiler.enabled = False
+            self.assertEqual(profiler.report()["Bundle.list_dir"]["count"], 1)
+            profiler.reset()
+
+
+class TestBundleIndex(TestCase):
+    def setUp(self) -> None:
+        self._tmpdir = TMPWorkingDir()
+        self._root = self._tmpdir.create_workingdir()
+        self._root.joinpath("tools", "linux").mkdir(parents=True)
+        self._root.joinpath("tools", "linux", "run.sh").write_bytes(b"#!/bin/sh\n")
+        self._root.joinpath("tools", "run.sh").write_bytes(b"#!/bin/sh\necho\n")
+        self._root.joinpath("data.bin").write_bytes(b"\0" * 1000)
+        patcher = patch.object(Bundle, Bundle.dirpath.__name__, lambda: self._root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self._tmpdir.delete_workingdir()
+        return super().tearDown()
+
+    def test_lookups(self):
+        entry = Bundle.lookup("tools/linux/run.sh")
+        self.assertEqual(
+            entry,
+            BundleEntry(
+                "tools/linux/run.sh",
+                self._root.joinpath("tools", "linux", "run.sh"),
+                10,
+                False,
+            ),
+        )
+        self.assertEqual(Bundle.lookup(Path("tools", "linux", "run.sh")), entry)
+        self.assertTrue(Bundle.lookup("tools").is_dir)
+        self.assertIsNone(Bundle.lookup("nope"))
+
+        # Lookups by name and glob shall see the whole tree, not only the top level
+        self.assertSetEqual(
+            {entry.relpath for entry in Bundle.find_named("run.sh")},
+            {"tools/run.sh", "tools/linux/run.sh"},
+        )
+        self.assertSetEqual(
+            {entry.relpath for entry in Bundle.glob("*.sh")},
+            {"tools/run.sh", "tools/linux/run.sh"},
+        )
+        self.assertSetEqual(
+            {entry.relpath for entry in Bundle.glob("tools/linux/*")},
+            {"tools/linux/run.sh"},
+        )
+        self.assertDictEqual(
+            dict(Bundle.iter_sizes()),
+            {"tools/linux/run.sh": 10, "tools/run.sh": 15, "data.bin": 1000},
+        )
+        self.assertSetEqual(
+            set(Bundle.list_dir()),
+            {self._root.joinpath("tools"), self._root.joinpath("data.bin")},
+        )
+
+    def test_cached_until_changed(self):
+        Bundle.lookup("data.bin")
+
+        # Once indexed, lookups shall neither walk the bundle again nor check it
+        # every time
+        with patch.object(
+            bundle.os, "scandir", wraps=bundle.os.scandir
+        ) as spy, patch.object(bundle.os, "stat", wraps=bundle.os.stat) as spy_stat:
+            for _ in range(100):
+                self.assertIsNotNone(Bundle.lookup("data.bin"))
+        self.assertEqual(spy.call_count, 0)
+        self.assertEqual(spy_stat.call_count, 0)
+
+        # Except that listing the top level shall always be up to date
+        self._root.joinpath("new.txt").write_bytes(b"")
+        self.assertIn(self._root.joinpath("new.txt"), Bundle.list_dir())
+        self.assertIsNotNone(Bundle.lookup("new.txt"))
+
+        # Changes anywhere in the tree shall be noticed once it's checked again
+        patcher = patch.object(bundle, "_INDEX_CHECK_INTERVAL_SEC", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self._root.joinpath("tools", "linux", "new.sh").write_bytes(b"")
+        self.assertIsNotNone(Bundle.lookup("tools/linux/new.sh"))
+        self._root.joinpath("data.bin").unlink()
+        self.assertIsNone(Bundle.lookup("data.bin"))
+
+    def test_manifest_for_frozen_builds(self):
+        fpath = Bundle.write_manifest(self._root)
+        self.assertEqual(fpath.parent, self._root)
+        # The manifest shall not index itself
+        self.assertIsNone(Bundle.lookup(fpath.name))
+
+        with patch.object(bundle, bundle.sys.__name__) as sys_mock, patch.object(
+            bundle.os, "scandir", side_effect=AssertionError("walked")
+        ):
+            setattr(sys_mock, "frozen", True)
+            setattr(sys_mock, "_MEIPASS", self._root)
+            # Built programs shall load the manifest rather than walk the bundle
+            self.assertEqual(Bundle.lookup("tools/run.sh").size, 15)
+            self.assertEqual(len(Bundle.find_named("run.sh")), 2)
+
+
+class TestMappedResources(TestCase):
+    def setUp(self) -> None:
+        self._tmpdir = TMPWorkingDir()
+        self._root = self._tmpdir.create_workingdir()
+        self._data = bytes(range(256)) * 64
+        self._root.joinpath("models").mkdir()
+        self._root.joinpath("models", "table.bin").write_bytes(self._data)
+        self._root.joinpath("empty").write_bytes(b"")
+        patcher = patch.object(Bundle, Bundle.dirpath.__name__, lambda: self._root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(Bundle.unmap_all)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self._tmpdir.delete_workingdir()
+        return super().tearDown()
+
+    def test_shared_and_read_only(self):
+        mapped = Bundle.map_file("models/table.bin")
+        self.assertEqual(mapped[:], self._data)
+
+        # Everyone in the process shall share one mapping
+        self.assertIs(Bundle.map_file("models/table.bin"), mapped)
+        view = Bundle.view_file("models/table.bin")
+        self.assertTrue(view.readonly)
+        self.assertEqual(view[256:512].tobytes(), self._data[256:512])
+        with self.assertRaises(TypeError):
+            mapped[0] = 1
+        with self.assertRaises(TypeError):
+            view[0] = 1
+
+    def test_changed_file_mapped_anew(self):
+        old = Bundle.map_file("models/table.bin")
+        self._root.joinpath("new").write_bytes(b"new")
+        self._root.joinpath("new").replace(self._root.joinpath("models", "table.bin"))
+        self.assertEqual(Bundle.map_file("models/table.bin")[:], b"new")
+        # The old mapping shall still work for whoever has it
+        self.assertEqual(old[:], self._data)
+
+    def test_odd_files(self):
+        self.assertEqual(Bundle.view_file("empty").tobytes(), b"")
+        with self.assertRaises(ValueError):
+            Bundle.map_file("empty")
+        with self.assertRaises(FileNotFoundError):
+            Bundle.map_file("nope")
+        with self.assertRaises(IsADirectoryError):
+            Bundle.map_file("models")
+
+
+class TestIntegrity(TestCase):
+    def setUp(self) -> None:
+        self._tmpdir = TMPWorkingDir()
+        self._root = self._tmpdir.create_workingdir()
+        self._root.joinpath("tools").mkdir()
+        for n in range(20):
+            self._root.joinpath("tools", f"{n}.sh").write_bytes(b"echo %d\n" % n)
+        Bundle.write_manifest(self._root)
+        patcher = patch.object(Bundle, Bundle.dirpath.__name__, lambda: self._root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(Bundle.unmap_all)
+        # Results are memoized per bundle directory, and each test has its own
+        patcher = patch.object(bundle, "_verifier", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self._tmpdir.delete_workingdir()
+        return super().tearDown()
+
+    def test_lazy(self):
+        self.assertEqual(Bundle.verify("tools/0.sh"), self._root / "tools" / "0.sh")
+
+        self._root.joinpath("tools", "1.sh").write_bytes(b"rm -rf ~\n")
+        with self.assertRaises(BundleIntegrityError) as caught:
+            Bundle.verify("tools/1.sh")
+        self.assertEqual(caught.exception.relpath, "tools/1.sh")
+
+        # Files the manifest doesn't know about shall fail too
+        self._root.joinpath("tools", "extra.sh").write_bytes(b"")
+        with self.assertRaises(BundleIntegrityError):
+            Bundle.verify("tools/extra.sh")
+
+    def test_memoized(self):
+        with patch.object(
+            bundle, "_digest_of_mapped_", wraps=bundle._digest_of_mapped_
+        ) as spy:
+            for _ in range(10):
+                Bundle.verify("tools/0.sh")
+        self.assertEqual(spy.call_count, 1)
+
+    def test_eager(self):
+        self._root.joinpath("tools", "3.sh").write_bytes(b"tampered\n")
+        self._root.joinpath("tools", "4.sh").unlink()
+        with patch.object(
+            bundle, "_digest_of_mapped_", wraps=bundle._digest_of_mapped_
+        ) as spy:
+            failures = Bundle.verify_all().result(timeout=10)
+            # What was verified in the background shall not be hashed again
+            Bundle.verify("tools/0.sh")
+            Bundle.map_file("tools/0.sh")
+        self.assertSetEqual(set(failures), {"tools/3.sh", "tools/4.sh"})
+        self.assertIsInstance(failures["tools/3.sh"], BundleIntegrityError)
+        self.assertIsInstance(failures["tools/4.sh"], FileNotFoundError)
+        # Once per file that's there
+        self.assertEqual(spy.call_count, 19)
+
+    def test_mapped_files(self):
+        self.assertEqual(Bundle.map_file("tools/0.sh")[:], b"echo 0\n")
+
+        # Files shall be checked when they're mapped, not only when asked to be
+        self._root.joinpath("tools", "1.sh").write_bytes(b"rm -rf ~\n")
+        with self.assertRaises(BundleIntegrityError):
+            Bundle.map_file("tools/1.sh")
+        with self.assertRaises(BundleIntegrityError):
+            Bundle.view_file("tools/1.sh")
+
+        # Including when they change after they've been checked
+        with patch.object(
+            bundle, "_digest_of_mapped_", wraps=bundle._digest_of_mapped_
+        ) as spy:
+            self.assertEqual(Bundle.verify("tools/2.sh"), self._root / "tools" / "2.sh")
+            self._root.joinpath("new").write_bytes(b"rm -rf /\n")
+            self._root.joinpath("new").replace(self._root.joinpath("tools", "2.sh"))
+            with self.assertRaises(BundleIntegrityError):
+                Bundle.view_file("tools/2.sh")
+        self.assertEqual(spy.call_count, 2)
+
+    def test_without_manifest(self):
+        self._root.joinpath(".bundle_manifest.json").unlink()
+        with self.assertRaises(FileNotFoundError):
+            Bundle.verify("tools/0.sh")
@@ -1,13 +1,42 @@
+import os
+from asyncio import create_task, wait_for
+from asyncio import sleep as sleep_async
+from gzip import compress as gzip_compress
+from hashlib import blake2b, sha256, sha512
+from http.client import HTTPException, IncompleteRead
 from io import BufferedReader
+from lzma import compress as xz_compress
+from os import urandom
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import monotonic, sleep
 from typing import Optional
-from unittest import TestCase
+from unittest import IsolatedAsyncioTestCase, TestCase, skipUnless
 from unittest.mock import MagicMock, patch
+from urllib.error import HTTPError
 from uuid import uuid4
 
 from src.xlib_commonpy import request
-from src.xlib_commonpy.request import download_file_from_
+from src.xlib_commonpy.request import (
+    DigestMismatchError,
+    DownloadCache,
+    DownloadObserver,
+    DownloadStats,
+    HedgePolicy,
+    HTTPConnectionPool,
+    RetryPolicy,
+    async_download_file_from_,
+    async_download_files_from_,
+    download_file_from_,
+    download_files_from_,
+)
+from src.xlib_commonpy.time_related import (
+    DeadlineExceeded,
+    deadline_after_,
+    profiler,
+)
+from tests.stand_in_server import StandInServer
 
 _PATCHARGS_URLOPEN = (request.request, request.request.urlopen.__name__)
 from types import MethodType
@@ -32,7 +61,7 @@ class TestRequest(TestCase):
                 fout.write(expected_data)
             # Mock a HTTPResponse object
             mock_httpresp = MagicMock()
-            with open(mock_download_data, "r") as pretend_dl_stream:
+            with open(mock_download_data, "rb") as pretend_dl_stream:
                 # Mock the HTTPMessage object within the response object
                 pretend_dl_stream.info = MethodType(  # type:ignore
                     lambda x: _MOCKHTTPMessage(filename=mock_download_data.name),
@@ -98,3 +127,1542 @@ class TestRequest(TestCase):
                 self.assertTrue(uut.exists())
                 with open(uut, "r") as fin:
                     self.assertEqual(fin.read(), expected_data)
+
+
+class TestBatchDownload(TestCase):
+    def test_downloading_files(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            expected = {
+                server.add_file(f"/{i}", data=f"file {i}".encode(), filename=f"{i}.txt")
+                for i in range(6)
+            }
+            dpath_dest = Path(tmpdir)
+
+            results = list(download_files_from_(urls=expected, dest_dir=dpath_dest))
+
+            # Every URL shall get exactly one result, and each shall have succeeded
+            self.assertSetEqual({result.url for result in results}, expected)
+            for result in results:
+                self.assertTrue(result.succeeded)
+                assert result.fpath is not None
+                self.assertEqual(
+                    result.fpath.read_bytes(), f"file {result.fpath.stem}".encode()
+                )
+
+    def test_destination_checks_happen_up_front(self):
+        with TemporaryDirectory() as tmpdir:
+            dpath_dest = Path(tmpdir).joinpath("downloads")
+
+            # Missing destinations shall be rejected before anything is iterated
+            with self.assertRaises(FileNotFoundError):
+                download_files_from_(urls=["doesn't matter"], dest_dir=dpath_dest)
+
+            # So shall destinations that are files
+            dpath_dest.touch()
+            with self.assertRaises(NotADirectoryError):
+                download_files_from_(urls=["doesn't matter"], dest_dir=dpath_dest)
+
+    def test_failures_are_reported_per_url(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url_ok = server.add_file("/ok", data=b"ok", filename="ok.txt")
+            url_exists = server.add_file("/exists", data=b"new", filename="exists.txt")
+            url_missing = server.url_for("/missing")
+            Path(tmpdir).joinpath("exists.txt").write_bytes(b"old")
+
+            results = {
+                result.url: result
+                for result in download_files_from_(
+                    urls=[url_ok, url_exists, url_missing], dest_dir=Path(tmpdir)
+                )
+            }
+
+            # One failure shall not stop the rest of the batch
+            self.assertTrue(results[url_ok].succeeded)
+            self.assertIsInstance(results[url_exists].error, FileExistsError)
+            self.assertIsNotNone(results[url_missing].error)
+            self.assertIsNone(results[url_missing].fpath)
+
+            # Existing files shall be left alone
+            self.assertEqual(Path(tmpdir).joinpath("exists.txt").read_bytes(), b"old")
+
+    def test_per_host_cap(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            urls = [
+                server.add_file(f"/{i}", data=b"x", filename=f"{i}", delay_sec=0.1)
+                for i in range(6)
+            ]
+
+            results = list(
+                download_files_from_(
+                    urls=urls, dest_dir=Path(tmpdir), max_workers=8, max_per_host=2
+                )
+            )
+
+            # Even with spare workers, no more than the cap shall hit one host at once
+            self.assertTrue(all(result.succeeded for result in results))
+            self.assertEqual(server.max_in_flight, 2)
+
+    def test_invalid_limits(self):
+        with TemporaryDirectory() as tmpdir:
+            with self.assertRaises(ValueError):
+                download_files_from_(urls=[], dest_dir=Path(tmpdir), max_workers=0)
+            with self.assertRaises(ValueError):
+                download_files_from_(urls=[], dest_dir=Path(tmpdir), max_per_host=0)
+
+
+class TestDeadline(TestCase):
+    def test_passed_deadline(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/f", data=b"x")
+
+            # Nothing shall be requested once there's no time left
+            with deadline_after_(0.01):
+                sleep(0.02)
+                with self.assertRaises(DeadlineExceeded):
+                    download_file_from_(url=url, dest_dir=Path(tmpdir))
+                with HTTPConnectionPool() as pool, self.assertRaises(DeadlineExceeded):
+                    download_file_from_(url=url, dest_dir=Path(tmpdir), pool=pool)
+                # Nor by the batch's workers
+                results = list(download_files_from_(urls=[url], dest_dir=Path(tmpdir)))
+                self.assertIsInstance(results[0].error, DeadlineExceeded)
+            self.assertEqual(server.request_count, 0)
+
+    def test_running_out_mid_body(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file(
+                "/slow", data=b"x" * 100_000, filename="slow.bin", stall_mid_body_sec=5
+            )
+
+            # A stalled body shall be given up on when time's up, not when it resumes,
+            # and the partial file shall not be left behind
+            for pool in (None, HTTPConnectionPool()):
+                started = monotonic()
+                with deadline_after_(0.5), self.assertRaises(DeadlineExceeded):
+                    download_file_from_(
+                        url=url, dest_dir=Path(tmpdir), pool=pool, chunk_size=1000
+                    )
+                self.assertLess(monotonic() - started, 3)
+                self.assertListEqual(list(Path(tmpdir).iterdir()), [])
+
+            # Reads shall only wait for what's left of the deadline as they start, not
+            # for what was left when connecting
+            url = server.add_file(
+                "/late", data=b"x" * 100_000, delay_sec=0.6, stall_mid_body_sec=3
+            )
+            for pool in (None, HTTPConnectionPool()):
+                started = monotonic()
+                with deadline_after_(1), self.assertRaises(DeadlineExceeded):
+                    download_file_from_(
+                        url=url, dest_dir=Path(tmpdir), pool=pool, chunk_size=1000
+                    )
+                self.assertLess(monotonic() - started, 1.4)
+
+            # Without a deadline, the pool's connections shall go back to no timeout
+            with HTTPConnectionPool() as pool:
+                with deadline_after_(60):
+                    download_file_from_(
+                        url=server.add_file("/f", data=b"x"),
+                        dest_dir=Path(tmpdir),
+                        pool=pool,
+                    )
+                self.assertEqual(pool.idle_count, 1)
+                with pool.urlopen(server.url_for("/f")) as response:
+                    self.assertIsNone(response.fp.raw._sock.gettimeout())
+                    response.read()
+
+
+class TestRetrying(TestCase):
+    def test_retrying(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, patch.object(
+            request, request.sleep.__name__
+        ) as spy_sleep:
+            url = server.add_file("/f", data=b"x", filename="f", fail_first=2)
+            policy = RetryPolicy(max_attempts=3, base_delay_sec=1)
+
+            # Passing failures shall be tried again, backing off in between
+            fpath = download_file_from_(url=url, dest_dir=Path(tmpdir), retry=policy)
+            self.assertEqual(fpath.read_bytes(), b"x")
+            self.assertEqual(server.request_count, 3)
+            delays = [call.args[0] for call in spy_sleep.call_args_list]
+            self.assertEqual(len(delays), 2)
+            self.assertTrue(0 <= delays[0] <= 1 and 0 <= delays[1] <= 2)
+
+            # But only so many times
+            url = server.add_file("/g", data=b"x", filename="g", fail_first=3)
+            with self.assertRaises(HTTPError):
+                download_file_from_(url=url, dest_dir=Path(tmpdir), retry=policy)
+
+            # And not for failures that would just happen again
+            spy_sleep.reset_mock()
+            with self.assertRaises(HTTPError):
+                download_file_from_(
+                    url=server.url_for("/missing"), dest_dir=Path(tmpdir), retry=policy
+                )
+            with self.assertRaises(FileExistsError):
+                download_file_from_(
+                    url=server.url_for("/f"), dest_dir=Path(tmpdir), retry=policy
+                )
+            spy_sleep.assert_not_called()
+
+    def test_retrying_with_pool(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, (
+            HTTPConnectionPool()
+        ) as pool, patch.object(request, request.sleep.__name__):
+            url = server.add_file("/f", data=b"x", filename="f", fail_first=2)
+
+            # Failed responses shall give their connection back to be retried over
+            fpath = download_file_from_(
+                url=url, dest_dir=Path(tmpdir), pool=pool, retry=RetryPolicy()
+            )
+            self.assertEqual(fpath.read_bytes(), b"x")
+            self.assertEqual(pool.connections_created, 1)
+            self.assertEqual(pool.connections_reused, 2)
+            self.assertEqual(pool.idle_count, 1)
+
+    def test_retry_after(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, patch.object(
+            request, request.sleep.__name__
+        ) as spy_sleep:
+            url = server.add_file(
+                "/f", data=b"x", filename="f", fail_first=1, retry_after="7"
+            )
+
+            # What the server asks for shall be waited
+            download_file_from_(url=url, dest_dir=Path(tmpdir), retry=RetryPolicy())
+            spy_sleep.assert_called_once_with(7.0)
+
+            # Unless it's too much to ask
+            url = server.add_file(
+                "/g", data=b"x", fail_first=1, retry_after="3600", fail_status=429
+            )
+            with self.assertRaises(HTTPError):
+                download_file_from_(url=url, dest_dir=Path(tmpdir), retry=RetryPolicy())
+            # Or more than the deadline leaves
+            url = server.add_file("/h", data=b"x", fail_first=1, retry_after="5")
+            with deadline_after_(1), self.assertRaises(HTTPError):
+                download_file_from_(url=url, dest_dir=Path(tmpdir), retry=RetryPolicy())
+            spy_sleep.assert_called_once()
+
+    def test_mirrors_and_partial_files(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, patch.object(
+            request, request.sleep.__name__
+        ):
+            dpath_dest = Path(tmpdir)
+            url_broken = server.add_file(
+                "/broken", data=b"x" * 1000, filename="f", drop_after_bytes=10
+            )
+            url_mirror = server.add_file("/mirror", data=b"x" * 1000, filename="f")
+
+            # A body cut short shall be retried from the next mirror, without the
+            # partial file getting in the way
+            fpath = download_file_from_(
+                url=url_broken,
+                dest_dir=dpath_dest,
+                retry=RetryPolicy(),
+                mirror_urls=[url_mirror],
+            )
+            self.assertEqual(fpath.read_bytes(), b"x" * 1000)
+            self.assertListEqual(
+                [path for _, path, _ in server.requests], ["/broken", "/mirror"]
+            )
+
+    def test_invalid_policies(self):
+        with self.assertRaises(ValueError):
+            RetryPolicy(max_attempts=0)
+        with self.assertRaises(ValueError):
+            RetryPolicy(base_delay_sec=-1)
+        with self.assertRaises(ValueError):
+            HedgePolicy(percentile=0)
+        with self.assertRaises(ValueError):
+            download_file_from_(
+                url="doesn't matter", dest_dir=Path(), hedge=HedgePolicy(), parts=2
+            )
+
+
+class TestHedging(TestCase):
+    def test_hedging_to_a_mirror(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url_slow = server.add_file("/slow", data=b"slow", delay_sec=3)
+            url_fast = server.add_file("/fast", data=b"fast", filename="f")
+            hedge = HedgePolicy(initial_delay_sec=0.1)
+
+            # The mirror that answers first shall be the one downloaded from
+            started = monotonic()
+            fpath = download_file_from_(
+                url=url_slow,
+                dest_dir=Path(tmpdir),
+                hedge=hedge,
+                mirror_urls=[url_fast],
+            )
+            self.assertLess(monotonic() - started, 2)
+            self.assertEqual(fpath.read_bytes(), b"fast")
+            self.assertEqual(hedge.hedged, 1)
+
+            # The time to first byte learned from shall include the wait before
+            # hedging, not only how quickly the mirror answered
+            self.assertGreaterEqual(hedge._ttfbs_sec[-1], 0.1)
+
+            # Servers that answer in time shall not be hedged
+            url = server.add_file("/f", data=b"x")
+            download_file_from_(url=url, dest_dir=Path(tmpdir), hedge=hedge)
+            self.assertEqual(hedge.hedged, 1)
+
+    def test_hedging_to_the_same_url(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, (
+            HTTPConnectionPool()
+        ) as pool:
+            url = server.add_file(
+                "/f", data=b"x", filename="f", delay_sec=3, delay_first=1
+            )
+            hedge = HedgePolicy(initial_delay_sec=0.1)
+
+            started = monotonic()
+            fpath = download_file_from_(
+                url=url, dest_dir=Path(tmpdir), pool=pool, hedge=hedge
+            )
+            self.assertLess(monotonic() - started, 2)
+            self.assertEqual(fpath.read_bytes(), b"x")
+            self.assertEqual(server.request_count, 2)
+
+    def test_delay_follows_percentile(self):
+        hedge = HedgePolicy(
+            percentile=90, initial_delay_sec=5, min_delay_sec=0.01, min_samples=10
+        )
+        self.assertEqual(hedge.delay_sec(), 5)
+        for i in range(1, 101):
+            hedge._record(i / 100)
+        self.assertAlmostEqual(hedge.delay_sec(), 0.91)
+        for _ in range(1000):
+            hedge._record(0)
+        self.assertEqual(hedge.delay_sec(), 0.01)
+
+
+class TestHTTPConnectionPool(TestCase):
+    def test_reusing_connections(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, (
+            HTTPConnectionPool()
+        ) as pool:
+            for i in range(5):
+                url = server.add_file(f"/{i}", data=f"{i}".encode(), filename=f"{i}")
+                fpath = download_file_from_(url=url, dest_dir=Path(tmpdir), pool=pool)
+                self.assertEqual(fpath.read_bytes(), f"{i}".encode())
+
+            # Consecutive downloads from one host shall share one connection
+            self.assertEqual(pool.connections_created, 1)
+            self.assertEqual(pool.connections_reused, 4)
+            self.assertEqual(server.connection_count, 1)
+            self.assertEqual(pool.idle_count, 1)
+
+    def test_batch_with_pool(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, (
+            HTTPConnectionPool()
+        ) as pool:
+            urls = [
+                server.add_file(f"/{i}", data=b"x", filename=f"{i}") for i in range(10)
+            ]
+
+            results = list(
+                download_files_from_(
+                    urls=urls, dest_dir=Path(tmpdir), max_per_host=2, pool=pool
+                )
+            )
+
+            # No more connections than the per-host cap shall ever be needed
+            self.assertTrue(all(result.succeeded for result in results))
+            self.assertLessEqual(pool.connections_created, 2)
+            self.assertEqual(pool.connections_created + pool.connections_reused, 10)
+
+    def test_evicting_idle_connections(self):
+        with StandInServer() as server, HTTPConnectionPool(
+            idle_timeout_sec=0.05
+        ) as pool:
+            url = server.add_file("/", data=b"x")
+            with pool.urlopen(url) as response:
+                response.read()
+            sleep(0.1)
+            with pool.urlopen(url) as response:
+                response.read()
+
+            # Connections idle for longer than the timeout shall not be reused
+            self.assertEqual(pool.connections_created, 2)
+            self.assertEqual(pool.connections_reused, 0)
+
+    def test_capping_pool_size(self):
+        with StandInServer() as server, HTTPConnectionPool(max_idle_per_host=1) as pool:
+            url = server.add_file("/", data=b"x")
+            responses = [pool.urlopen(url) for _ in range(3)]
+            for response in responses:
+                with response:
+                    response.read()
+
+            # Connections beyond the cap shall be closed instead of kept
+            self.assertEqual(pool.connections_created, 3)
+            self.assertEqual(pool.idle_count, 1)
+
+        with StandInServer() as server, HTTPConnectionPool(max_idle=1) as pool:
+            urls = [server.url_for("/"), server.url_for("/", host="localhost")]
+            server.add_file("/", data=b"x")
+            for url in urls:
+                with pool.urlopen(url) as response:
+                    response.read()
+
+            # The cap across hosts shall also hold
+            self.assertEqual(pool.idle_count, 1)
+
+    def test_unread_responses_are_not_reused(self):
+        with StandInServer() as server, HTTPConnectionPool() as pool:
+            url = server.add_file("/", data=b"x" * 1024)
+            with pool.urlopen(url) as response:
+                response.read(1)
+
+            # Leftover body bytes would corrupt the next response on the connection
+            self.assertEqual(pool.idle_count, 0)
+
+    def test_recovering_from_dropped_connections(self):
+        with StandInServer() as server, HTTPConnectionPool() as pool:
+            url_dropper = server.add_file("/dropper", data=b"x", hang_up_after=True)
+            url = server.add_file("/", data=b"y")
+            with pool.urlopen(url_dropper) as response:
+                response.read()
+            sleep(0.05)  # Let the server finish hanging up
+
+            # A connection the server dropped while idle shall be replaced seamlessly
+            with pool.urlopen(url) as response:
+                self.assertEqual(response.read(), b"y")
+            self.assertEqual(pool.connections_created, 2)
+
+    def test_redirects_and_errors(self):
+        with StandInServer() as server, HTTPConnectionPool() as pool:
+            server.add_file("/target", data=b"here")
+            url = server.add_file("/redirect", data=b"", redirect_to="/target")
+
+            # Redirects shall be followed
+            with pool.urlopen(url) as response:
+                self.assertEqual(response.read(), b"here")
+
+            # Error statuses shall raise like urllib does
+            with self.assertRaises(HTTPError) as context:
+                pool.urlopen(server.url_for("/missing"))
+            self.assertEqual(context.exception.code, 404)
+
+            # Only HTTP(S) is supported
+            with self.assertRaises(ValueError):
+                pool.urlopen("ftp://example.com/")
+
+
+@patch.object(request, "_MIN_PART_SIZE", 1000)
+class TestRangedDownload(TestCase):
+    def test_downloading_in_parts(self):
+        data = urandom(10_500)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/big", data=data, filename="big.bin")
+
+            uut = download_file_from_(url=url, dest_dir=Path(tmpdir), parts=4)
+
+            # The parts shall be stitched back together in the right places
+            self.assertEqual(uut, Path(tmpdir).joinpath("big.bin"))
+            self.assertEqual(uut.read_bytes(), data)
+
+            # Ranges shall only be asked for after a one byte range shows the server
+            # supports them, and the ranges shall cover the file without overlapping
+            methods = [method for method, _, _ in server.requests]
+            self.assertEqual(methods, ["GET"] * 5)
+            self.assertEqual(server.requests[0][2]["Range"], "bytes=0-0")
+            self.assertListEqual(
+                sorted(headers["Range"] for _, _, headers in server.requests[1:]),
+                [
+                    "bytes=0-2624",
+                    "bytes=2625-5249",
+                    "bytes=5250-7874",
+                    "bytes=7875-10499",
+                ],
+            )
+
+    def test_downloading_in_parts_with_pool(self):
+        data = urandom(4000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, (
+            HTTPConnectionPool()
+        ) as pool:
+            url = server.add_file("/big", data=data, filename="big.bin")
+
+            uut = download_file_from_(
+                url=url, dest_dir=Path(tmpdir), pool=pool, parts=4
+            )
+
+            # Parts smaller than the minimum shall not be made
+            self.assertEqual(uut.read_bytes(), data)
+            self.assertEqual(server.request_count, 5)
+            self.assertEqual(pool.connections_created + pool.connections_reused, 5)
+
+    def test_falling_back_to_one_stream(self):
+        data = urandom(10_000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            # Servers that don't support ranges shall get a normal download
+            url = server.add_file("/big", data=data, filename="a", accept_ranges=False)
+            uut = download_file_from_(url=url, dest_dir=Path(tmpdir), parts=4)
+            self.assertEqual(uut.read_bytes(), data)
+            self.assertNotIn("Range", server.requests[-1][2])
+
+            # Files too small to split up shall get a normal download
+            url = server.add_file("/small", data=data[:1999], filename="b")
+            uut = download_file_from_(url=url, dest_dir=Path(tmpdir), parts=4)
+            self.assertEqual(uut.read_bytes(), data[:1999])
+            self.assertNotIn("Range", server.requests[-1][2])
+
+    def test_server_without_head(self):
+        data = urandom(10_000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            # Servers that refuse HEAD (like presigned S3 URLs do) shall still get
+            # downloaded from in parts
+            url = server.add_file("/big", data=data, filename="a", head_status=405)
+            uut = download_file_from_(url=url, dest_dir=Path(tmpdir), parts=4)
+            self.assertEqual(uut.read_bytes(), data)
+            self.assertEqual(server.request_count, 5)
+
+    def test_failing_probe(self):
+        data = urandom(10_000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file(
+                "/big", data=data, filename="a", fail_first=1, fail_status=403
+            )
+
+            # A failing probe shall get a normal download rather than an error
+            uut = download_file_from_(url=url, dest_dir=Path(tmpdir), parts=4)
+            self.assertEqual(uut.read_bytes(), data)
+            self.assertEqual(server.request_count, 2)
+            self.assertNotIn("Range", server.requests[-1][2])
+
+    def test_failing_part(self):
+        real_download_range = request._download_range_
+        real_write_all = request._write_all_
+
+        def fail_first_part(url, pool, fpath_dest, start, *args):
+            if start == 0:
+                sleep(0.2)  # Once the other part's well underway
+                raise ValueError("Part failed")
+            real_download_range(url, pool, fpath_dest, start, *args)
+
+        def write_slowly(fout, data):
+            sleep(0.01)
+            real_write_all(fout, data)
+
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, patch.object(
+            request, "_download_range_", side_effect=fail_first_part
+        ), patch.object(request, "_write_all_", side_effect=write_slowly):
+            url = server.add_file("/big", data=urandom(100_000), filename="big.bin")
+
+            # The other parts shall stop rather than download what'll be thrown away
+            started = monotonic()
+            with self.assertRaises(ValueError):
+                download_file_from_(
+                    url=url, dest_dir=Path(tmpdir), parts=2, chunk_size=100
+                )
+            self.assertLess(monotonic() - started, 2)
+            self.assertFalse(Path(tmpdir).joinpath("big.bin").exists())
+
+    def test_existing_file(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/big", data=urandom(10_000), filename="big.bin")
+            Path(tmpdir).joinpath("big.bin").write_bytes(b"old")
+
+            # Existing files shall not be overwritten
+            with self.assertRaises(FileExistsError):
+                download_file_from_(url=url, dest_dir=Path(tmpdir), parts=4)
+            self.assertEqual(Path(tmpdir).joinpath("big.bin").read_bytes(), b"old")
+
+    def test_file_changing_mid_download(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/big", data=urandom(10_000), filename="big.bin")
+            real_urlopen = request.request.urlopen
+
+            def change_file_after_head(req, *args, **kwargs):
+                response = real_urlopen(req, *args, **kwargs)
+                if req.get_header("Range") == "bytes=0-0":
+                    server.add_file("/big", data=urandom(10_000), filename="big.bin")
+                return response
+
+            with patch.object(*_PATCHARGS_URLOPEN, side_effect=change_file_after_head):
+                # Mixing parts of two different files shall be refused
+                with self.assertRaises(HTTPException):
+                    download_file_from_(url=url, dest_dir=Path(tmpdir), parts=4)
+
+            # The half-written file shall be cleaned up
+            self.assertFalse(Path(tmpdir).joinpath("big.bin").exists())
+
+
+@patch.object(request, "_CHECKPOINT_INTERVAL", 100)
+class TestResumableDownload(TestCase):
+    def test_resuming(self):
+        data = urandom(1000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file(
+                "/f", data=data, filename="f.bin", drop_after_bytes=450
+            )
+            dpath_dest = Path(tmpdir)
+
+            # A dropped connection shall raise but keep what was downloaded so far
+            with self.assertRaises(IncompleteRead):
+                download_file_from_(
+                    url=url, dest_dir=dpath_dest, resumable=True, chunk_size=10
+                )
+            self.assertFalse(dpath_dest.joinpath("f.bin").exists())
+            self.assertEqual(len(list(dpath_dest.glob("*.part"))), 1)
+            self.assertEqual(len(list(dpath_dest.glob("*.part.json"))), 1)
+
+            # Trying again shall only ask for what's missing
+            server.files["/f"].drop_after_bytes = None
+            uut = download_file_from_(
+                url=url, dest_dir=dpath_dest, resumable=True, chunk_size=10
+            )
+            self.assertEqual(server.requests[-1][2]["Range"], "bytes=450-")
+            self.assertEqual(
+                server.requests[-1][2]["If-Range"], server.files["/f"].etag
+            )
+
+            # The finished file shall be whole and the leftovers shall be gone
+            self.assertEqual(uut, dpath_dest.joinpath("f.bin"))
+            self.assertEqual(uut.read_bytes(), data)
+            self.assertListEqual(list(dpath_dest.iterdir()), [uut])
+
+    def test_restarting_when_file_changed(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/f", data=urandom(1000), drop_after_bytes=450)
+            with self.assertRaises(IncompleteRead):
+                download_file_from_(
+                    url=url, dest_dir=Path(tmpdir), resumable=True, chunk_size=10
+                )
+
+            # Bytes from an older version of the file shall not be kept
+            data = urandom(800)
+            server.add_file("/f", data=data, filename="f.bin")
+            uut = download_file_from_(
+                url=url, dest_dir=Path(tmpdir), resumable=True, chunk_size=10
+            )
+            self.assertEqual(uut.read_bytes(), data)
+            self.assertListEqual(list(Path(tmpdir).iterdir()), [uut])
+
+    def test_checkpoint_behind_file(self):
+        data = urandom(1000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file(
+                "/f", data=data, filename="f.bin", drop_after_bytes=450
+            )
+            with self.assertRaises(IncompleteRead):
+                download_file_from_(
+                    url=url, dest_dir=Path(tmpdir), resumable=True, chunk_size=10
+                )
+
+            # Simulate dying after writing bytes but before checkpointing them
+            fpath_part = next(Path(tmpdir).glob("*.part"))
+            with open(fpath_part, "ab") as fout:
+                fout.write(b"garbage")
+
+            # Only what the checkpoint vouches for shall be kept
+            server.files["/f"].drop_after_bytes = None
+            uut = download_file_from_(
+                url=url, dest_dir=Path(tmpdir), resumable=True, chunk_size=10
+            )
+            self.assertEqual(uut.read_bytes(), data)
+
+    def test_existing_file(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/f", data=b"new", filename="f.bin")
+            Path(tmpdir).joinpath("f.bin").write_bytes(b"old")
+
+            # Existing files shall not be overwritten
+            with self.assertRaises(FileExistsError):
+                download_file_from_(
+                    url=url, dest_dir=Path(tmpdir), resumable=True, chunk_size=10
+                )
+            self.assertEqual(Path(tmpdir).joinpath("f.bin").read_bytes(), b"old")
+
+    def test_not_combinable_with_parts(self):
+        with TemporaryDirectory() as tmpdir:
+            with self.assertRaises(ValueError):
+                download_file_from_(
+                    url="doesn't matter", dest_dir=Path(tmpdir), parts=2, resumable=True
+                )
+
+
+class TestStreaming(TestCase):
+    def test_chunk_sizes(self):
+        data = urandom(10_000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/f", data=data)
+
+            # Any chunk size shall produce the same file
+            for chunk_size in (1, 7, 4096, 1_000_000):
+                dpath_dest = Path(tmpdir).joinpath(str(chunk_size))
+                dpath_dest.mkdir()
+                uut = download_file_from_(
+                    url=url, dest_dir=dpath_dest, chunk_size=chunk_size
+                )
+                self.assertEqual(uut.read_bytes(), data)
+
+            with self.assertRaises(ValueError):
+                download_file_from_(url=url, dest_dir=Path(tmpdir), chunk_size=0)
+
+    def test_profiling(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/f", data=urandom(1000))
+            profiler.reset()
+            profiler.enabled = True
+            try:
+                download_file_from_(url=url, dest_dir=Path(tmpdir))
+            finally:
+                profiler.enabled = False
+            self.assertEqual(profiler.report()["download_file_from_"]["count"], 1)
+            profiler.reset()
+
+    def test_cut_short(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/f", data=urandom(1000), drop_after_bytes=10)
+
+            # Bodies that end early shall not pass for complete downloads
+            with self.assertRaises(IncompleteRead):
+                download_file_from_(url=url, dest_dir=Path(tmpdir))
+
+    @skipUnless(hasattr(os, "splice"), "splice is Linux-only")
+    def test_zero_copy(self):
+        data = urandom(1_000_000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, (
+            HTTPConnectionPool()
+        ) as pool, patch.object(
+            request, "_splice_body_", wraps=request._splice_body_
+        ) as spy_splice:
+            url = server.add_file("/f", data=data, filename="f.bin")
+            server.add_file("/g", data=data[:10], filename="g.bin")
+
+            # Plain HTTP downloads shall be spliced and come out the same
+            uut = download_file_from_(
+                url=url, dest_dir=Path(tmpdir), pool=pool, zero_copy=True
+            )
+            self.assertEqual(spy_splice.call_count, 1)
+            self.assertEqual(uut.read_bytes(), data)
+
+            # The connection shall still be reusable afterwards
+            uut = download_file_from_(
+                url=server.url_for("/g"), dest_dir=Path(tmpdir), pool=pool
+            )
+            self.assertEqual(uut.read_bytes(), data[:10])
+            self.assertEqual(pool.connections_reused, 1)
+
+            # Connections with timeouts can't be spliced and shall take the usual path
+            with HTTPConnectionPool(timeout_sec=10) as pool_with_timeouts:
+                dpath_dest = Path(tmpdir).joinpath("timeouts")
+                dpath_dest.mkdir()
+                uut = download_file_from_(
+                    url=url,
+                    dest_dir=dpath_dest,
+                    pool=pool_with_timeouts,
+                    zero_copy=True,
+                )
+            self.assertEqual(spy_splice.call_count, 1)
+            self.assertEqual(uut.read_bytes(), data)
+
+    @skipUnless(hasattr(os, "splice"), "splice is Linux-only")
+    def test_zero_copy_parts(self):
+        data = urandom(10_000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, patch.object(
+            request, "_MIN_PART_SIZE", 1000
+        ):
+            url = server.add_file("/f", data=data, filename="f.bin")
+
+            # Spliced parts shall land at their offsets too
+            uut = download_file_from_(
+                url=url, dest_dir=Path(tmpdir), parts=4, zero_copy=True, chunk_size=999
+            )
+            self.assertEqual(uut.read_bytes(), data)
+
+
+class TestDownloadCache(TestCase):
+    def setUp(self) -> None:
+        self._tmpdir = TemporaryDirectory()
+        self.dpath_cache = Path(self._tmpdir.name).joinpath("cache")
+        self.dpath_downloads = Path(self._tmpdir.name).joinpath("downloads")
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self._tmpdir.cleanup()
+        return super().tearDown()
+
+    def _fresh_dest_dir(self) -> Path:
+        dpath = self.dpath_downloads.joinpath(str(uuid4()))
+        dpath.mkdir(parents=True)
+        return dpath
+
+    def test_revalidating(self):
+        data = urandom(1000)
+        with StandInServer() as server, HTTPConnectionPool() as pool:
+            url = server.add_file("/f", data=data, filename="f.bin")
+            uut = DownloadCache(dirpath=self.dpath_cache, max_size_bytes=10_000)
+
+            # The first download shall be a miss
+            fpath = download_file_from_(
+                url=url, dest_dir=self._fresh_dest_dir(), pool=pool, cache=uut
+            )
+            self.assertEqual(fpath.read_bytes(), data)
+            self.assertEqual((uut.hits, uut.misses), (0, 1))
+            self.assertEqual(uut.size_bytes, 1000)
+
+            # Downloading it again shall only ask whether it changed
+            fpath = download_file_from_(
+                url=url, dest_dir=self._fresh_dest_dir(), pool=pool, cache=uut
+            )
+            self.assertEqual(fpath.name, "f.bin")
+            self.assertEqual(fpath.read_bytes(), data)
+            self.assertEqual((uut.hits, uut.misses), (1, 1))
+            _, _, headers = server.requests[-1]
+            self.assertEqual(headers["If-None-Match"], server.files["/f"].etag)
+            self.assertEqual(
+                headers["If-Modified-Since"], server.files["/f"].last_modified
+            )
+
+            # The pool shall be able to reuse the connection after a 304
+            self.assertEqual(pool.connections_created, 1)
+
+            # Without a pool (where urllib raises for 304s) it shall work the same
+            fpath = download_file_from_(
+                url=url, dest_dir=self._fresh_dest_dir(), cache=uut
+            )
+            self.assertEqual(fpath.read_bytes(), data)
+            self.assertEqual((uut.hits, uut.misses), (2, 1))
+
+            # The cache shall survive being reopened
+            uut = DownloadCache(dirpath=self.dpath_cache, max_size_bytes=10_000)
+            download_file_from_(url=url, dest_dir=self._fresh_dest_dir(), cache=uut)
+            self.assertEqual((uut.hits, uut.misses), (1, 0))
+
+    def test_changed_content(self):
+        with StandInServer() as server:
+            url = server.add_file("/f", data=b"old")
+            uut = DownloadCache(dirpath=self.dpath_cache, max_size_bytes=10_000)
+            download_file_from_(url=url, dest_dir=self._fresh_dest_dir(), cache=uut)
+
+            # Content that changed shall be downloaded and replace what was cached
+            server.add_file("/f", data=b"newer")
+            fpath = download_file_from_(
+                url=url, dest_dir=self._fresh_dest_dir(), cache=uut
+            )
+            self.assertEqual(fpath.read_bytes(), b"newer")
+            self.assertEqual((uut.hits, uut.misses), (0, 2))
+            self.assertEqual(uut.size_bytes, 5)
+            self.assertEqual(
+                len(list(self.dpath_cache.joinpath("objects").iterdir())), 1
+            )
+
+    def test_lru_eviction(self):
+        with StandInServer() as server:
+            urls = {
+                name: server.add_file(f"/{name}", data=urandom(1000)) for name in "abc"
+            }
+            uut = DownloadCache(dirpath=self.dpath_cache, max_size_bytes=2500)
+            for name in "aba":
+                download_file_from_(
+                    url=urls[name], dest_dir=self._fresh_dest_dir(), cache=uut
+                )
+
+            # Going over the limit shall evict what was used longest ago
+            download_file_from_(
+                url=urls["c"], dest_dir=self._fresh_dest_dir(), cache=uut
+            )
+            self.assertEqual(uut.evictions, 1)
+            self.assertLessEqual(uut.size_bytes, 2500)
+            for name, expected_hits in (("a", 2), ("c", 3), ("b", 3)):
+                download_file_from_(
+                    url=urls[name], dest_dir=self._fresh_dest_dir(), cache=uut
+                )
+                self.assertEqual(uut.hits, expected_hits)
+
+    def test_index_writes(self):
+        with StandInServer() as server:
+            urls = [server.add_file(f"/{i}", data=urandom(1000)) for i in range(3)]
+            uut = DownloadCache(dirpath=self.dpath_cache, max_size_bytes=10_000)
+            download_file_from_(url=urls[0], dest_dir=self._fresh_dest_dir(), cache=uut)
+
+            # Hits shall not rewrite the index every time, and stores shall not list
+            # the whole cache to know how big it is
+            with patch.object(
+                uut, "_save_index", wraps=uut._save_index
+            ) as spy, patch.object(
+                Path, "iterdir", side_effect=AssertionError("listed")
+            ):
+                for _ in range(5):
+                    download_file_from_(
+                        url=urls[0], dest_dir=self._fresh_dest_dir(), cache=uut
+                    )
+                self.assertEqual(spy.call_count, 0)
+                for url in urls[1:]:
+                    download_file_from_(
+                        url=url, dest_dir=self._fresh_dest_dir(), cache=uut
+                    )
+            self.assertEqual(uut.size_bytes, 3000)
+
+            # What the hits changed shall be saved once it's closed
+            download_file_from_(url=urls[0], dest_dir=self._fresh_dest_dir(), cache=uut)
+            uut.close()
+            reopened = DownloadCache(dirpath=self.dpath_cache, max_size_bytes=10_000)
+            self.assertDictEqual(reopened._index, uut._index)
+            self.assertEqual(reopened.size_bytes, 3000)
+
+            # Content stored by a process that crashed before saving shall be removed
+            fpath_stray = self.dpath_cache.joinpath("objects", "0" * 64)
+            fpath_stray.write_bytes(b"x")
+            DownloadCache(dirpath=self.dpath_cache, max_size_bytes=10_000)
+            self.assertFalse(fpath_stray.exists())
+
+    def test_copying_without_blocking(self):
+        real_clone_or_link_or_copy = request._clone_or_link_or_copy_
+        copying = Event()
+        done_copying = Event()
+
+        def copy_slowly(fpath_src, fpath_dest, allow_link):
+            if fpath_dest.parent.name == "slow":
+                copying.set()
+                done_copying.wait(timeout=10)
+            real_clone_or_link_or_copy(fpath_src, fpath_dest, allow_link)
+
+        with StandInServer() as server, patch.object(
+            request, "_clone_or_link_or_copy_", side_effect=copy_slowly
+        ):
+            url_slow = server.add_file("/slow", data=b"slow")
+            url_other = server.add_file("/other", data=b"other")
+            uut = DownloadCache(
+                dirpath=self.dpath_cache, max_size_bytes=6, allow_hardlinks=False
+            )
+            download_file_from_(
+                url=url_slow, dest_dir=self._fresh_dest_dir(), cache=uut
+            )
+            dpath_slow = self.dpath_downloads.joinpath("slow")
+            dpath_slow.mkdir()
+            hit = Thread(
+                target=download_file_from_,
+                kwargs={"url": url_slow, "dest_dir": dpath_slow, "cache": uut},
+            )
+            hit.start()
+            try:
+                copying.wait(timeout=10)
+
+                # Other downloads shall not wait for a hit that's copying
+                started = monotonic()
+                download_file_from_(
+                    url=url_other, dest_dir=self._fresh_dest_dir(), cache=uut
+                )
+                self.assertLess(monotonic() - started, 5)
+            finally:
+                done_copying.set()
+                hit.join()
+
+            # And what's being copied shall not be evicted meanwhile, even though
+            # storing the other download went over the limit
+            self.assertEqual(next(dpath_slow.iterdir()).read_bytes(), b"slow")
+            self.assertEqual(uut.hits, 1)
+
+    def test_serving_without_copying(self):
+        data = urandom(1000)
+        with StandInServer() as server, patch.object(
+            request, request.copyfileobj.__name__, side_effect=AssertionError
+        ), patch.object(request, request.copyfile.__name__, side_effect=AssertionError):
+            url = server.add_file("/f", data=data)
+            uut = DownloadCache(dirpath=self.dpath_cache, max_size_bytes=10_000)
+
+            # Cached content shall be cloned or hard-linked rather than copied
+            for _ in range(2):
+                fpath = download_file_from_(
+                    url=url, dest_dir=self._fresh_dest_dir(), cache=uut
+                )
+                self.assertEqual(fpath.read_bytes(), data)
+
+    def test_without_hardlinks(self):
+        with StandInServer() as server:
+            url = server.add_file("/f", data=b"data")
+            uut = DownloadCache(
+                dirpath=self.dpath_cache, max_size_bytes=10_000, allow_hardlinks=False
+            )
+
+            # Downloads shall then be independent of the cache
+            for _ in range(2):
+                fpath = download_file_from_(
+                    url=url, dest_dir=self._fresh_dest_dir(), cache=uut
+                )
+                self.assertEqual(fpath.stat().st_nlink, 1)
+                self.assertEqual(fpath.read_bytes(), b"data")
+
+    def test_existing_file_and_invalid_combinations(self):
+        with StandInServer() as server:
+            url = server.add_file("/f", data=b"new", filename="f.bin")
+            uut = DownloadCache(dirpath=self.dpath_cache, max_size_bytes=10_000)
+            dpath_dest = self._fresh_dest_dir()
+            download_file_from_(url=url, dest_dir=dpath_dest, cache=uut)
+
+            # Files shall not be overwritten, even when served from the cache
+            with self.assertRaises(FileExistsError):
+                download_file_from_(url=url, dest_dir=dpath_dest, cache=uut)
+
+            with self.assertRaises(ValueError):
+                download_file_from_(url=url, dest_dir=dpath_dest, cache=uut, parts=2)
+            with self.assertRaises(ValueError):
+                download_file_from_(
+                    url=url, dest_dir=dpath_dest, cache=uut, resumable=True
+                )
+
+
+class TestDigestVerification(TestCase):
+    _DATA = urandom(10_000)
+    _DIGESTS = {
+        "sha256": sha256(_DATA).hexdigest(),
+        "sha512": sha512(_DATA).hexdigest(),
+        "blake2b": blake2b(_DATA).hexdigest(),
+    }
+    _WRONG_DIGESTS = {**_DIGESTS, "sha512": sha512(b"something else").hexdigest()}
+
+    def test_streaming(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, patch.object(
+            request._DigestVerifier,
+            request._DigestVerifier.update_from_.__name__,
+            side_effect=AssertionError("Shall not read the file back"),
+        ):
+            url = server.add_file("/f", data=self._DATA, filename="f.bin")
+
+            # Matching digests shall be verified as the download streams by
+            uut = download_file_from_(
+                url=url, dest_dir=Path(tmpdir), expected_digests=self._DIGESTS
+            )
+            self.assertEqual(uut.read_bytes(), self._DATA)
+            uut.unlink()
+
+            # Any digest not matching shall raise and leave nothing behind
+            with self.assertRaises(DigestMismatchError) as context:
+                download_file_from_(
+                    url=url, dest_dir=Path(tmpdir), expected_digests=self._WRONG_DIGESTS
+                )
+            self.assertEqual(context.exception.algorithm, "sha512")
+            self.assertListEqual(list(Path(tmpdir).iterdir()), [])
+
+    def test_unknown_algorithm(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/f", data=self._DATA)
+
+            # Unknown algorithms shall be rejected before downloading anything
+            with self.assertRaises(ValueError):
+                download_file_from_(
+                    url=url, dest_dir=Path(tmpdir), expected_digests={"nope": "00"}
+                )
+            self.assertEqual(server.request_count, 0)
+
+    @patch.object(request, "_MIN_PART_SIZE", 1000)
+    def test_parts(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/f", data=self._DATA, filename="f.bin")
+
+            uut = download_file_from_(
+                url=url, dest_dir=Path(tmpdir), parts=4, expected_digests=self._DIGESTS
+            )
+            self.assertEqual(uut.read_bytes(), self._DATA)
+            uut.unlink()
+
+            with self.assertRaises(DigestMismatchError):
+                download_file_from_(
+                    url=url,
+                    dest_dir=Path(tmpdir),
+                    parts=4,
+                    expected_digests=self._WRONG_DIGESTS,
+                )
+            self.assertListEqual(list(Path(tmpdir).iterdir()), [])
+
+    def test_resuming(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file(
+                "/f", data=self._DATA, filename="f.bin", drop_after_bytes=4000
+            )
+            with self.assertRaises(IncompleteRead):
+                download_file_from_(
+                    url=url,
+                    dest_dir=Path(tmpdir),
+                    resumable=True,
+                    expected_digests=self._DIGESTS,
+                )
+
+            # Bytes from before resuming shall count towards the digests too
+            server.files["/f"].drop_after_bytes = None
+            uut = download_file_from_(
+                url=url,
+                dest_dir=Path(tmpdir),
+                resumable=True,
+                expected_digests=self._DIGESTS,
+            )
+            self.assertEqual(server.requests[-1][2]["Range"], "bytes=4000-")
+            self.assertEqual(uut.read_bytes(), self._DATA)
+            uut.unlink()
+
+            # Mismatches shall discard the progress too so the next try starts over
+            with self.assertRaises(DigestMismatchError):
+                download_file_from_(
+                    url=url,
+                    dest_dir=Path(tmpdir),
+                    resumable=True,
+                    expected_digests=self._WRONG_DIGESTS,
+                )
+            self.assertListEqual(list(Path(tmpdir).iterdir()), [])
+
+    def test_cache(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/f", data=self._DATA, filename="f.bin")
+            cache = DownloadCache(
+                dirpath=Path(tmpdir).joinpath("cache"), max_size_bytes=100_000
+            )
+            dpath_dest = Path(tmpdir).joinpath("downloads")
+            dpath_dest.mkdir()
+
+            # Content that doesn't match shall not make it into the cache
+            with self.assertRaises(DigestMismatchError):
+                download_file_from_(
+                    url=url,
+                    dest_dir=dpath_dest,
+                    cache=cache,
+                    expected_digests=self._WRONG_DIGESTS,
+                )
+            self.assertEqual(cache.size_bytes, 0)
+            self.assertListEqual(list(dpath_dest.iterdir()), [])
+
+            # Cache hits expecting only SHA-256 shall not need to read anything
+            download_file_from_(url=url, dest_dir=dpath_dest, cache=cache).unlink()
+            with patch.object(
+                request._DigestVerifier,
+                request._DigestVerifier.update_from_.__name__,
+                side_effect=AssertionError("Shall not read the file back"),
+            ):
+                uut = download_file_from_(
+                    url=url,
+                    dest_dir=dpath_dest,
+                    cache=cache,
+                    expected_digests={"sha256": self._DIGESTS["sha256"]},
+                )
+            self.assertEqual(cache.hits, 1)
+            uut.unlink()
+
+            # Cache hits expecting something else shall be checked too
+            with self.assertRaises(DigestMismatchError):
+                download_file_from_(
+                    url=url,
+                    dest_dir=dpath_dest,
+                    cache=cache,
+                    expected_digests=self._WRONG_DIGESTS,
+                )
+            self.assertListEqual(list(dpath_dest.iterdir()), [])
+
+
+class TestAsyncDownload(IsolatedAsyncioTestCase):
+    async def test_downloading_a_file(self):
+        data = urandom(300_000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            dpath_dest = Path(tmpdir)
+            url_named = server.add_file("/named", data=data, filename="named.bin")
+            url_chunked = server.add_file(
+                "/chunked", data=data, filename="chunked.bin", chunked=True
+            )
+
+            # The file name shall come from Content-Disposition when there is one
+            uut = await async_download_file_from_(url=url_named, dest_dir=dpath_dest)
+            self.assertEqual(uut, dpath_dest.joinpath("named.bin"))
+            self.assertEqual(uut.read_bytes(), data)
+
+            # Chunked bodies shall be put back together, in small reads or large
+            uut = await async_download_file_from_(
+                url=url_chunked, dest_dir=dpath_dest, chunk_size=7
+            )
+            self.assertEqual(uut, dpath_dest.joinpath("chunked.bin"))
+            self.assertEqual(uut.read_bytes(), data)
+
+            # Existing files shall not be overwritten
+            with self.assertRaises(FileExistsError):
+                await async_download_file_from_(url=url_named, dest_dir=dpath_dest)
+            self.assertEqual(dpath_dest.joinpath("named.bin").read_bytes(), data)
+
+    async def test_redirects_and_errors(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            dpath_dest = Path(tmpdir)
+            server.add_file("/real", data=b"real", filename="real.txt")
+            url_redirect = server.add_file("/redirect", data=b"", redirect_to="/real")
+            url_truncated = server.add_file(
+                "/truncated",
+                data=b"x" * 1000,
+                filename="truncated.bin",
+                drop_after_bytes=100,
+            )
+
+            uut = await async_download_file_from_(url=url_redirect, dest_dir=dpath_dest)
+            self.assertEqual(uut.read_bytes(), b"real")
+
+            with self.assertRaises(HTTPError) as ctx:
+                await async_download_file_from_(
+                    url=server.url_for("/missing"), dest_dir=dpath_dest
+                )
+            self.assertEqual(ctx.exception.code, 404)
+
+            # Bodies cut short shall be reported rather than passed off as complete, and
+            # leave nothing behind that would get in the way of trying again
+            for _ in range(2):
+                with self.assertRaises(IncompleteRead):
+                    await async_download_file_from_(
+                        url=url_truncated, dest_dir=dpath_dest
+                    )
+                self.assertFalse(dpath_dest.joinpath("truncated.bin").exists())
+
+            # Bad destinations shall be rejected before connecting
+            with self.assertRaises(FileNotFoundError):
+                await async_download_file_from_(
+                    url=url_redirect, dest_dir=dpath_dest.joinpath("missing")
+                )
+
+    async def test_cancelling_deletes_the_partial_file(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            dpath_dest = Path(tmpdir)
+            url = server.add_file(
+                "/slow", data=b"x" * 100_000, filename="slow.bin", stall_mid_body_sec=5
+            )
+
+            task = create_task(
+                async_download_file_from_(url=url, dest_dir=dpath_dest, chunk_size=10)
+            )
+            while not dpath_dest.joinpath("slow.bin").exists():
+                await sleep_async(0.01)
+            task.cancel()
+            with self.assertRaises(BaseException):
+                await task
+            self.assertTrue(task.cancelled())
+            self.assertListEqual(list(dpath_dest.iterdir()), [])
+
+    async def test_running_out_of_time(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            dpath_dest = Path(tmpdir)
+            url = server.add_file(
+                "/slow", data=b"x" * 100_000, filename="slow.bin", stall_mid_body_sec=5
+            )
+
+            # Running out of time shall work out like being cancelled
+            with deadline_after_(0.5), self.assertRaises(DeadlineExceeded):
+                await wait_for(
+                    async_download_file_from_(url=url, dest_dir=dpath_dest), 3
+                )
+            self.assertListEqual(list(dpath_dest.iterdir()), [])
+
+    async def test_downloading_many_files(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            dpath_dest = Path(tmpdir)
+            expected = {
+                server.add_file(f"/{i}", data=f"file {i}".encode(), filename=f"{i}.txt")
+                for i in range(200)
+            }
+            url_missing = server.url_for("/missing")
+
+            results = [
+                result
+                async for result in async_download_files_from_(
+                    urls=[*expected, url_missing],
+                    dest_dir=dpath_dest,
+                    max_per_host=4,
+                )
+            ]
+
+            # Every URL shall get one result, with failures reported per URL
+            self.assertEqual(len(results), 201)
+            for result in results:
+                if result.url == url_missing:
+                    self.assertIsInstance(result.error, HTTPError)
+                    continue
+                self.assertTrue(result.succeeded)
+                assert result.fpath is not None
+                self.assertEqual(
+                    result.fpath.read_bytes(), f"file {result.fpath.stem}".encode()
+                )
+            # And no host shall be sent more than its share of requests at once
+            self.assertLessEqual(server.max_in_flight, 4)
+
+    async def test_stopping_early_cancels_the_rest(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            dpath_dest = Path(tmpdir)
+            url_fast = server.add_file("/fast", data=b"fast", filename="fast.txt")
+            url_slow = server.add_file(
+                "/slow", data=b"x" * 1000, filename="slow.bin", stall_mid_body_sec=5
+            )
+
+            # Destination checks shall happen before anything is iterated
+            with self.assertRaises(FileNotFoundError):
+                async_download_files_from_(
+                    urls=[url_fast], dest_dir=dpath_dest.joinpath("missing")
+                )
+
+            results = async_download_files_from_(
+                urls=[url_fast, url_slow], dest_dir=dpath_dest
+            )
+            async for result in results:
+                self.assertEqual(result.url, url_fast)
+                break
+            await wait_for(results.aclose(), timeout=2)
+            self.assertListEqual(list(dpath_dest.iterdir()), [dpath_dest / "fast.txt"])
+
+
+class TestDecompression(TestCase):
+    # Compressible, but not so repetitive that it's a toy
+    _DATA = b"".join(f"line {i}: {i * i}\n".encode() for i in range(50_000))
+
+    def test_compressed_transfer(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            for encoding in ("gzip", "deflate", "raw-deflate"):
+                dpath_dest = Path(tmpdir).joinpath(encoding)
+                dpath_dest.mkdir()
+                url = server.add_file(
+                    f"/{encoding}",
+                    data=self._DATA,
+                    filename="data.txt",
+                    content_encoding=encoding,
+                )
+                bytes_sent_before = server.body_bytes_sent
+
+                # What's saved shall be the same as what an uncompressed transfer
+                # saves, even with chunks much smaller than what they decode to
+                uut = download_file_from_(
+                    url=url,
+                    dest_dir=dpath_dest,
+                    compressed_transfer=True,
+                    chunk_size=99,
+                )
+                self.assertEqual(uut.read_bytes(), self._DATA)
+                # And far fewer bytes shall have been transferred
+                self.assertLess(
+                    server.body_bytes_sent - bytes_sent_before, len(self._DATA) / 3
+                )
+                self.assertIn("gzip", server.requests[-1][2]["Accept-Encoding"])
+
+            # Compression shall not be asked for unless it's wanted
+            dpath_dest = Path(tmpdir).joinpath("identity")
+            dpath_dest.mkdir()
+            uut = download_file_from_(url=server.url_for("/gzip"), dest_dir=dpath_dest)
+            self.assertEqual(uut.read_bytes(), self._DATA)
+            self.assertNotIn("gzip", server.requests[-1][2].get("Accept-Encoding", ""))
+
+    def test_compressed_transfer_over_pool_with_digests(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, (
+            HTTPConnectionPool()
+        ) as pool:
+            url = server.add_file(
+                "/f", data=self._DATA, filename="f.txt", content_encoding="gzip"
+            )
+
+            # Digests shall be of the decoded file, and the connection reusable
+            uut = download_file_from_(
+                url=url,
+                dest_dir=Path(tmpdir),
+                pool=pool,
+                compressed_transfer=True,
+                expected_digests={"sha256": sha256(self._DATA).hexdigest()},
+            )
+            self.assertEqual(uut.read_bytes(), self._DATA)
+            uut.unlink()
+            with self.assertRaises(DigestMismatchError):
+                download_file_from_(
+                    url=url,
+                    dest_dir=Path(tmpdir),
+                    pool=pool,
+                    compressed_transfer=True,
+                    expected_digests={"sha256": "0" * 64},
+                )
+            self.assertEqual(pool.connections_reused, 1)
+
+    def test_decompressing_archives(self):
+        gz = gzip_compress(self._DATA[:1000]) + gzip_compress(self._DATA[1000:])
+        xz = xz_compress(self._DATA, preset=0)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            dpath_dest = Path(tmpdir)
+            url_gz = server.add_file("/gz", data=gz, filename="data.txt.gz")
+            url_tgz = server.add_file("/tgz", data=gz, filename="data.tgz")
+            url_xz = server.add_file("/xz", data=xz, filename="data.bin.xz")
+            url_plain = server.add_file("/plain", data=b"plain", filename="plain.txt")
+
+            # Archives shall land decompressed (every gzip member of them), without
+            # their compression suffix, and checked against the digest of the archive
+            uut = download_file_from_(
+                url=url_gz,
+                dest_dir=dpath_dest,
+                decompress=True,
+                chunk_size=300,
+                expected_digests={"sha256": sha256(gz).hexdigest()},
+            )
+            self.assertEqual(uut, dpath_dest.joinpath("data.txt"))
+            self.assertEqual(uut.read_bytes(), self._DATA)
+            uut = download_file_from_(url=url_tgz, dest_dir=dpath_dest, decompress=True)
+            self.assertEqual(uut, dpath_dest.joinpath("data.tar"))
+            self.assertEqual(uut.read_bytes(), self._DATA)
+            uut = download_file_from_(url=url_xz, dest_dir=dpath_dest, decompress=True)
+            self.assertEqual(uut, dpath_dest.joinpath("data.bin"))
+            self.assertEqual(uut.read_bytes(), self._DATA)
+
+            # Other files shall be saved as usual
+            uut = download_file_from_(
+                url=url_plain, dest_dir=dpath_dest, decompress=True
+            )
+            self.assertEqual(uut.read_bytes(), b"plain")
+
+    def test_truncated_and_incompatible(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            dpath_dest = Path(tmpdir)
+            url_truncated = server.add_file(
+                "/f", data=gzip_compress(self._DATA)[:-100], filename="f.gz"
+            )
+
+            # Compressed streams that stop short shall not pass for complete
+            with self.assertRaises(EOFError):
+                download_file_from_(
+                    url=url_truncated, dest_dir=dpath_dest, decompress=True
+                )
+
+            for kwargs in ({"parts": 2}, {"resumable": True}):
+                with self.assertRaises(ValueError):
+                    download_file_from_(
+                        url=url_truncated,
+                        dest_dir=dpath_dest,
+                        compressed_transfer=True,
+                        **kwargs,
+                    )
+
+
+class _RecordingObserver(DownloadObserver):
+    def __init__(self, progress_interval_sec: float = 0) -> None:
+        super().__init__(progress_interval_sec=progress_interval_sec)
+        self.progresses = []
+        self.timings = []
+        self.failures = []
+
+    def on_progress(self, progress):
+        self.progresses.append(progress)
+
+    def on_finished(self, timings):
+        self.timings.append(timings)
+
+    def on_failed(self, url, error, elapsed_sec):
+        self.failures.append((url, error, elapsed_sec))
+
+
+class TestInstrumentation(TestCase):
+    def test_phase_timings(self):
+        data = urandom(100_000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, (
+            HTTPConnectionPool()
+        ) as pool:
+            url = server.add_file("/f", data=data, delay_sec=0.1)
+            uut = _RecordingObserver()
+
+            download_file_from_(
+                url=url, dest_dir=Path(tmpdir), pool=pool, observer=uut
+            ).unlink()
+            download_file_from_(
+                url=url, dest_dir=Path(tmpdir), pool=pool, observer=uut
+            ).unlink()
+            download_file_from_(url=url, dest_dir=Path(tmpdir), observer=uut)
+
+            fresh, reused, unpooled = uut.timings
+            # Connection setup shall be broken out whenever a connection was opened,
+            # whether by the pool or by urllib
+            for timings in (fresh, unpooled):
+                assert timings.dns_sec is not None and timings.connect_sec is not None
+                self.assertIsNone(timings.tls_sec)  # Plain HTTP
+            # But not when a connection was reused
+            self.assertIsNone(reused.dns_sec)
+            self.assertIsNone(reused.connect_sec)
+            for timings in uut.timings:
+                self.assertEqual(timings.url, url)
+                self.assertEqual(timings.bytes_transferred, len(data))
+                self.assertGreaterEqual(timings.ttfb_sec, 0.1)
+                self.assertAlmostEqual(
+                    timings.total_sec, timings.ttfb_sec + timings.transfer_sec
+                )
+                self.assertGreater(timings.average_bytes_per_sec, 0)
+            self.assertListEqual(uut.failures, [])
+
+    def test_progress(self):
+        data = urandom(100_000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server:
+            url = server.add_file("/f", data=data)
+
+            # Every chunk shall be reported when there's no interval between reports
+            uut = _RecordingObserver(progress_interval_sec=0)
+            download_file_from_(
+                url=url, dest_dir=Path(tmpdir), chunk_size=1000, observer=uut
+            ).unlink()
+            self.assertEqual(len(uut.progresses), 100)
+            self.assertListEqual(
+                [progress.bytes_done for progress in uut.progresses],
+                list(range(1000, 100_001, 1000)),
+            )
+            last = uut.progresses[-1]
+            self.assertEqual(last.bytes_expected, len(data))
+            self.assertGreater(last.average_bytes_per_sec, 0)
+
+            # And none shall be within the interval
+            uut = _RecordingObserver(progress_interval_sec=60)
+            download_file_from_(
+                url=url, dest_dir=Path(tmpdir), chunk_size=1000, observer=uut
+            )
+            self.assertListEqual(uut.progresses, [])
+            self.assertEqual(len(uut.timings), 1)
+
+    def test_parts_and_failures(self):
+        data = urandom(10_000)
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, patch.object(
+            request, "_MIN_PART_SIZE", 1000
+        ):
+            url = server.add_file("/f", data=data, filename="f.bin")
+            uut = _RecordingObserver()
+
+            # Bytes of every part shall be counted
+            download_file_from_(url=url, dest_dir=Path(tmpdir), parts=4, observer=uut)
+            self.assertEqual(uut.timings[-1].bytes_transferred, len(data))
+
+            # Failed downloads shall be reported as such
+            with self.assertRaises(FileExistsError):
+                download_file_from_(url=url, dest_dir=Path(tmpdir), observer=uut)
+            self.assertEqual(len(uut.timings), 1)
+            self.assertEqual(uut.failures[-1][0], url)
+            self.assertIsInstance(uut.failures[-1][1], FileExistsError)
+
+            # But misuse shall not count as a download
+            with self.assertRaises(ValueError):
+                download_file_from_(
+                    url=url, dest_dir=Path(tmpdir), chunk_size=0, observer=uut
+                )
+            self.assertEqual(len(uut.failures), 1)
+
+    def test_aggregate_stats(self):
+        with TemporaryDirectory() as tmpdir, StandInServer() as server, (
+            HTTPConnectionPool()
+        ) as pool:
+            urls = [
+                server.add_file(f"/{i}", data=b"x" * 1000, filename=f"{i}.txt")
+                for i in range(10)
+            ]
+            uut = DownloadStats()
+
+            results = list(
+                download_files_from_(
+                    urls=[*urls, server.url_for("/missing")],
+                    dest_dir=Path(tmpdir),
+                    pool=pool,
+                    observer=uut,
+                )
+            )
+
+            self.assertEqual(len(results), 11)
+            snapshot = uut.snapshot()
+            self.assertEqual(snapshot["downloads_succeeded"], 10)
+            self.assertEqual(snapshot["downloads_failed"], 1)
+            self.assertEqual(snapshot["bytes_transferred"], 10_000)
+            self.assertGreater(snapshot["connections_opened"], 0)
+            self.assertLessEqual(
+                snapshot["connections_opened"], pool.connections_created
+            )
+            self.assertGreater(snapshot["mean_ttfb_sec"], 0)
+            self.assertGreaterEqual(
+                snapshot["max_total_sec"], snapshot["mean_ttfb_sec"]
+            )
+            self.assertTrue(all(isinstance(v, (int, float)) for v in snapshot.values()))
@@ -1,7 +1,22 @@
+from asyncio import create_task
+from asyncio import run as run_async
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from threading import Event
 from time import sleep
 from unittest import TestCase
 
-from src.xlib_commonpy.time_related import TimeoutTimerPassive
+from src.xlib_commonpy.time_related import (
+    Deadline,
+    DeadlineExceeded,
+    DeadlineManager,
+    LatencyHistogram,
+    Profiler,
+    TimerArray,
+    TimeoutTimerMonotonic,
+    TimeoutTimerPassive,
+    deadline_after_,
+)
 
 
 class TestTimeoutTimer(TestCase):
@@ -81,3 +96,272 @@ class TestTimeoutTimer(TestCase):
             self.assertTrue(uut.is_active())
             uut.reset()
             self.assertFalse(uut.is_active())
+
+
+class TestTimeoutTimerMonotonic(TestCase):
+    def test_init(self):
+        self.assertEqual(TimeoutTimerMonotonic(0.25).get_timeout_time_sec(), 0.25)
+        with self.assertRaises(RuntimeError):
+            TimeoutTimerMonotonic(timeout_time_sec=0)
+        with self.assertRaises(RuntimeError):
+            TimeoutTimerMonotonic(timeout_time_sec=-0.5)
+        # No dict to spend memory on
+        with self.assertRaises(AttributeError):
+            TimeoutTimerMonotonic(1).__dict__
+
+    def test_timing_out(self):
+        uut = TimeoutTimerMonotonic(timeout_time_sec=0.2)
+        self.assertFalse(uut.is_active())
+        self.assertFalse(uut.timed_out())
+
+        uut.start_timer()
+        self.assertTrue(uut.is_active())
+        self.assertFalse(uut.timed_out())
+        with self.assertRaises(RuntimeError):
+            uut.start_timer()
+
+        sleep(0.2)
+        self.assertFalse(uut.is_active())
+        self.assertTrue(uut.timed_out())
+        # Only reported once
+        self.assertFalse(uut.timed_out())
+
+        uut.start_timer()
+        sleep(0.2)
+        with self.assertRaises(RuntimeError):
+            uut.timed_out(raise_on_timeout=True)
+
+        uut.start_timer()
+        uut.reset()
+        self.assertFalse(uut.is_active())
+        self.assertFalse(uut.timed_out())
+
+
+class TestTimerArray(TestCase):
+    def test_timed_out(self):
+        uut = TimerArray()
+        short = [uut.add(0.1) for _ in range(50)]
+        long = [uut.add(100) for _ in range(50)]
+        self.assertEqual(len(uut), 100)
+        self.assertEqual(uut.get_timeout_time_sec(short[0]), 0.1)
+
+        # Nothing's running yet
+        sleep(0.1)
+        self.assertEqual(uut.timed_out(), [])
+
+        uut.start_all()
+        self.assertTrue(all(uut.is_active(i) for i in range(100)))
+        sleep(0.1)
+        self.assertEqual(uut.timed_out(), short)
+        # Only reported once
+        self.assertEqual(uut.timed_out(), [])
+        self.assertFalse(uut.is_active(short[0]))
+        self.assertTrue(uut.is_active(long[0]))
+
+        uut.start_timer(short[3])
+        with self.assertRaises(RuntimeError):
+            uut.start_timer(short[3])
+        uut.reset(short[3])
+        started = uut.add(0.1, start=True)
+        sleep(0.1)
+        self.assertEqual(uut.timed_out(), [started])
+
+        with self.assertRaises(RuntimeError):
+            uut.add(0)
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestDeadlineManager(TestCase):
+    def test_expired(self):
+        clock = FakeClock()
+        uut = DeadlineManager(clock=clock)
+        for i in range(10):
+            uut.add(i, timeout_sec=10 - i)
+        self.assertEqual(len(uut), 10)
+        self.assertEqual(uut.expired(), [])
+
+        clock.now += 3
+        self.assertEqual(uut.expired(), [9, 8, 7])
+        # Expired things get forgotten
+        self.assertEqual(uut.expired(), [])
+        self.assertEqual(len(uut), 7)
+        self.assertEqual(uut.next_deadline(), clock.now + 1)
+
+        clock.now += 100
+        self.assertEqual(uut.expired(), [6, 5, 4, 3, 2, 1, 0])
+        self.assertIsNone(uut.next_deadline())
+
+        with self.assertRaises(RuntimeError):
+            uut.add("zero", timeout_sec=0)
+        with self.assertRaises(RuntimeError):
+            uut.add("negative", timeout_sec=-1)
+
+    def test_cancel(self):
+        clock = FakeClock()
+        uut = DeadlineManager(clock=clock)
+        pendings = [uut.add(i, timeout_sec=1 + i) for i in range(1000)]
+        for pending in pendings:
+            if pending.item % 3:
+                self.assertTrue(pending.cancel())
+                self.assertFalse(pending.is_pending())
+        self.assertFalse(pendings[1].cancel())
+        self.assertEqual(len(uut), 334)
+        # Cancelled timeouts don't pile up in there
+        self.assertLess(len(uut._heap), 1000)
+
+        clock.now += 10000
+        self.assertEqual(uut.expired(), list(range(0, 1000, 3)))
+        # Can't cancel what already expired
+        self.assertFalse(pendings[0].cancel())
+
+    def test_active(self):
+        fired = []
+        done = Event()
+
+        def callback(item):
+            fired.append(item)
+            if len(fired) == 2:
+                done.set()
+
+        with self.assertRaises(ValueError):
+            DeadlineManager().start()
+
+        with DeadlineManager(callback=callback) as uut:
+            uut.add("later", timeout_sec=0.2)
+            uut.add("cancelled", timeout_sec=0.1).cancel()
+            # Added after the thread went to sleep, but due before what it sleeps for
+            uut.add("sooner", timeout_sec=0.05)
+            self.assertTrue(done.wait(5))
+            self.assertEqual(fired, ["sooner", "later"])
+
+        # Stopping leaves whatever's left alone
+        uut.add("leftover", timeout_sec=0.01)
+        sleep(0.05)
+        self.assertEqual(fired, ["sooner", "later"])
+        self.assertEqual(uut.expired(), ["leftover"])
+
+
+class TestDeadline(TestCase):
+    def test_budget(self):
+        self.assertIsNone(Deadline.current())
+        self.assertEqual(Deadline.timeout_sec_for_(5), 5)
+        self.assertIsNone(Deadline.timeout_sec_for_())
+
+        with deadline_after_(0.2) as uut:
+            self.assertIs(Deadline.current(), uut)
+            self.assertLessEqual(uut.remaining_sec(), 0.2)
+            self.assertLessEqual(Deadline.timeout_sec_for_(), 0.2)
+            self.assertEqual(Deadline.timeout_sec_for_(0.01), 0.01)
+            uut.check()
+
+            # Nesting shall only ever shorten the time left
+            with deadline_after_(100) as nested:
+                self.assertIs(nested, uut)
+            with deadline_after_(0.1) as nested:
+                self.assertIsNot(nested, uut)
+            self.assertIs(Deadline.current(), uut)
+
+            sleep(0.2)
+            self.assertTrue(uut.expired())
+            self.assertEqual(uut.remaining_sec(), 0)
+            with self.assertRaises(DeadlineExceeded):
+                uut.check()
+            with self.assertRaises(TimeoutError):
+                Deadline.timeout_sec_for_()
+        self.assertIsNone(Deadline.current())
+
+        with self.assertRaises(RuntimeError):
+            Deadline(0)
+
+    def test_propagation(self):
+        with deadline_after_(10) as uut:
+            # Threads are under it when they run in a copy of the context
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                self.assertIsNone(executor.submit(Deadline.current).result())
+                self.assertIs(
+                    executor.submit(copy_context().run, Deadline.current).result(), uut
+                )
+
+        async def in_task():
+            with deadline_after_(10) as deadline:
+                return deadline, await create_task(self._current_deadline_())
+
+        # And so are asyncio tasks created under it
+        deadline, in_task_deadline = run_async(in_task())
+        self.assertIs(in_task_deadline, deadline)
+
+    @staticmethod
+    async def _current_deadline_():
+        return Deadline.current()
+
+
+class TestLatencyHistogram(TestCase):
+    def test_percentiles(self):
+        uut = LatencyHistogram()
+        self.assertEqual(uut.percentile_ns(50), 0)
+        values = [i * 1_000 for i in range(1, 10_001)]
+        for value in reversed(values):
+            uut.record(value)
+        self.assertEqual(len(uut), 10_000)
+
+        # Percentiles shall be within the precision promised
+        for percentile in (1, 50, 90, 99, 99.9, 100):
+            expected = values[int(len(values) * percentile / 100) - 1]
+            actual = uut.percentile_ns(percentile)
+            self.assertLessEqual(abs(actual - expected) / expected, 1 / 64)
+
+        summary = uut.summary()
+        self.assertEqual(summary["count"], 10_000)
+        self.assertEqual(summary["min_sec"], 0.000001)
+        self.assertEqual(summary["max_sec"], 0.01)
+        self.assertAlmostEqual(summary["mean_sec"], 0.0050005)
+
+        # Small values shall be exact
+        uut = LatencyHistogram()
+        for value in (0, 3, 3, 100):
+            uut.record(value)
+        self.assertEqual(uut.percentile_ns(50), 3)
+        self.assertEqual(uut.percentile_ns(100), 100)
+
+    def test_merge(self):
+        uut, other = LatencyHistogram(), LatencyHistogram()
+        uut.record(10)
+        for _ in range(3):
+            other.record(1_000_000)
+        uut.merge(other)
+        self.assertEqual(len(uut), 4)
+        self.assertEqual(uut.percentile_ns(25), 10)
+        self.assertAlmostEqual(uut.percentile_ns(75), 1_000_000, delta=1_000_000 / 64)
+
+
+class TestProfiler(TestCase):
+    def test_spans(self):
+        uut = Profiler()
+
+        # Disabled, spans shall be the same do-nothing object and record nothing
+        self.assertIs(uut.span("a"), uut.span("b"))
+        with uut.span("a"):
+            pass
+        self.assertEqual(uut.report(), {})
+
+        uut.enabled = True
+        for _ in range(3):
+            with uut.span("a"):
+                sleep(0.01)
+        with self.assertRaises(KeyError), uut.span("b"):
+            raise KeyError  # Spans that raise still count
+        report = uut.report()
+        self.assertEqual(report["a"]["count"], 3)
+        self.assertGreaterEqual(report["a"]["p50_sec"], 0.01)
+        self.assertEqual(report["b"]["count"], 1)
+        self.assertEqual(len(uut.histogram("a")), 3)  # type: ignore
+
+        uut.reset()
+        self.assertEqual(uut.report(), {})
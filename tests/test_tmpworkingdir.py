@@ -1,12 +1,32 @@
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from shutil import rmtree
 from sys import executable
+from threading import Event, current_thread, main_thread
+from time import perf_counter, sleep, time
 from typing import Any, List
-from unittest import TestCase, mock
-from uuid import UUID
+from unittest import TestCase, mock, skipUnless
+from uuid import UUID, getnode, uuid1
 
 from src.xlib_commonpy import tmpworkingdir
-from src.xlib_commonpy.tmpworkingdir import TMPWorkingDir
+from src.xlib_commonpy.time_related import (
+    DeadlineExceeded,
+    deadline_after_,
+    profiler,
+)
+from src.xlib_commonpy.tmpworkingdir import TMPWorkingDir, TMPWorkingDirPool
+
+
+def _entries_of_(dirpath: Path) -> List[Path]:
+    """What's in a directory, other than the lockfiles of working directories' owners."""
+    return [
+        path
+        for path in dirpath.iterdir()
+        if not tmpworkingdir._OWNER_LOCK_NAME.fullmatch(path.name)
+    ]
 
 
 class TestTMPWorkingDir(TestCase):
@@ -16,7 +36,7 @@ class TestTMPWorkingDir(TestCase):
 
     @staticmethod
     def _contents_of_(dir: Path) -> List[Path]:
-        return list(dir.iterdir())
+        return _entries_of_(dir)
 
     def setUp(self) -> None:
         # Because these unit tests may potentially create create lots of directories,
@@ -193,15 +213,866 @@ class TestTMPWorkingDir(TestCase):
         uut.delete_workingdir()
         self.assertFalse(uut.dirpath.exists())
 
-    @mock.patch.object(tmpworkingdir, tmpworkingdir.rmtree.__name__)
-    def test_arg_for_rmtree_is_str(self, mock_rmtree: mock.MagicMock):
+    def test_names_unique(self):
+        # Names shall be unique even when made from many threads at once, and still
+        # tell when they were made
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            names = list(
+                executor.map(
+                    lambda _: TMPWorkingDir(self._UNITTEST_TMP_DIR).dirpath.name,
+                    range(10000),
+                )
+            )
+        self.assertEqual(len(set(names)), len(names))
+        made = (UUID(names[0].split("_")[-1]).time - 0x01B21DD213814000) / 10**7
+        self.assertAlmostEqual(made, time(), delta=60)
+
+    def test_name_taken(self):
+        uut = TMPWorkingDir(dirpath_parent=self._UNITTEST_TMP_DIR)
+        taken = uut.dirpath
+        taken.mkdir()
+        taken.joinpath("file").write_bytes(b"not yours")
+
+        # Like mkdtemp, creating shall never share a directory that's already there
+        with uut:
+            self.assertNotEqual(uut.dirpath, taken)
+            self.assertListEqual(self._contents_of_(dir=uut.dirpath), [])
+        self.assertEqual(taken.joinpath("file").read_bytes(), b"not yours")
+
+    def test_profiling(self):
+        profiler.reset()
+        profiler.enabled = True
+        try:
+            for _ in range(2):
+                with TMPWorkingDir(dirpath_parent=self._UNITTEST_TMP_DIR):
+                    pass
+        finally:
+            profiler.enabled = False
+        report = profiler.report()
+        profiler.reset()
+
+        # Creating and deleting shall each be timed
+        self.assertEqual(report["TMPWorkingDir.create_workingdir"]["count"], 2)
+        self.assertEqual(report["TMPWorkingDir.delete_workingdir"]["count"], 2)
+
+    def test_default_parent_follows_cwd(self):
+        cwd = Path().absolute()
+        os.chdir(str(self._UNITTEST_TMP_DIR))
+        try:
+            self.assertEqual(TMPWorkingDir().dirpath.parent, self._UNITTEST_TMP_DIR)
+        finally:
+            os.chdir(str(cwd))
+
+    @mock.patch.object(tmpworkingdir, tmpworkingdir._delete_tree_.__name__)
+    def test_arg_for_rmtree_is_str(self, mock_delete_tree: mock.MagicMock):
         """This test is necessary for backwards support for Python 3.5.2. Passing
-        pathlib.Path object to builtins.open and similar stuff doesn't work."""
+        pathlib.Path object to builtins.open and similar stuff doesn't work. Deleting
+        goes through _delete_tree_, which only falls back to rmtree on platforms that
+        can't delete relative to directory descriptors."""
 
-        def rm_tree_replacement(x: Any):
+        def delete_tree_replacement(x: Any):
             self.assertTrue(isinstance(x, str))
 
-        mock_rmtree.side_effect = rm_tree_replacement
+        mock_delete_tree.side_effect = delete_tree_replacement
 
         uut = TMPWorkingDir(dirpath_parent=self._UNITTEST_TMP_DIR)
         uut.delete_workingdir()
+        mock_delete_tree.assert_called_once()
+
+
+class TestMemoryBacked(TestCase):
+    _UNITTEST_TMP_DIR = Path().absolute().joinpath("_tmp_unittest_memory_backed")
+    # Stands in for a RAM-backed mount so these run anywhere
+    _DIRPATH_MEMORY = _UNITTEST_TMP_DIR.joinpath("memory")
+    _DIRPATH_DISK = _UNITTEST_TMP_DIR.joinpath("disk")
+
+    def setUp(self) -> None:
+        self._DIRPATH_MEMORY.mkdir(parents=True, exist_ok=True)
+        self._DIRPATH_DISK.mkdir(parents=True, exist_ok=True)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        try:
+            rmtree(str(self._UNITTEST_TMP_DIR))
+        except FileNotFoundError:
+            pass
+        return super().tearDown()
+
+    def _uut(self, memory_budget_bytes: int) -> TMPWorkingDir:
+        return TMPWorkingDir(
+            dirpath_parent=self._DIRPATH_DISK,
+            memory_budget_bytes=memory_budget_bytes,
+            dirpath_memory=self._DIRPATH_MEMORY,
+        )
+
+    def test_spills_once_over_budget(self):
+        with self._uut(memory_budget_bytes=64 * 1024) as uut:
+            # The working directory shall be in memory, with its spill directory being
+            # where it would have been otherwise
+            self.assertEqual(uut.dirpath.parent, self._DIRPATH_MEMORY)
+            self.assertEqual(uut.spill_dirpath, self._DIRPATH_DISK / uut.dirpath.name)
+            self.assertFalse(uut.spill_dirpath.exists())
+
+            first = uut.filepath_for("first")
+            self.assertEqual(first.parent, uut.dirpath)
+            first.write_bytes(os.urandom(100 * 1024))
+            self.assertGreaterEqual(uut.memory_bytes_used, 100 * 1024)
+
+            second = uut.filepath_for("second")
+            self.assertEqual(second.parent, uut.spill_dirpath)
+            second.write_bytes(b"x")
+
+            # Making room shall put new files back in memory
+            first.unlink()
+            self.assertEqual(uut.filepath_for("third").parent, uut.dirpath)
+
+        # Both directories shall be deleted
+        self.assertListEqual(_entries_of_(self._DIRPATH_MEMORY), [])
+        self.assertListEqual(_entries_of_(self._DIRPATH_DISK), [])
+
+    def test_size_hint(self):
+        with self._uut(memory_budget_bytes=64 * 1024) as uut:
+            self.assertEqual(uut.filepath_for("small", 1024).parent, uut.dirpath)
+            self.assertEqual(
+                uut.filepath_for("big", 65 * 1024).parent, uut.spill_dirpath
+            )
+
+    def test_before_creating(self):
+        # Asking where to put a file shall work before the directory's created, as it
+        # does without a memory budget
+        uut = self._uut(memory_budget_bytes=64 * 1024)
+        self.assertEqual(uut.filepath_for("early").parent, uut.dirpath)
+
+    def test_running_total(self):
+        # Handing out files shall cost the same however many there are already, so
+        # the directory's only counted from scratch when it's about to spill
+        count_ = tmpworkingdir._bytes_used_by_
+        with self._uut(memory_budget_bytes=2 * 1024 * 1024) as uut, mock.patch.object(
+            tmpworkingdir, count_.__name__, wraps=count_
+        ) as spy:
+            for i in range(200):
+                uut.filepath_for(str(i)).write_bytes(os.urandom(1000))
+            self.assertEqual(uut.memory_bytes_used, count_(uut.dirpath))
+            self.assertEqual(spy.call_count, 0)
+
+            # Size hints shall count until their files are written
+            big = uut.filepath_for("big", size_hint=1024 * 1024)
+            self.assertEqual(big.parent, uut.dirpath)
+            bigger = uut.filepath_for("bigger", size_hint=1024 * 1024)
+            self.assertEqual(bigger.parent, uut.spill_dirpath)
+            self.assertEqual(spy.call_count, 1)
+
+    def test_deferred_deletion(self):
+        uut = TMPWorkingDir(
+            dirpath_parent=self._DIRPATH_DISK,
+            defer_deletion=True,
+            memory_budget_bytes=0,
+            dirpath_memory=self._DIRPATH_MEMORY,
+        )
+        with uut:
+            uut.filepath_for("spilled").write_bytes(b"x")
+        self.assertTrue(TMPWorkingDir.drain(timeout_sec=10))
+        self.assertListEqual(_entries_of_(self._DIRPATH_MEMORY), [])
+        self.assertListEqual(_entries_of_(self._DIRPATH_DISK), [])
+
+    def test_without_memory_backing(self):
+        # Without a RAM-backed file system, it shall be a normal working directory
+        with mock.patch.object(
+            tmpworkingdir, "_ram_backed_dirpath_", return_value=None
+        ):
+            uut = TMPWorkingDir(
+                dirpath_parent=self._DIRPATH_DISK, memory_budget_bytes=1
+            )
+        self.assertEqual(uut.dirpath.parent, self._DIRPATH_DISK)
+        self.assertIsNone(uut.spill_dirpath)
+        with uut:
+            uut.filepath_for("file").write_bytes(os.urandom(1024))
+            self.assertEqual(uut.filepath_for("other").parent, uut.dirpath)
+            self.assertEqual(uut.memory_bytes_used, 0)
+
+    @skipUnless(tmpworkingdir._ram_backed_dirpath_() is not None, "No RAM-backed mount")
+    def test_finds_memory_backing(self):
+        uut = TMPWorkingDir(
+            dirpath_parent=self._DIRPATH_DISK, memory_budget_bytes=1024 * 1024
+        )
+        self.assertIn(uut.dirpath.parent, tmpworkingdir._RAM_BACKED_DIRPATHS)
+
+
+class TestSeeding(TestCase):
+    _UNITTEST_TMP_DIR = Path().absolute().joinpath("_tmp_unittest_seeding")
+    _DIRPATH_TEMPLATE = _UNITTEST_TMP_DIR.joinpath("template")
+
+    def setUp(self) -> None:
+        self._DIRPATH_TEMPLATE.joinpath("dir", "subdir").mkdir(parents=True)
+        self._DIRPATH_TEMPLATE.joinpath("writable").write_bytes(b"writable")
+        self._DIRPATH_TEMPLATE.joinpath("read-only").write_bytes(b"read-only")
+        self._DIRPATH_TEMPLATE.joinpath("read-only").chmod(0o444)
+        for n in range(100):
+            self._DIRPATH_TEMPLATE.joinpath("dir", "subdir", str(n)).write_text(str(n))
+        self._DIRPATH_TEMPLATE.joinpath("link").symlink_to("dir")
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        try:
+            rmtree(str(self._UNITTEST_TMP_DIR))
+        except FileNotFoundError:
+            pass
+        return super().tearDown()
+
+    def _uut(self) -> TMPWorkingDir:
+        return TMPWorkingDir(
+            dirpath_parent=self._UNITTEST_TMP_DIR,
+            dirpath_template=self._DIRPATH_TEMPLATE,
+        )
+
+    @staticmethod
+    def _tree_of_(dirpath: Path) -> List[Any]:
+        return sorted(
+            (
+                str(path.relative_to(dirpath)),
+                os.readlink(str(path)) if path.is_symlink() else None,
+                path.read_bytes() if path.is_file() and not path.is_symlink() else None,
+                path.lstat().st_mode & 0o777 if path.is_file() else None,
+            )
+            for path in dirpath.rglob("*")
+        )
+
+    def test_same_tree(self):
+        with self._uut() as uut:
+            self.assertListEqual(
+                self._tree_of_(uut.dirpath), self._tree_of_(self._DIRPATH_TEMPLATE)
+            )
+            # Changing the seeded files shall leave the template alone
+            uut.dirpath.joinpath("writable").write_bytes(b"changed")
+            uut.dirpath.joinpath("dir", "subdir", "0").unlink()
+        self.assertEqual(
+            self._DIRPATH_TEMPLATE.joinpath("writable").read_bytes(), b"writable"
+        )
+        self.assertTrue(self._DIRPATH_TEMPLATE.joinpath("dir", "subdir", "0").exists())
+        self.assertEqual(
+            self._DIRPATH_TEMPLATE.joinpath("read-only").read_bytes(), b"read-only"
+        )
+
+    def test_without_reflinks(self):
+        with mock.patch.object(
+            tmpworkingdir, "try_cloning_", return_value=False
+        ), self._uut() as uut:
+            # Read-only files shall be hard links, and the rest copies
+            self.assertTrue(
+                uut.dirpath.joinpath("read-only").samefile(
+                    self._DIRPATH_TEMPLATE.joinpath("read-only")
+                )
+            )
+            self.assertFalse(
+                uut.dirpath.joinpath("writable").samefile(
+                    self._DIRPATH_TEMPLATE.joinpath("writable")
+                )
+            )
+            self.assertListEqual(
+                self._tree_of_(uut.dirpath), self._tree_of_(self._DIRPATH_TEMPLATE)
+            )
+
+    def test_created_before_the_context(self):
+        # Entering what's been created already shall leave what's been seeded alone
+        # rather than seeding it again
+        uut = self._uut()
+        uut.create_workingdir()
+        uut.dirpath.joinpath("writable").write_bytes(b"changed")
+        with uut:
+            self.assertEqual(uut.dirpath.joinpath("writable").read_bytes(), b"changed")
+            self.assertEqual(
+                len(list(uut.dirpath.joinpath("dir", "subdir").iterdir())), 100
+            )
+        self.assertFalse(uut.dirpath.exists())
+
+    def test_failing_to_seed(self):
+        # A working directory that couldn't be seeded shall be deleted again, whether
+        # it was being created directly or by a context (which never gets to exit)
+        real_seed_file = tmpworkingdir._seed_file_
+
+        def seed_file_failing_once(fpath_src: str, *args: Any) -> None:
+            if fpath_src.endswith(os.sep + "50"):
+                raise PermissionError(fpath_src)
+            real_seed_file(fpath_src, *args)
+
+        with mock.patch.object(
+            tmpworkingdir, "_seed_file_", side_effect=seed_file_failing_once
+        ):
+            uut = self._uut()
+            with self.assertRaises(PermissionError):
+                uut.create_workingdir()
+            self.assertFalse(uut.dirpath.exists())
+            with self.assertRaises(PermissionError):
+                with self._uut():
+                    pass
+        self.assertListEqual(
+            _entries_of_(self._UNITTEST_TMP_DIR), [self._DIRPATH_TEMPLATE]
+        )
+
+    def test_read_only_template_dir(self):
+        # The seeded directories shall stay writable so the working directory can
+        # still be deleted
+        self._DIRPATH_TEMPLATE.joinpath("dir", "subdir").chmod(0o555)
+        try:
+            with self._uut() as uut:
+                self.assertTrue(
+                    os.access(str(uut.dirpath.joinpath("dir", "subdir")), os.W_OK)
+                )
+            self.assertFalse(uut.dirpath.exists())
+        finally:
+            self._DIRPATH_TEMPLATE.joinpath("dir", "subdir").chmod(0o755)
+
+
+class TestDeferredDeletion(TestCase):
+    _UNITTEST_TMP_DIR = Path().absolute().joinpath("_tmp_unittest_deferred_deletion")
+
+    def setUp(self) -> None:
+        self._UNITTEST_TMP_DIR.mkdir(parents=True, exist_ok=True)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        TMPWorkingDir.drain()
+        rmtree(str(self._UNITTEST_TMP_DIR), ignore_errors=True)
+        return super().tearDown()
+
+    @staticmethod
+    def _fill_(dirpath: Path, file_count: int) -> None:
+        for i in range(file_count):
+            dirpath.joinpath(str(i)).write_bytes(b"x")
+
+    def test_deleting_in_the_background(self):
+        uut = TMPWorkingDir(dirpath_parent=self._UNITTEST_TMP_DIR, defer_deletion=True)
+        reaper_may_continue = Event()
+        real_delete = tmpworkingdir._delete_tree_
+
+        def delete_when_allowed(path: str) -> None:
+            reaper_may_continue.wait(timeout=10)
+            real_delete(path)
+
+        with mock.patch.object(
+            tmpworkingdir, tmpworkingdir._delete_tree_.__name__, delete_when_allowed
+        ):
+            with uut:
+                self._fill_(uut.dirpath, file_count=100)
+
+            # The working directory shall be out of the way as soon as the context
+            # closes, even though its files aren't deleted yet
+            self.assertFalse(uut.dirpath.exists())
+            tombstones = _entries_of_(self._UNITTEST_TMP_DIR)
+            self.assertEqual(len(tombstones), 1)
+            self.assertTrue(tombstones[0].name.startswith(uut.dirpath.name))
+            self.assertEqual(len(list(tombstones[0].iterdir())), 100)
+
+            # Draining shall time out while the reaper is stuck
+            self.assertFalse(TMPWorkingDir.drain(timeout_sec=0.05))
+
+            # The same working directory shall be reusable in the meantime
+            with uut:
+                self._fill_(uut.dirpath, file_count=10)
+            self.assertEqual(len(_entries_of_(self._UNITTEST_TMP_DIR)), 2)
+
+            reaper_may_continue.set()
+            self.assertTrue(TMPWorkingDir.drain(timeout_sec=10))
+        self.assertListEqual(_entries_of_(self._UNITTEST_TMP_DIR), [])
+
+    def test_exit_latency(self):
+        def exit_sec_of_(uut: TMPWorkingDir) -> float:
+            with uut:
+                self._fill_(uut.dirpath, file_count=500)
+                # Keeps the reaper from competing with the exit for the interpreter
+                TMPWorkingDir.drain()
+                started = perf_counter()
+            return perf_counter() - started
+
+        deferred = TMPWorkingDir(
+            dirpath_parent=self._UNITTEST_TMP_DIR, defer_deletion=True
+        )
+        deferred_exit_sec = min(exit_sec_of_(deferred) for _ in range(5))
+        plain_exit_sec = exit_sec_of_(TMPWorkingDir(self._UNITTEST_TMP_DIR))
+
+        # Leaving shall only cost a rename, which for hundreds of files is far less
+        # than deleting them
+        self.assertLess(deferred_exit_sec * 5, plain_exit_sec)
+
+    def test_deleting_under_a_deadline(self):
+        reaper_may_continue = Event()
+        real_delete = tmpworkingdir._delete_tree_
+
+        def delete_when_allowed(path: str) -> None:
+            reaper_may_continue.wait(timeout=10)
+            real_delete(path)
+
+        # With time to spare, deleting shall be waited on like usual
+        with deadline_after_(10):
+            with TMPWorkingDir(dirpath_parent=self._UNITTEST_TMP_DIR) as uut:
+                self._fill_(uut.dirpath, file_count=10)
+        self.assertListEqual(_entries_of_(self._UNITTEST_TMP_DIR), [])
+
+        # But only until time's up, after which it's finished in the background
+        with mock.patch.object(
+            tmpworkingdir, tmpworkingdir._delete_tree_.__name__, delete_when_allowed
+        ), deadline_after_(0.2):
+            with TMPWorkingDir(dirpath_parent=self._UNITTEST_TMP_DIR) as uut:
+                self._fill_(uut.dirpath, file_count=10)
+            self.assertFalse(uut.dirpath.exists())
+            self.assertEqual(len(_entries_of_(self._UNITTEST_TMP_DIR)), 1)
+
+            # Nothing new shall be started once it's passed
+            with self.assertRaises(DeadlineExceeded):
+                TMPWorkingDir(dirpath_parent=self._UNITTEST_TMP_DIR).create_workingdir()
+            reaper_may_continue.set()
+            self.assertTrue(TMPWorkingDir.drain(timeout_sec=10))
+        self.assertListEqual(_entries_of_(self._UNITTEST_TMP_DIR), [])
+
+    def test_full_queue_deletes_inline(self):
+        reaper = tmpworkingdir._Reaper(max_pending=1)
+        reaper_may_continue = Event()
+        real_delete = tmpworkingdir._delete_tree_
+
+        def delete_blocking_in_background(path: str) -> None:
+            if current_thread() is not main_thread():
+                reaper_may_continue.wait(timeout=10)
+            real_delete(path)
+
+        with mock.patch.object(tmpworkingdir, "_reaper", reaper), mock.patch.object(
+            tmpworkingdir,
+            tmpworkingdir._delete_tree_.__name__,
+            delete_blocking_in_background,
+        ), mock.patch.object(tmpworkingdir, tmpworkingdir.register.__name__) as spy:
+            uuts = [
+                TMPWorkingDir(
+                    dirpath_parent=self._UNITTEST_TMP_DIR, defer_deletion=True
+                )
+                for _ in range(4)
+            ]
+            for uut in uuts:
+                uut.create_workingdir()
+            uuts[0].delete_workingdir()
+            # Wait for the reaper to get stuck on the first so the queue has one slot
+            while reaper._queue.qsize():
+                sleep(0.001)
+            uuts[1].delete_workingdir()
+
+            # With the queue full, deletion shall happen inline rather than pile up
+            uuts[2].delete_workingdir()
+            uuts[3].delete_workingdir()
+            self.assertEqual(len(_entries_of_(self._UNITTEST_TMP_DIR)), 2)
+
+            reaper_may_continue.set()
+            self.assertTrue(reaper.drain(timeout_sec=10))
+            self.assertListEqual(_entries_of_(self._UNITTEST_TMP_DIR), [])
+
+            # Whatever's pending at exit shall be waited on
+            spy.assert_called_once_with(reaper.drain)
+
+
+class TestTreeDeletion(TestCase):
+    _UNITTEST_TMP_DIR = Path().absolute().joinpath("_tmp_unittest_tree_deletion")
+
+    def setUp(self) -> None:
+        self._UNITTEST_TMP_DIR.mkdir(parents=True, exist_ok=True)
+        self._dirpath_tree = self._UNITTEST_TMP_DIR.joinpath("tree")
+        self._dirpath_outside = self._UNITTEST_TMP_DIR.joinpath("outside")
+        self._dirpath_outside.mkdir()
+        self._dirpath_outside.joinpath("keep.txt").write_text("keep")
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        rmtree(str(self._UNITTEST_TMP_DIR), ignore_errors=True)
+        return super().tearDown()
+
+    def _make_tree(self) -> None:
+        """Wide, deep, empty and symlinked parts all at once."""
+        self._dirpath_tree.mkdir()
+        for i in range(20):
+            self._dirpath_tree.joinpath(f"file {i}").write_bytes(b"x")
+        for i in range(5):
+            dirpath_wide = self._dirpath_tree.joinpath(f"wide {i}")
+            dirpath_wide.mkdir()
+            for j in range(10):
+                dirpath_wide.joinpath(str(j)).write_bytes(b"x")
+        dirpath_deep = self._dirpath_tree
+        for i in range(30):
+            dirpath_deep = dirpath_deep.joinpath(f"deep {i}")
+            dirpath_deep.mkdir()
+            dirpath_deep.joinpath("file").write_bytes(b"x")
+        self._dirpath_tree.joinpath("empty", "emptier").mkdir(parents=True)
+        self._dirpath_tree.joinpath("to outside").symlink_to(self._dirpath_outside)
+        self._dirpath_tree.joinpath("to file").symlink_to(
+            self._dirpath_outside.joinpath("keep.txt")
+        )
+        self._dirpath_tree.joinpath("broken").symlink_to("nowhere")
+
+    def _assert_outside_kept(self) -> None:
+        self.assertEqual(self._dirpath_outside.joinpath("keep.txt").read_text(), "keep")
+
+    def test_deleting_trees(self):
+        # Batches of a directory's files shall be split up as well as subdirectories
+        for batch_size in (3, tmpworkingdir._UNLINK_BATCH_SIZE):
+            self._make_tree()
+            with mock.patch.object(tmpworkingdir, "_UNLINK_BATCH_SIZE", batch_size):
+                tmpworkingdir._delete_tree_(str(self._dirpath_tree))
+
+            # Everything shall be gone, but nothing symlinks point to
+            self.assertFalse(os.path.lexists(str(self._dirpath_tree)))
+            self._assert_outside_kept()
+
+    def test_missing_tree(self):
+        with self.assertRaises(FileNotFoundError):
+            tmpworkingdir._delete_tree_(str(self._dirpath_tree))
+
+    def test_errors_are_raised_after_deleting_the_rest(self):
+        self._make_tree()
+        real_unlink = os.unlink
+
+        def unlink_except_one(path: Any, *args: Any, **kwargs: Any) -> None:
+            if path == "file 7":
+                raise PermissionError(path)
+            real_unlink(path, *args, **kwargs)
+
+        with mock.patch.object(os, "unlink", unlink_except_one):
+            with self.assertRaises(PermissionError):
+                tmpworkingdir._delete_tree_(str(self._dirpath_tree))
+
+        # Only the file that couldn't be deleted shall be left (with its directory)
+        self.assertListEqual(
+            [path.name for path in self._dirpath_tree.iterdir()], ["file 7"]
+        )
+        self._assert_outside_kept()
+
+    def test_without_threads(self):
+        # Once the interpreter's exiting, the threads are gone, and deleting shall still
+        # finish rather than hang
+        self._make_tree()
+        executor = ThreadPoolExecutor(max_workers=1)
+        executor.shutdown()
+        with mock.patch.object(tmpworkingdir, "_deletion_executor", executor):
+            tmpworkingdir._delete_tree_(str(self._dirpath_tree))
+        self.assertFalse(os.path.lexists(str(self._dirpath_tree)))
+        self._assert_outside_kept()
+
+    def test_fallback(self):
+        # Platforms without directory descriptors shall get rmtree
+        self._make_tree()
+        with mock.patch.object(
+            tmpworkingdir, "_CAN_DELETE_WITH_DIR_FD", False
+        ), mock.patch.object(
+            tmpworkingdir, tmpworkingdir.rmtree.__name__, wraps=rmtree
+        ) as spy:
+            tmpworkingdir._delete_tree_(str(self._dirpath_tree))
+        spy.assert_called_once_with(str(self._dirpath_tree))
+        self.assertFalse(os.path.lexists(str(self._dirpath_tree)))
+
+
+class TestSweepingOrphans(TestCase):
+    _UNITTEST_TMP_DIR = Path().absolute().joinpath("_tmp_unittest_sweeping_orphans")
+
+    def setUp(self) -> None:
+        self._UNITTEST_TMP_DIR.mkdir(parents=True, exist_ok=True)
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        try:
+            rmtree(str(self._UNITTEST_TMP_DIR))
+        except FileNotFoundError:
+            pass
+        return super().tearDown()
+
+    @staticmethod
+    def _uuid1_from_(age_sec: float, node: int = getnode()) -> UUID:
+        timestamp = int((time() - age_sec) * 10**7) + 0x01B21DD213814000
+        return UUID(
+            fields=(
+                timestamp & 0xFFFFFFFF,
+                (timestamp >> 32) & 0xFFFF,
+                (timestamp >> 48) & 0x0FFF | 0x1000,
+                0x80,
+                0,
+                node,
+            )
+        )
+
+    def _make_dir(self, name: str) -> Path:
+        dirpath = self._UNITTEST_TMP_DIR.joinpath(name)
+        dirpath.joinpath("inside").mkdir(parents=True)
+        return dirpath
+
+    def _lockfiles(self) -> List[Path]:
+        return [
+            path
+            for path in self._UNITTEST_TMP_DIR.iterdir()
+            if tmpworkingdir._OWNER_LOCK_NAME.fullmatch(path.name)
+        ]
+
+    def _sweep(self, **kwargs: Any) -> int:
+        return TMPWorkingDir.sweep_orphans(
+            dirpath_parent=self._UNITTEST_TMP_DIR, **kwargs
+        )
+
+    @skipUnless(tmpworkingdir.flock is not None, "No flock")
+    def test_killed_owner(self):
+        # A process that got SIGKILLed shall have its working directory swept, even
+        # right away, and its lockfile along with it
+        code = (
+            "import os, signal\n"
+            "from pathlib import Path\n"
+            "from src.xlib_commonpy.tmpworkingdir import TMPWorkingDir\n"
+            f"uut = TMPWorkingDir(dirpath_parent=Path({str(self._UNITTEST_TMP_DIR)!r}))\n"
+            "uut.create_workingdir()\n"
+            "uut.dirpath.joinpath('file').write_bytes(b'x')\n"
+            "print(uut.dirpath.name, flush=True)\n"
+            "os.kill(os.getpid(), signal.SIGKILL)\n"
+        )
+        completed = subprocess.run(
+            [executable, "-c", code], stdout=subprocess.PIPE, check=False
+        )
+        name = completed.stdout.decode().strip()
+        self.assertTrue(self._UNITTEST_TMP_DIR.joinpath(name).is_dir())
+        self.assertEqual(len(self._lockfiles()), 1)
+
+        self.assertEqual(self._sweep(min_age_sec=0), 1)
+        self.assertListEqual(list(self._UNITTEST_TMP_DIR.iterdir()), [])
+
+    @skipUnless(tmpworkingdir.flock is not None, "No flock")
+    def test_owner_with_another_temp_dir(self):
+        # Owners and sweepers needn't agree on a temp directory (which is per user on
+        # macOS, per job under Slurm, ...) for live working directories to be kept
+        dirpath_owner_tmp = self._UNITTEST_TMP_DIR.joinpath("owner tmp")
+        dirpath_owner_tmp.mkdir()
+        dirpath_parent = self._UNITTEST_TMP_DIR.joinpath("parent")
+        code = (
+            "import sys\n"
+            "from pathlib import Path\n"
+            "from src.xlib_commonpy.tmpworkingdir import TMPWorkingDir\n"
+            f"uut = TMPWorkingDir(dirpath_parent=Path({str(dirpath_parent)!r}))\n"
+            "uut.create_workingdir()\n"
+            "print(uut.dirpath.name, flush=True)\n"
+            "sys.stdin.read()\n"
+        )
+        owner = subprocess.Popen(
+            [executable, "-c", code],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=dict(os.environ, TMPDIR=str(dirpath_owner_tmp)),
+        )
+        try:
+            name = owner.stdout.readline().decode().strip()  # type: ignore
+            dirpath_sweeper_tmp = self._UNITTEST_TMP_DIR.joinpath("sweeper tmp")
+            dirpath_sweeper_tmp.mkdir()
+            with mock.patch.object(tempfile, "tempdir", str(dirpath_sweeper_tmp)):
+                swept = TMPWorkingDir.sweep_orphans(dirpath_parent, min_age_sec=0)
+            self.assertEqual(swept, 0)
+            self.assertTrue(dirpath_parent.joinpath(name).is_dir())
+        finally:
+            owner.kill()
+            owner.wait()
+            owner.stdout.close()  # type: ignore
+            owner.stdin.close()  # type: ignore
+        self.assertEqual(TMPWorkingDir.sweep_orphans(dirpath_parent, min_age_sec=0), 1)
+
+    def test_one_lockfile_per_parent(self):
+        # However many working directories there are, the owner only takes one lock
+        # in each directory they're in, and keeps it after they're gone
+        with mock.patch.object(
+            tmpworkingdir, "_take_owner_lock_", wraps=tmpworkingdir._take_owner_lock_
+        ) as spy:
+            for _ in range(10):
+                with TMPWorkingDir(dirpath_parent=self._UNITTEST_TMP_DIR):
+                    pass
+        self.assertEqual(spy.call_count, 1)
+        self.assertEqual(len(self._lockfiles()), 1)
+
+        # It's taken again if its lockfile goes missing, lest sweeping take what's
+        # there for orphans
+        self._lockfiles()[0].unlink()
+        with TMPWorkingDir(dirpath_parent=self._UNITTEST_TMP_DIR) as uut:
+            self.assertEqual(len(self._lockfiles()), 1)
+            self.assertEqual(self._sweep(min_age_sec=0), 0)
+            self.assertTrue(uut.dirpath.is_dir())
+
+    def test_live_owner(self):
+        # Working directories in use (including tombstones still being deleted) shall
+        # be left alone however old they are
+        reaper_may_continue = Event()
+        real_delete = tmpworkingdir._delete_tree_
+
+        def delete_blocking_in_background(path: str) -> None:
+            if current_thread() is not main_thread():
+                reaper_may_continue.wait(timeout=10)
+            real_delete(path)
+
+        with TMPWorkingDir(
+            dirpath_parent=self._UNITTEST_TMP_DIR
+        ) as live, TMPWorkingDir(
+            dirpath_parent=self._UNITTEST_TMP_DIR, defer_deletion=True
+        ) as deferred, mock.patch.object(
+            tmpworkingdir,
+            tmpworkingdir._delete_tree_.__name__,
+            delete_blocking_in_background,
+        ):
+            deferred.delete_workingdir()
+            self.assertEqual(self._sweep(min_age_sec=0), 0)
+            self.assertTrue(live.dirpath.is_dir())
+            self.assertEqual(len(_entries_of_(self._UNITTEST_TMP_DIR)), 2)
+            reaper_may_continue.set()
+            self.assertTrue(TMPWorkingDir.drain(timeout_sec=10))
+
+    def test_names(self):
+        old = self._uuid1_from_(age_sec=3600)
+        orphans = [
+            self._make_dir(f"_tmp_python_{old}"),
+            self._make_dir(f"_tmp_other_program_{self._uuid1_from_(age_sec=3600)}"),
+            self._make_dir(f"_tmp_python_{old}.deleting3"),
+        ]
+        quarantined = self._make_dir(
+            f"_tmp_python_{self._uuid1_from_(age_sec=3600)}.quarantined"
+        )
+        kept = [
+            # Too young
+            self._make_dir(f"_tmp_python_{uuid1()}"),
+            # Not working directories at all
+            self._make_dir("_tmp_python_not-a-uuid"),
+            self._make_dir(f"data_{old}"),
+        ]
+        if not getnode() & 0x010000000000:
+            # From another host (which can only be told with a real MAC address)
+            kept.append(
+                self._make_dir(
+                    f"_tmp_python_{self._uuid1_from_(3600, node=getnode() ^ 1)}"
+                )
+            )
+        kept.append(self._UNITTEST_TMP_DIR.joinpath(f"_tmp_file_{old}"))
+        kept[-1].write_bytes(b"x")
+
+        self.assertEqual(self._sweep(), len(orphans))
+        self.assertListEqual(
+            sorted(_entries_of_(self._UNITTEST_TMP_DIR)), sorted(kept + [quarantined])
+        )
+
+        # Quarantined ones shall only go when asked
+        self.assertEqual(self._sweep(include_quarantined=True), 1)
+        self.assertFalse(quarantined.exists())
+
+
+class TestTMPWorkingDirPool(TestCase):
+    _UNITTEST_TMP_DIR = (
+        Path().absolute().joinpath("_tmp_unittest_" + TMPWorkingDirPool.__name__)
+    )
+
+    def setUp(self) -> None:
+        self._UNITTEST_TMP_DIR.mkdir(parents=True, exist_ok=True)
+        self._pools: List[TMPWorkingDirPool] = []
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        # Closing first so no maintenance is still going on while cleaning up
+        for pool in self._pools:
+            pool.close()
+        try:
+            rmtree(str(self._UNITTEST_TMP_DIR))
+        except FileNotFoundError:
+            pass
+        return super().tearDown()
+
+    def _pool(self, **kwargs: Any) -> TMPWorkingDirPool:
+        pool = TMPWorkingDirPool(dirpath_parent=self._UNITTEST_TMP_DIR, **kwargs)
+        self._pools.append(pool)
+        return pool
+
+    def _dirnames(self) -> List[str]:
+        return sorted(path.name for path in _entries_of_(self._UNITTEST_TMP_DIR))
+
+    def test_precreated(self):
+        uut = self._pool(min_ready=3)
+        self.assertEqual(uut.ready_count, 3)
+        self.assertEqual(len(self._dirnames()), 3)
+
+        # Directories shall be handed out as they are, with nothing made on demand
+        with uut.workingdir() as workingdir:
+            self.assertTrue(workingdir.dirpath.is_dir())
+            self.assertListEqual(list(workingdir.dirpath.iterdir()), [])
+            self.assertEqual(uut.leased_count, 1)
+            uut._wait_for_maintenance()
+            # It shall top itself back up in the background
+            self.assertEqual(uut.ready_count, 3)
+
+    def test_recycled(self):
+        uut = self._pool(min_ready=1)
+        with uut.workingdir() as workingdir:
+            first = workingdir.dirpath
+            first.joinpath("file").write_bytes(b"x")
+            first.joinpath("dir", "subdir").mkdir(parents=True)
+            first.joinpath("dir", "subdir", "file").write_bytes(b"x")
+            first.joinpath("link").symlink_to(self._UNITTEST_TMP_DIR)
+        uut._wait_for_maintenance()
+
+        # The same directory shall come back, wiped clean, and where the symlink
+        # pointed shall be untouched
+        self.assertEqual(uut.leased_count, 0)
+        with uut.workingdir() as workingdir:
+            self.assertEqual(workingdir.dirpath, first)
+            self.assertListEqual(list(first.iterdir()), [])
+        self.assertTrue(self._UNITTEST_TMP_DIR.is_dir())
+
+    def test_limit(self):
+        uut = self._pool(min_ready=0, max_dirs=2)
+        first = uut.workingdir()
+        first.__enter__()
+        second = uut.workingdir()
+        second.__enter__()
+        with self.assertRaises(TimeoutError):
+            uut.workingdir(timeout_sec=0.05)
+
+        # Giving one back shall let a waiting lease through
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            waiting = executor.submit(uut.workingdir, 5)
+            sleep(0.05)
+            self.assertFalse(waiting.done())
+            first.__exit__(None, None, None)
+            third = waiting.result()
+            self.assertEqual(third.dirpath, first.dirpath)
+        second.__exit__(None, None, None)
+        third.__exit__(None, None, None)
+
+    def test_quarantined(self):
+        uut = self._pool(min_ready=1)
+        with mock.patch.object(tmpworkingdir, "_wipe_", side_effect=PermissionError):
+            with uut.workingdir() as workingdir:
+                dirpath = workingdir.dirpath
+                dirpath.joinpath("file").write_bytes(b"x")
+            uut._wait_for_maintenance()
+
+        # The dirty directory shall be set aside under another name, and never handed
+        # out again
+        self.assertEqual(uut.quarantined_count, 1)
+        quarantined = dirpath.with_name(dirpath.name + ".quarantined")
+        self.assertTrue(quarantined.joinpath("file").is_file())
+        self.assertEqual(uut.ready_count, 1)
+        with uut.workingdir() as other:
+            self.assertNotEqual(other.dirpath, dirpath)
+
+    def test_shrinks(self):
+        uut = self._pool(min_ready=1, max_dirs=8, idle_timeout_sec=0)
+        leases = [uut.workingdir() for _ in range(5)]
+        for lease in leases:
+            lease.__enter__()
+        for lease in leases:
+            lease.__exit__(None, None, None)
+        uut._wait_for_maintenance()
+
+        # Having gone unused, the directories beyond min_ready shall be deleted
+        self.assertEqual(uut.ready_count, 1)
+        self.assertEqual(len(self._dirnames()), 1)
+
+    def test_close(self):
+        uut = TMPWorkingDirPool(dirpath_parent=self._UNITTEST_TMP_DIR, min_ready=2)
+        lease = uut.workingdir()
+        lease.__enter__()
+        uut.close()
+
+        # Ready directories shall be deleted right away and leased ones once given back
+        self.assertListEqual(self._dirnames(), [lease.dirpath.name])
+        lease.__exit__(None, None, None)
+        self.assertListEqual(self._dirnames(), [])
+        with self.assertRaises(ValueError):
+            uut.workingdir()